@@ -32,6 +32,38 @@ class JsonsDontMatchPathsError(AutocertError):
         message = f'len(jsons) -> {len_jsons} != len(paths) -> {len_paths}; jsons={jsons}, paths={paths}'
         super(JsonsDontMatchPathsError, self).__init__(message)
 
+class UnknownPairingError(AutocertError):
+    def __init__(self, pairing):
+        message = f'unknown pairing {pairing}; choices={PAIRINGS}'
+        super(UnknownPairingError, self).__init__(message)
+
+ZIP = 'zip'
+BROADCAST = 'broadcast'
+PRODUCT = 'product'
+PAIRINGS = (ZIP, BROADCAST, PRODUCT)
+
+def pair(paths, jsons, pairing=None):
+    '''
+    pair paths with jsons; zip -> one json per path, broadcast -> the single json
+    is sent to every path, product -> every path gets every json; when pairing is
+    None it is inferred from the lengths of paths and jsons
+    '''
+    paths = list(paths)
+    jsons = list(jsons)
+    if pairing is None:
+        pairing = BROADCAST if len(jsons) == 1 else ZIP
+    if pairing == ZIP:
+        if len(jsons) != len(paths):
+            raise JsonsDontMatchPathsError(jsons, paths)
+        return list(zip(paths, jsons))
+    elif pairing == BROADCAST:
+        if len(jsons) != 1:
+            raise JsonsDontMatchPathsError(jsons, paths)
+        return [(path, jsons[0]) for path in paths]
+    elif pairing == PRODUCT:
+        return list(product(paths, jsons))
+    raise UnknownPairingError(pairing)
+
 class AuthorityBase(object):
     def __init__(self, ar, cfg, verbosity):
         self.ar = ar
@@ -64,28 +96,36 @@ class AuthorityBase(object):
     def delete(self, path=None, **kw):
         return self.request('DELETE', path=path, **kw)
 
-    def requests(self, method, paths=None, jsons=None, **kw):
+    def requests(self, method, paths=None, jsons=None, pairing=None, **kw):
         if not paths or not hasattr(paths, '__iter__'):
             raise AuthorityPathError(paths)
         if jsons:
-            if len(jsons) != len(paths):
-                raise JsonsDontMatchPathsError(jsons, paths)
-            kws = [self.keywords(path=path, json=json, **kw) for (path, json) in product(paths, jsons)]
+            kws = [self.keywords(path=path, json=json, **kw) for (path, json) in pair(paths, jsons, pairing)]
         else:
             kws = [self.keywords(path=path, **kw) for path in paths]
-        return self.ar.requests(method, *kws)
+        return self.windowed(method, kws)
+
+    def windowed(self, method, kws):
+        '''
+        send kws through the async runner at most cfg.concurrency at a time
+        '''
+        window = self.cfg.get('concurrency', None) or len(kws)
+        calls = []
+        for index in range(0, len(kws), window):
+            calls += self.ar.requests(method, *kws[index:index+window])
+        return calls
 
-    def gets(self, paths=None, jsons=None, **kw):
-        return self.requests('GET', paths=paths, jsons=jsons, **kw)
+    def gets(self, paths=None, jsons=None, pairing=None, **kw):
+        return self.requests('GET', paths=paths, jsons=jsons, pairing=pairing, **kw)
 
-    def puts(self, paths=None, jsons=None, **kw):
-        return self.requests('PUT', paths=paths, jsons=jsons, **kw)
+    def puts(self, paths=None, jsons=None, pairing=None, **kw):
+        return self.requests('PUT', paths=paths, jsons=jsons, pairing=pairing, **kw)
 
-    def posts(self, paths=None, jsons=None, **kw):
-        return self.requests('POST', paths=paths, jsons=jsons, **kw)
+    def posts(self, paths=None, jsons=None, pairing=None, **kw):
+        return self.requests('POST', paths=paths, jsons=jsons, pairing=pairing, **kw)
 
-    def deletes(self, paths=None, jsons=None, **kw):
-        return self.requests('DELETE', paths=paths, jsons=jsons, **kw)
+    def deletes(self, paths=None, jsons=None, pairing=None, **kw):
+        return self.requests('DELETE', paths=paths, jsons=jsons, pairing=pairing, **kw)
 
     def has_connectivity(self):
         raise NotImplementedError
@@ -96,9 +136,73 @@ class AuthorityBase(object):
     def create_certificate(self, organization_name, common_name, validity_years, csr, bug, sans=None, repeat_delta=None):
         raise NotImplementedError
 
+    def create_certificates(self, organization_name, specs, validity_years, bug, repeat_delta=None, whois_check=False):
+        '''
+        specs are dicts of common_name, csr and sans; returns one result per spec
+        holding either crt, expiry and authority or error; authorities that can't
+        order in batches fall back to ordering one certificate at a time
+        '''
+        results = []
+        for spec in specs:
+            try:
+                crt, expiry, authority = self.create_certificate(
+                    organization_name,
+                    spec['common_name'],
+                    validity_years,
+                    spec['csr'],
+                    bug,
+                    sans=spec['sans'],
+                    repeat_delta=repeat_delta,
+                    whois_check=whois_check)
+                results += [dict(crt=crt, expiry=expiry, authority=authority)]
+            except AutocertError as ae:
+                app.logger.error(ae)
+                results += [dict(error=ae.message)]
+        return results
+
     def renew_certificates(self, bundles, organization_name, validity_years, bug, repeat_delta=None):
         raise NotImplementedError
 
-    def revoke_certificates(self, bundles):
+    def renew_certificates_results(self, bundles, organization_name, validity_years, bug, sans=None, repeat_delta=None, whois_check=False):
+        '''
+        one result per bundle, like create_certificates; authorities that can't
+        renew order by order fail every bundle when the batch fails
+        '''
+        try:
+            crts, expiries, authorities = self.renew_certificates(
+                bundles,
+                organization_name,
+                validity_years,
+                bug,
+                sans,
+                repeat_delta,
+                whois_check)
+        except AutocertError as ae:
+            app.logger.error(ae)
+            return [dict(error=ae.message) for bundle in bundles]
+        return [
+            dict(crt=crt, expiry=expiry, authority=authority)
+            for crt, expiry, authority in zip(crts, expiries, authorities)]
+
+    def revoke_certificates(self, bundles, bug, persist=None):
+        '''
+        revoke in windows of cfg.concurrency bundles; each window is revoked and
+        handed to persist before the next one starts, and a bundle that fails
+        only fails itself; returns the revoked bundles and errors by bundle_name
+        '''
+        app.logger.info(f'revoke_certificates:\n{locals}')
+        window = self.cfg.get('concurrency', None) or len(bundles) or 1
+        revoked, errors = [], {}
+        for index in range(0, len(bundles), window):
+            done, failed = self._revoke_window(bundles[index:index+window], bug)
+            for bundle_name, error in failed.items():
+                app.logger.error(f'failed to revoke {bundle_name}: {error}')
+            errors.update(failed)
+            if persist and done:
+                persist(done)
+            revoked += done
+        return revoked, errors
+
+    def _revoke_window(self, bundles, bug):
         raise NotImplementedError
 
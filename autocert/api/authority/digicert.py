@@ -2,16 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import io
+import os
 import zipfile
 from attrdict import AttrDict
 from pprint import pprint, pformat
 from fnmatch import fnmatch
 from datetime import timedelta #FIXME: do we import this here?
+from urllib.parse import urlencode
 from whois import whois
 from tld import get_fld
 
-from authority.base import AuthorityBase
+from authority.base import AuthorityBase, ZIP, BROADCAST
 from exceptions import AutocertError
+from cache import Cache
 from utils.dictionary import merge, body
 from utils.newline import windows2unix
 from app import app
@@ -19,6 +22,17 @@ from app import app
 def not_200(call):
     return call.recv.status != 200
 
+def error_code(call):
+    '''
+    the code of the first error digicert returned, or None when the response
+    has none, eg. an html 502 from a proxy
+    '''
+    json = call.recv.get('json', None)
+    if not isinstance(json, dict):
+        return None
+    errors = json.get('errors', None) or [{}]
+    return errors[0].get('code', None) if isinstance(errors[0], dict) else None
+
 def strip_wildcard(domain):
     return domain[2:] if domain.startswith('*.') else domain
 
@@ -61,10 +75,25 @@ class WhoisDoesntMatchError(AutocertError):
 class DigicertError(AutocertError):
     def __init__(self, call):
         message = 'digicert error without errors field'
-        if 'errors' in call.recv.json:
-            message = call.recv.json['errors'][0]['message']
+        json = call.recv.get('json', None)
+        if isinstance(json, dict) and json.get('errors', None):
+            message = json['errors'][0].get('message', message)
         super(DigicertError, self).__init__(message)
 
+def unzip_certificates(content):
+    '''
+    unpack an archive of certificates in memory; each member is expected to be
+    named after its certificate id, eg. 12345.pem or 12345/12345.crt
+    '''
+    crts = {}
+    with zipfile.ZipFile(io.BytesIO(content)) as zf:
+        for info in zf.infolist():
+            if info.filename.endswith('/'):
+                continue
+            certificate_id = os.path.basename(info.filename).split('.')[0]
+            crts[certificate_id] = windows2unix(zf.read(info).decode('utf-8'))
+    return crts
+
 def domain_to_check(domain):
     return domain if domain.startswith('*.') else get_fld('http://'+domain)
 
@@ -100,9 +129,10 @@ class DigicertAuthority(AuthorityBase):
                 return offset if offset < page.total else None
             call = super(DigicertAuthority, self).request(method, path=path, **kw)
             offset = next_offset(call.recv.json.page)
+            separator = '&' if '?' in path else '?'
             while call.recv.status in (200,) and offset:
                 prev = call
-                query_params = f'?offset={offset}'
+                query_params = f'{separator}offset={offset}'
                 call = super(DigicertAuthority, self).request(method, path=path+query_params, **kw)
                 offset = next_offset(call.recv.json.page)
                 call.prev = prev
@@ -149,6 +179,40 @@ class DigicertAuthority(AuthorityBase):
         authority = dict(digicert=dict(order_id=order_ids[0]))
         return crts[0], expiries[0], authority
 
+    def create_certificates(self, organization_name, specs, validity_years, bug, repeat_delta=None, whois_check=False):
+        '''
+        the organization and its active domains are fetched once for the whole
+        batch; every spec that validates is ordered, approved and downloaded
+        together and failures are reported per spec instead of failing the batch
+        '''
+        app.logger.info(f'create_certificates:\n{locals}')
+        organization_id, container_id = self._get_organization_container_ids(organization_name)
+        active_domains = self._get_domains(organization_id, container_id)
+        results = [{} for spec in specs]
+        indices, paths, jsons = [], [], []
+        for index, spec in enumerate(specs):
+            try:
+                path, json = self._prepare_path_json(
+                    organization_id,
+                    container_id,
+                    spec['common_name'],
+                    validity_years,
+                    spec['csr'],
+                    bug,
+                    sans=spec['sans'],
+                    whois_check=whois_check,
+                    active_domains=active_domains)
+                indices += [index]
+                paths += [path]
+                jsons += [json]
+            except AutocertError as ae:
+                results[index]['error'] = ae.message
+        if paths:
+            ordered = self._create_certificates_batch(paths, jsons, bug, repeat_delta)
+            for index, result in zip(indices, ordered):
+                results[index] = result
+        return results
+
     def renew_certificates(self, bundles, organization_name, validity_years, bug, sans=None, repeat_delta=None, whois_check=False):
         app.logger.info(f'renew_certificates:\n{locals}')
         if not sans:
@@ -166,11 +230,76 @@ class DigicertAuthority(AuthorityBase):
         authorities = [dict(digicert=dict(order_id=order_id)) for order_id in order_ids]
         return crts, expiries, authorities
 
-    def revoke_certificates(self, bundles, bug):
-        app.logger.info(f'revoke_certificates:\n{locals}')
-        paths, jsons = self._prepare_paths_jsons_for_revocations(bundles, bug)
-        self._revoke_certificates(paths, jsons, bug)
-        return bundles
+    def renew_certificates_results(self, bundles, organization_name, validity_years, bug, sans=None, repeat_delta=None, whois_check=False):
+        '''
+        every renewal is its own order; one that fails at any stage only fails
+        its own bundle, with the order_id when it was placed
+        '''
+        app.logger.info(f'renew_certificates_results:\n{locals}')
+        organization_id, container_id = self._get_organization_container_ids(organization_name)
+        active_domains = self._get_domains(organization_id, container_id)
+        results = [{} for bundle in bundles]
+        indices, paths, jsons = [], [], []
+        for index, bundle in enumerate(bundles):
+            try:
+                bundle.sans = combine_sans(bundle.sans, sans or [])
+                path, json = self._prepare_path_json(
+                    organization_id,
+                    container_id,
+                    bundle.common_name,
+                    validity_years,
+                    bundle.csr,
+                    bug,
+                    sans=bundle.sans,
+                    whois_check=whois_check,
+                    renewal_of_order_id=bundle.authority['digicert']['order_id'],
+                    active_domains=active_domains)
+                indices += [index]
+                paths += [path]
+                jsons += [json]
+            except AutocertError as ae:
+                results[index]['error'] = ae.message
+        if paths:
+            ordered = self._create_certificates_batch(paths, jsons, bug, repeat_delta)
+            for index, result in zip(indices, ordered):
+                results[index] = result
+        return results
+
+    def _revoke_window(self, bundles, bug):
+        '''
+        detail -> revoke -> approve for one window; a bundle failing a stage
+        drops out of the later ones
+        '''
+        app.logger.debug(f'_revoke_window:\n{locals}')
+        errors = {}
+        order_ids = [bundle.authority['digicert']['order_id'] for bundle in bundles]
+        pending = []
+        for bundle, call in zip(bundles, self._get_certificate_order_detail(order_ids)):
+            if call.recv.status == 200:
+                pending += [(bundle, call.recv.json.certificate.id)]
+            else:
+                errors[bundle.bundle_name] = DigicertError(call).message
+        if not pending:
+            return [], errors
+        paths = [f'certificate/{certificate_id}/revoke' for _, certificate_id in pending]
+        calls = self.puts(paths=paths, jsons=[dict(comments=str(bug))], pairing=BROADCAST)
+        requested = []
+        for (bundle, _), call in zip(pending, calls):
+            if call.recv.status == 201:
+                requested += [(bundle, call.recv.json.id)]
+            else:
+                errors[bundle.bundle_name] = RevokeCertificateError(call).message
+        if not requested:
+            return [], errors
+        paths = [f'request/{request_id}/status' for _, request_id in requested]
+        calls = self.puts(paths=paths, jsons=[dict(status='approved', processor_comment=bug)], pairing=BROADCAST)
+        revoked = []
+        for (bundle, _), call in zip(requested, calls):
+            if call.recv.status == 204 or error_code(call) == 'request_already_processed':
+                revoked += [bundle]
+            else:
+                errors[bundle.bundle_name] = ApproveCertificateError(call).message
+        return revoked, errors
 
     def _get_organization_container_ids(self, organization_name):
         app.logger.debug(f'_get_organization_container_ids:\n{locals}')
@@ -190,9 +319,10 @@ class DigicertAuthority(AuthorityBase):
             raise DigicertError(call)
         return [domain for domain in call.recv.json.domains if domain.is_active and domain.organization.id == organization_id]
 
-    def _validate_domains(self, organization_id, container_id, domains, whois_check=False):
+    def _validate_domains(self, organization_id, container_id, domains, whois_check=False, active_domains=None):
         app.logger.debug(f'_validate_domains:\n{locals}')
-        active_domains = self._get_domains(organization_id, container_id)
+        if active_domains is None:
+            active_domains = self._get_domains(organization_id, container_id)
         active_domains = [ad.name for ad in active_domains]
         def _is_validated(domain):
             app.logger.debug(f'_is_validated:\n{locals}')
@@ -224,10 +354,10 @@ class DigicertAuthority(AuthorityBase):
             raise NotValidatedDomainError(denied_domains, active_domains)
         return True
 
-    def _prepare_path_json(self, organization_id, container_id, common_name, validity_years, csr, bug, sans=None, whois_check=False, renewal_of_order_id=None):
+    def _prepare_path_json(self, organization_id, container_id, common_name, validity_years, csr, bug, sans=None, whois_check=False, renewal_of_order_id=None, active_domains=None):
         app.logger.debug(f'_prepare_path_json:\n{locals}')
         domains = list(set([common_name] + (sans if sans else [])))
-        self._validate_domains(organization_id, container_id, domains, whois_check)
+        self._validate_domains(organization_id, container_id, domains, whois_check, active_domains=active_domains)
         path = 'order/certificate/ssl_plus'
         json = merge(self.cfg.template, dict(
             validity_years=validity_years,
@@ -271,15 +401,6 @@ class DigicertAuthority(AuthorityBase):
             jsons += [json]
         return paths, jsons
 
-    def _prepare_paths_jsons_for_revocations(self, bundles, bug):
-        app.logger.debug(f'_prepare_paths_jsons_for_revocations:\n{locals}')
-        order_ids = [bundles.authority['digicert']['order_id'] for bundles in bundles]
-        calls = self._get_certificate_order_detail(order_ids)
-        certificate_ids = [call.recv.json.certificate.id for call in calls]
-        paths = [f'certificate/{certificate_id}/revoke' for certificate_id in certificate_ids]
-        jsons = [dict(comments=str(bug))]
-        return paths, jsons
-
     def _create_certificates(self, paths, jsons, bug, repeat_delta):
         app.logger.debug(f'_create_certificates:\n{locals}')
         order_ids, request_ids = self._order_certificates(paths, jsons)
@@ -296,18 +417,73 @@ class DigicertAuthority(AuthorityBase):
             expiries = []
         return crts, expiries, order_ids
 
-    def _revoke_certificates(self, paths, jsons, bug):
-        app.logger.debug(f'_revoke_certificates:\n{locals}')
-        calls = self.puts(paths=paths, jsons=jsons)
-        for call in calls:
-            if call.recv.status != 201:
-                raise RevokeCertificateError(call)
-        request_ids = [call.recv.json.id for call in calls]
-        self._update_requests_status(request_ids, 'approved', bug)
+    def _create_certificates_batch(self, paths, jsons, bug, repeat_delta):
+        '''
+        like _create_certificates but an order that fails at any stage only fails
+        its own result; a failure after the order was placed carries its
+        order_id so it can be followed up without ordering again
+        '''
+        app.logger.debug(f'_create_certificates_batch:\n{locals}')
+        results = [{} for path in paths]
+        def fail(index, error, order_id=None):
+            app.logger.error(error)
+            results[index] = dict(error=error.message)
+            if order_id:
+                results[index]['order_id'] = order_id
+        pending = []
+        calls = self.posts(paths=paths, jsons=jsons, pairing=ZIP)
+        for index, call in enumerate(calls):
+            if call.recv.status == 201:
+                pending += [(index, call.recv.json.id, call.recv.json.requests[0].id)]
+            else:
+                fail(index, OrderCertificateError(call))
+        if not pending:
+            return results
+        request_paths = [f'request/{request_id}/status' for _, _, request_id in pending]
+        calls = self.puts(paths=request_paths, jsons=[dict(status='approved', processor_comment=bug)], pairing=BROADCAST)
+        approved = []
+        for item, call in zip(pending, calls):
+            if call.recv.status == 204 or error_code(call) == 'request_already_processed':
+                approved += [item]
+            else:
+                fail(item[0], ApproveCertificateError(call), item[1])
+        if not approved:
+            return results
+        calls = self._get_certificate_order_detail([order_id for _, order_id, _ in approved])
+        issued = []
+        for (index, order_id, _), call in zip(approved, calls):
+            if call.recv.status == 200 and call.recv.json.get('certificate', {}).get('id', None):
+                issued += [(index, order_id, call.recv.json.certificate.id)]
+            else:
+                fail(index, DigicertError(call), order_id)
+        if not issued:
+            return results
+        crts = self._download_certificates_results([certificate_id for _, _, certificate_id in issued], repeat_delta=repeat_delta)
+        downloaded = []
+        for (index, order_id, certificate_id), crt in zip(issued, crts):
+            if isinstance(crt, AutocertError):
+                fail(index, crt, order_id)
+            else:
+                downloaded += [(index, order_id, crt)]
+        if not downloaded:
+            return results
+        calls = self._get_certificate_order_detail([order_id for _, order_id, _ in downloaded])
+        for (index, order_id, crt), call in zip(downloaded, calls):
+            if call.recv.status != 200:
+                fail(index, DigicertError(call), order_id)
+                continue
+            try:
+                results[index] = dict(
+                    crt=crt,
+                    expiry=expiryify(call),
+                    authority=dict(digicert=dict(order_id=order_id)))
+            except AutocertError as ae:
+                fail(index, ae, order_id)
+        return results
 
     def _order_certificates(self, paths, jsons):
         app.logger.debug(f'_order_certificates:\n{locals}')
-        calls = self.posts(paths=paths, jsons=jsons)
+        calls = self.posts(paths=paths, jsons=jsons, pairing=ZIP)
         for call in calls:
             if call.recv.status != 201:
                 raise OrderCertificateError(call)
@@ -318,16 +494,19 @@ class DigicertAuthority(AuthorityBase):
         paths = [f'request/{request_id}/status' for request_id in request_ids]
         jsons = [dict(status=status, processor_comment=bug)]
         app.logger.debug(f'calling digicert api with paths={paths} and jsons={jsons}')
-        calls = self.puts(paths=paths, jsons=jsons)
+        calls = self.puts(paths=paths, jsons=jsons, pairing=BROADCAST)
         for call in calls:
             if call.recv.status != 204:
-                if call.recv.json.errors[0].code != 'request_already_processed':
+                if error_code(call) != 'request_already_processed':
                     raise ApproveCertificateError(call)
         return True
 
-    def _get_certificate_order_summary(self):
+    def _get_certificate_order_summary(self, filters=None):
         app.logger.debug(f'_get_certificate_order_summary:\n{locals}')
-        call = self.get(path='order/certificate')
+        path = 'order/certificate'
+        if filters:
+            path += '?' + urlencode({f'filters[{name}]': value for name, value in sorted(filters.items())})
+        call = self.get(path=path)
         return call
 
     def _get_certificate_order_detail(self, order_ids):
@@ -336,16 +515,77 @@ class DigicertAuthority(AuthorityBase):
         calls = self.gets(paths=paths)
         return calls
 
+    def _get_certificate_order_detail_cached(self, orders):
+        '''
+        order details keyed by order_id; a cached detail is reused while the
+        order's status in the summary still matches the status it was cached with
+        '''
+        app.logger.debug(f'_get_certificate_order_detail_cached:\n{locals}')
+        cache = Cache('digicert-order-detail')
+        entries = cache.load()
+        def is_fresh(order):
+            entry = entries.get(str(order['id']), None)
+            return entry is not None and entry['status'] == order['status']
+        stale = [order for order in orders if not is_fresh(order)]
+        if stale:
+            calls = self._get_certificate_order_detail([order['id'] for order in stale])
+            fetched = {}
+            for order, call in zip(stale, calls):
+                if call.recv.status != 200:
+                    raise DigicertError(call)
+                fetched[str(order['id'])] = dict(status=order['status'], detail=call.recv.json)
+            with cache.update() as cached:
+                cached.update(fetched)
+            entries.update(fetched)
+        app.logger.info(f'order details: {len(orders) - len(stale)} cached, {len(stale)} fetched')
+        return [AttrDict(entries[str(order['id'])]['detail']) for order in orders]
+
     def _download_certificates(self, certificate_ids, format_type='pem_noroot', repeat_delta=None):
         app.logger.debug(f'_download_certificates:\n{locals}')
+        crts = self._download_certificates_results(certificate_ids, format_type, repeat_delta)
+        for crt in crts:
+            if isinstance(crt, DownloadCertificateError):
+                raise crt
+        return crts
+
+    def _download_certificates_results(self, certificate_ids, format_type='pem_noroot', repeat_delta=None):
+        '''
+        a crt per certificate id, or the DownloadCertificateError of one that
+        couldn't be downloaded; the archive is tried first when configured and
+        whatever it lacks is downloaded per certificate
+        '''
+        app.logger.debug(f'_download_certificates_results:\n{locals}')
         if repeat_delta is not None and isinstance(repeat_delta, int):
             repeat_delta = timedelta(seconds=repeat_delta)
+        crts = {}
+        if self.cfg.get('archive', None) and len(certificate_ids) > 1:
+            crts = self._download_certificates_archive(certificate_ids, format_type)
+        missing = [certificate_id for certificate_id in certificate_ids if str(certificate_id) not in crts]
+        if missing:
+            crts.update({
+                str(certificate_id): crt
+                for certificate_id, crt in zip(missing, self._download_certificates_each(missing, format_type, repeat_delta))})
+        return [crts[str(certificate_id)] for certificate_id in certificate_ids]
+
+    def _download_certificates_archive(self, certificate_ids, format_type):
+        app.logger.debug(f'_download_certificates_archive:\n{locals}')
+        path = self.cfg.archive.format(
+            format_type=format_type,
+            certificate_ids=','.join([str(certificate_id) for certificate_id in certificate_ids]))
+        call = self.gets(paths=[path])[0]
+        content = call.recv.get('content', None)
+        if call.recv.status != 200 or not content:
+            app.logger.warning(f'archive download failed; falling back to per certificate downloads; status={call.recv.status}')
+            return {}
+        try:
+            crts = unzip_certificates(content)
+        except zipfile.BadZipFile as bzf:
+            app.logger.warning(f'archive download was not a zipfile; falling back to per certificate downloads; {bzf}')
+            return {}
+        return {certificate_id: crt for certificate_id, crt in crts.items() if crt.strip()}
+
+    def _download_certificates_each(self, certificate_ids, format_type, repeat_delta):
+        app.logger.debug(f'_download_certificates_each:\n{locals}')
         paths = [f'certificate/{certificate_id}/download/format/{format_type}' for certificate_id in certificate_ids]
         calls = self.gets(paths=paths, repeat_delta=repeat_delta, repeat_if=not_200)
-        texts = []
-        for call in calls:
-            if call.recv.status == 200:
-                texts += [call.recv.text]
-            else:
-                raise DownloadCertificateError(call)
-        return texts
+        return [call.recv.text if call.recv.status == 200 else DownloadCertificateError(call) for call in calls]
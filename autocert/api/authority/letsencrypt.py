@@ -1,31 +1,428 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+'''
+authority.letsencrypt: acme v2 (rfc 8555) authority
 
-import io
-import zipfile
+every phase (new-order, authorizations, challenges, finalize, download) is sent
+for all pending orders at once through the AsyncRequests runner, so issuing n
+certificates costs the same number of round-trips as issuing one
+'''
+
+import os
+import json
+import time
+import hashlib
+import threading
+from base64 import urlsafe_b64encode
 from attrdict import AttrDict
-from pprint import pprint, pformat
-from fnmatch import fnmatch
 
-from authority.base import AuthorityBase
-from utils.dictionary import merge
+from cryptography import x509
+from cryptography.x509.oid import NameOID, ExtensionOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
 
+from authority.base import AuthorityBase
+from exceptions import AutocertError
 from app import app
 
-from config import CFG
+BAD_NONCE = 'urn:ietf:params:acme:error:badNonce'
+HTTP_01 = 'http-01'
+JOSE_JSON = 'application/jose+json'
+
+def b64(data):
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return urlsafe_b64encode(data).decode('utf-8').rstrip('=')
+
+def int2b64(i):
+    return b64(i.to_bytes((i.bit_length() + 7) // 8, 'big'))
+
+def header(call, name):
+    headers = call.recv.get('headers', None) or {}
+    for key, value in headers.items():
+        if key.lower() == name.lower():
+            return value
+    return None
+
+def problem_type(call):
+    recv_json = call.recv.get('json', None) or {}
+    return recv_json.get('type', None)
+
+def pem2der(pem):
+    crt = x509.load_pem_x509_certificate(pem.encode('utf-8'), default_backend())
+    return crt.public_bytes(serialization.Encoding.DER)
+
+def csr2der(csr):
+    req = x509.load_pem_x509_csr(csr.encode('utf-8'), default_backend())
+    return req.public_bytes(serialization.Encoding.DER)
+
+def csr_domains(csr):
+    req = x509.load_pem_x509_csr(csr.encode('utf-8'), default_backend())
+    domains = [attr.value for attr in req.subject.get_attributes_for_oid(NameOID.COMMON_NAME)]
+    try:
+        ext = req.extensions.get_extension_for_oid(ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
+        domains += ext.value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        pass
+    return sorted(set(domains), key=domains.index)
 
-def not_200(call):
-    return call.recv.status != 200
+def expiry(pem):
+    crt = x509.load_pem_x509_certificate(pem.encode('utf-8'), default_backend())
+    return crt.not_valid_after
+
+class AcmeError(AutocertError):
+    def __init__(self, call):
+        recv_json = call.recv.get('json', None) or {}
+        detail = recv_json.get('detail', 'acme error without detail field')
+        message = f'acme error status={call.recv.status} type={problem_type(call)} detail={detail}'
+        super(AcmeError, self).__init__(message)
+
+class AcmeNonceError(AutocertError):
+    def __init__(self, url):
+        message = f'acme server at {url} did not return a Replay-Nonce'
+        super(AcmeNonceError, self).__init__(message)
+
+class AcmeChallengeError(AutocertError):
+    def __init__(self, authz):
+        message = f'acme authorization failed for {authz}'
+        super(AcmeChallengeError, self).__init__(message)
+
+class AcmeTimeoutError(AutocertError):
+    def __init__(self, urls):
+        message = f'acme objects did not become ready in time: {urls}'
+        super(AcmeTimeoutError, self).__init__(message)
+
+class AcmeSansError(AutocertError):
+    def __init__(self, bundle_name, sans):
+        message = f'cannot add sans {sans} to {bundle_name}; acme orders must match the domains in the existing csr'
+        super(AcmeSansError, self).__init__(message)
+
+class AcmeAccount(object):
+    '''
+    account key and key id shared by every order against one directory
+    '''
+    def __init__(self, key):
+        self.key = key
+        self.kid = None
+        numbers = key.public_key().public_numbers()
+        self.jwk = dict(e=int2b64(numbers.e), kty='RSA', n=int2b64(numbers.n))
+
+    @property
+    def thumbprint(self):
+        jwk = json.dumps(self.jwk, sort_keys=True, separators=(',', ':'))
+        return b64(hashlib.sha256(jwk.encode('utf-8')).digest())
+
+    def sign(self, url, nonce, payload):
+        protected = dict(alg='RS256', nonce=nonce, url=url)
+        if self.kid:
+            protected['kid'] = self.kid
+        else:
+            protected['jwk'] = self.jwk
+        protected = b64(json.dumps(protected))
+        # an empty payload is the post-as-get form
+        payload = '' if payload is None else b64(json.dumps(payload))
+        signature = self.key.sign(f'{protected}.{payload}'.encode('utf-8'), padding.PKCS1v15(), hashes.SHA256())
+        return json.dumps(dict(protected=protected, payload=payload, signature=b64(signature)))
+
+def load_account_key(account_key_path, key_size=2048):
+    if os.path.isfile(account_key_path):
+        with open(account_key_path, 'rb') as f:
+            return serialization.load_pem_private_key(f.read(), password=None, backend=default_backend())
+    key = rsa.generate_private_key(public_exponent=65537, key_size=key_size, backend=default_backend())
+    os.makedirs(os.path.dirname(account_key_path), exist_ok=True)
+    with open(os.open(account_key_path, os.O_WRONLY | os.O_CREAT, 0o600), 'wb') as f:
+        f.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption()))
+    return key
 
 class LetsEncryptAuthority(AuthorityBase):
+    # directories, accounts and unused nonces live for the life of the worker
+    # so that every request after the first skips straight to new-order; they
+    # are shared by the pipeline's and the authority policy's threads, so only
+    # touched under _lock
+    _directories = {}
+    _accounts = {}
+    _nonces = {}
+    _lock = threading.Lock()
+
     def __init__(self, ar, cfg, verbosity):
         super(LetsEncryptAuthority, self).__init__(ar, cfg, verbosity)
 
-    def display(self, bundle_name):
-        raise NotImplementedError
+    @property
+    def directory_url(self):
+        return str(self.cfg.baseurl)
+
+    @property
+    def nonces(self):
+        return LetsEncryptAuthority._nonces.setdefault(self.directory_url, [])
+
+    def acme_keywords(self, url, **kw):
+        kw['url'] = url
+        kw['headers'] = kw.get('headers', {
+            'Content-Type': JOSE_JSON,
+            'User-Agent': 'autocert',
+        })
+        kw['verify_ssl'] = self.cfg.get('verify_ssl', True)
+        return kw
+
+    def collect_nonces(self, calls):
+        nonces = [header(call, 'Replay-Nonce') for call in calls]
+        with LetsEncryptAuthority._lock:
+            self.nonces.extend(nonce for nonce in nonces if nonce)
+        return calls
+
+    def take_nonces(self, count):
+        '''
+        count unused nonces, each handed to exactly one caller; the missing ones
+        are fetched with HEAD new-nonce
+        '''
+        with LetsEncryptAuthority._lock:
+            nonces = self.nonces
+            taken, nonces[:] = nonces[:count], nonces[count:]
+        missing = count - len(taken)
+        if missing > 0:
+            url = self.directory.newNonce
+            calls = self.windowed('HEAD', [self.acme_keywords(url) for _ in range(missing)])
+            fresh = [nonce for nonce in (header(call, 'Replay-Nonce') for call in calls) if nonce]
+            taken += fresh[:missing]
+            with LetsEncryptAuthority._lock:
+                self.nonces.extend(fresh[missing:])
+                if len(taken) < count:
+                    self.nonces.extend(taken)
+                    raise AcmeNonceError(url)
+        return taken
+
+    @property
+    def directory(self):
+        with LetsEncryptAuthority._lock:
+            directory = LetsEncryptAuthority._directories.get(self.directory_url, None)
+        if directory is None:
+            call = self.ar.request('GET', **self.acme_keywords(self.directory_url, headers={'User-Agent': 'autocert'}))
+            if call.recv.status != 200:
+                raise AcmeError(call)
+            with LetsEncryptAuthority._lock:
+                directory = LetsEncryptAuthority._directories.setdefault(self.directory_url, AttrDict(call.recv.json))
+        return directory
+
+    @property
+    def account(self):
+        with LetsEncryptAuthority._lock:
+            account = LetsEncryptAuthority._accounts.get(self.directory_url, None)
+        if account is None:
+            account = AcmeAccount(load_account_key(str(self.cfg.account_key_path)))
+            payload = dict(termsOfServiceAgreed=True)
+            if self.cfg.get('contact', None):
+                payload['contact'] = [self.cfg.contact]
+            call = self.signed_posts(account, [self.directory.newAccount], [payload])[0]
+            if call.recv.status not in (200, 201):
+                raise AcmeError(call)
+            account.kid = header(call, 'Location')
+            with LetsEncryptAuthority._lock:
+                account = LetsEncryptAuthority._accounts.setdefault(self.directory_url, account)
+        return account
+
+    def signed_posts(self, account, urls, payloads, retries=2):
+        '''
+        sign and post one payload per url; payload None is post-as-get; calls
+        rejected with badNonce are re-signed with fresh nonces and re-sent
+        '''
+        calls = [None] * len(urls)
+        pending = list(range(len(urls)))
+        for attempt in range(retries + 1):
+            nonces = self.take_nonces(len(pending))
+            kws = [
+                self.acme_keywords(urls[index], data=account.sign(urls[index], nonce, payloads[index]))
+                for index, nonce in zip(pending, nonces)]
+            for index, call in zip(pending, self.collect_nonces(self.windowed('POST', kws))):
+                calls[index] = call
+            pending = [index for index in pending if problem_type(calls[index]) == BAD_NONCE]
+            if not pending:
+                break
+        return calls
+
+    def post_as_gets(self, account, urls):
+        return self.signed_posts(account, urls, [None] * len(urls))
+
+    def poll(self, account, urls, done, failed=lambda obj: obj.status == 'invalid'):
+        '''
+        post-as-get urls until done(obj) for all of them; each round only asks
+        for the objects that are still pending
+        '''
+        interval = self.cfg.get('poll_interval', 2)
+        deadline = time.time() + self.cfg.get('poll_timeout', 300)
+        objs = {}
+        pending = list(dict.fromkeys(urls))
+        while pending:
+            for url, call in zip(pending, self.post_as_gets(account, pending)):
+                if call.recv.status != 200:
+                    raise AcmeError(call)
+                obj = AttrDict(call.recv.json)
+                if failed(obj):
+                    raise AcmeChallengeError(dict(url=url, obj=obj))
+                objs[url] = obj
+            pending = [url for url in pending if not done(objs[url])]
+            if pending:
+                if time.time() > deadline:
+                    raise AcmeTimeoutError(pending)
+                time.sleep(interval)
+        return [objs[url] for url in urls]
+
+    def has_connectivity(self):
+        return bool(self.directory)
+
+    def display_certificates(self, bundles, repeat_delta=None):
+        app.logger.info(f'display_certificates:\n{locals}')
+        issued = [bundle for bundle in bundles if 'letsencrypt' in (bundle.authority or {})]
+        if issued:
+            urls = [bundle.authority['letsencrypt']['certificate_url'] for bundle in issued]
+            calls = self.post_as_gets(self.account, urls)
+            for bundle, call in zip(issued, calls):
+                matched = call.recv.status == 200 and call.recv.text.strip() == bundle.crt.strip()
+                bundle.authority['letsencrypt']['matched'] = matched
+        return bundles
+
+    def create_certificate(self, organization_name, common_name, validity_years, csr, bug, sans=None, repeat_delta=None, whois_check=False):
+        app.logger.info(f'create_certificate:\n{locals}')
+        crts, expiries, authorities = self._create_certificates([csr])
+        return crts[0], expiries[0], authorities[0]
+
+    def create_certificates(self, organization_name, specs, validity_years, bug, repeat_delta=None, whois_check=False):
+        '''
+        all orders are authorized, finalized and polled together; if any of them
+        fails the batch is retried one order at a time so the rest still issue
+        '''
+        app.logger.info(f'create_certificates:\n{locals}')
+        try:
+            crts, expiries, authorities = self._create_certificates([spec['csr'] for spec in specs])
+        except AutocertError as ae:
+            app.logger.warning(f'batch of {len(specs)} orders failed; ordering one at a time; {ae}')
+            return super(LetsEncryptAuthority, self).create_certificates(
+                organization_name,
+                specs,
+                validity_years,
+                bug,
+                repeat_delta=repeat_delta,
+                whois_check=whois_check)
+        return [
+            dict(crt=crt, expiry=expiry, authority=authority)
+            for crt, expiry, authority in zip(crts, expiries, authorities)]
+
+    def renew_certificates(self, bundles, organization_name, validity_years, bug, sans=None, repeat_delta=None, whois_check=False):
+        app.logger.info(f'renew_certificates:\n{locals}')
+        for bundle in bundles:
+            missing = sorted(set(sans or []) - set(csr_domains(bundle.csr)))
+            if missing:
+                raise AcmeSansError(bundle.bundle_name, missing)
+        return self._create_certificates([bundle.csr for bundle in bundles])
+
+    def renew_certificates_results(self, bundles, organization_name, validity_years, bug, sans=None, repeat_delta=None, whois_check=False):
+        '''
+        renewals are new orders for the bundles' csrs, ordered like create_certificates
+        '''
+        app.logger.info(f'renew_certificates_results:\n{locals}')
+        results = [{} for bundle in bundles]
+        indices, specs = [], []
+        for index, bundle in enumerate(bundles):
+            missing = sorted(set(sans or []) - set(csr_domains(bundle.csr)))
+            if missing:
+                results[index]['error'] = AcmeSansError(bundle.bundle_name, missing).message
+            else:
+                indices += [index]
+                specs += [dict(common_name=bundle.common_name, csr=bundle.csr, sans=bundle.sans)]
+        if specs:
+            ordered = self.create_certificates(organization_name, specs, validity_years, bug, repeat_delta=repeat_delta, whois_check=whois_check)
+            for index, result in zip(indices, ordered):
+                results[index] = result
+        return results
+
+    def _revoke_window(self, bundles, bug):
+        app.logger.debug(f'_revoke_window:\n{locals}')
+        account = self.account
+        urls = [self.directory.revokeCert] * len(bundles)
+        payloads = [dict(certificate=b64(pem2der(bundle.crt))) for bundle in bundles]
+        revoked, errors = [], {}
+        for bundle, call in zip(bundles, self.signed_posts(account, urls, payloads)):
+            if call.recv.status == 200:
+                revoked += [bundle]
+            else:
+                errors[bundle.bundle_name] = AcmeError(call).message
+        return revoked, errors
+
+    def _create_certificates(self, csrs):
+        app.logger.debug(f'_create_certificates:\n{locals}')
+        account = self.account
+        order_urls, orders = self._new_orders(account, csrs)
+        tokens = []
+        try:
+            self._authorize(account, orders, tokens)
+            self.poll(account, order_urls, lambda order: order.status in ('ready', 'valid'))
+            finalize_urls = [order.finalize for order in orders]
+            payloads = [dict(csr=b64(csr2der(csr))) for csr in csrs]
+            for call in self.signed_posts(account, finalize_urls, payloads):
+                if call.recv.status != 200:
+                    raise AcmeError(call)
+            orders = self.poll(account, order_urls, lambda order: order.status == 'valid')
+        finally:
+            self._remove_challenge_responses(tokens)
+        certificate_urls = [order.certificate for order in orders]
+        crts = []
+        for call in self.post_as_gets(account, certificate_urls):
+            if call.recv.status != 200:
+                raise AcmeError(call)
+            crts += [call.recv.text]
+        expiries = [expiry(crt) for crt in crts]
+        authorities = [
+            dict(letsencrypt=dict(order_url=order_url, certificate_url=certificate_url))
+            for order_url, certificate_url in zip(order_urls, certificate_urls)]
+        return crts, expiries, authorities
+
+    def _new_orders(self, account, csrs):
+        app.logger.debug(f'_new_orders:\n{locals}')
+        payloads = [
+            dict(identifiers=[dict(type='dns', value=domain) for domain in csr_domains(csr)])
+            for csr in csrs]
+        calls = self.signed_posts(account, [self.directory.newOrder] * len(csrs), payloads)
+        for call in calls:
+            if call.recv.status != 201:
+                raise AcmeError(call)
+        return [header(call, 'Location') for call in calls], [AttrDict(call.recv.json) for call in calls]
+
+    def _authorize(self, account, orders, tokens):
+        '''
+        answer the http-01 challenge of every pending authorization across all
+        orders, then wait for all of them to become valid; every token written
+        is added to tokens as it is written, for the caller to clean up
+        '''
+        app.logger.debug(f'_authorize:\n{locals}')
+        authz_urls = list(dict.fromkeys([url for order in orders for url in order.authorizations]))
+        authzs = dict(zip(authz_urls, self.poll(account, authz_urls, lambda authz: True)))
+        pending = {url: authz for url, authz in authzs.items() if authz.status == 'pending'}
+        challenge_urls = []
+        for url, authz in pending.items():
+            challenge = [c for c in authz.challenges if c.type == HTTP_01]
+            if not challenge:
+                raise AcmeChallengeError(dict(url=url, obj=authz))
+            tokens.append(self._write_challenge_response(account, challenge[0].token))
+            challenge_urls += [challenge[0].url]
+        if challenge_urls:
+            for call in self.signed_posts(account, challenge_urls, [{}] * len(challenge_urls)):
+                if call.recv.status != 200:
+                    raise AcmeError(call)
+            self.poll(account, list(pending.keys()), lambda authz: authz.status == 'valid')
 
-    def renew_certificate(self, bundle_name):
-        raise NotImplementedError
+    def _write_challenge_response(self, account, token):
+        challenge_path = str(self.cfg.challenge_path)
+        os.makedirs(challenge_path, exist_ok=True)
+        with open(os.path.join(challenge_path, token), 'w') as f:
+            f.write(f'{token}.{account.thumbprint}')
+        return token
 
-    def revoke_certificate(self, bundle_name):
-        raise NotImplementedError
+    def _remove_challenge_responses(self, tokens):
+        for token in tokens:
+            try:
+                os.remove(os.path.join(str(self.cfg.challenge_path), token))
+            except FileNotFoundError:
+                pass
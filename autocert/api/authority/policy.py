@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+authority.policy: issue through whichever configured authority is healthy
+
+failover tries the authorities one after the other, optionally starting the next
+one as well when the current one hasn't answered within hedge_after seconds;
+race orders from all of them at once and keeps the first certificate issued
+
+racing and hedging can leave the slower authority with an issued certificate
+nobody uses, so common names matching authority_policy.ev are never raced or
+hedged and only ever fail over; the losers are left to finish on their own and
+any certificate they issue is logged and kept in abandoned, to be revoked
+'''
+
+import time
+import asyncio
+import threading
+
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fnmatch import fnmatch
+
+from authority.factory import create_authority
+from utils.asyncrequests import AsyncRequests
+from exceptions import AutocertError
+from app import app
+
+POLICY = 'policy'
+
+FAILOVER = 'failover'
+RACE = 'race'
+MODES = (FAILOVER, RACE)
+
+class UnknownPolicyModeError(AutocertError):
+    def __init__(self, mode):
+        message = f'unknown authority policy mode {mode}; choices={MODES}'
+        super(UnknownPolicyModeError, self).__init__(message)
+
+class AllAuthoritiesFailedError(AutocertError):
+    def __init__(self, errors):
+        message = f'every authority failed: {errors}'
+        super(AllAuthoritiesFailedError, self).__init__(message)
+
+class AuthorityAttemptError(AutocertError):
+    def __init__(self, name, ex):
+        message = f'authority {name} failed: {ex!r}'
+        super(AuthorityAttemptError, self).__init__(message)
+        self.errors = [ex]
+
+class AuthorityMetrics(object):
+    '''
+    latency and outcome of the last window requests made to one authority, per
+    api worker
+    '''
+
+    _metrics = {}
+    _lock = threading.Lock()
+
+    def __init__(self, name, window):
+        self.name = name
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.counts = dict(requests=0, errors=0)
+
+    @classmethod
+    def get(cls, name, window=20):
+        with cls._lock:
+            metrics = cls._metrics.get(name, None)
+            if metrics is None:
+                metrics = cls._metrics[name] = AuthorityMetrics(name, window)
+            return metrics
+
+    @classmethod
+    def record(cls, name, seconds, ok):
+        metrics = cls.get(name)
+        with cls._lock:
+            metrics.counts['requests'] += 1
+            metrics.outcomes.append(ok)
+            if ok:
+                metrics.latencies.append(seconds)
+            else:
+                metrics.counts['errors'] += 1
+
+    @classmethod
+    @contextmanager
+    def timed(cls, name):
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            cls.record(name, time.time() - start, False)
+            raise
+        cls.record(name, time.time() - start, True)
+
+    @property
+    def error_rate(self):
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    @property
+    def metrics(self):
+        with AuthorityMetrics._lock:
+            return dict(
+                name=self.name,
+                error_rate=self.error_rate,
+                p50=self.percentile(50),
+                p95=self.percentile(95),
+                **self.counts)
+
+    @classmethod
+    def all_metrics(cls):
+        return [metrics.metrics for metrics in list(cls._metrics.values())]
+
+class AuthorityPolicy(object):
+    '''
+    stands in for an authority on create; each attempt runs on its own thread,
+    event loop, AsyncRequests and authority
+    '''
+
+    def __init__(self, cfg, authorities_cfg, verbosity):
+        self.mode = cfg.get('mode', FAILOVER)
+        if self.mode not in MODES:
+            raise UnknownPolicyModeError(self.mode)
+        self.order = list(cfg.get('order', None) or authorities_cfg.keys())
+        self.hedge_after = cfg.get('hedge_after', None)
+        self.max_error_rate = cfg.get('max_error_rate', 0.5)
+        self.window = cfg.get('window', 20)
+        self.ev = list(cfg.get('ev', None) or [])
+        self.authorities_cfg = authorities_cfg
+        self.verbosity = verbosity
+        self.calls = []
+        self.abandoned = []
+        self.lock = threading.Lock()
+
+    def is_ev(self, common_name):
+        return any(fnmatch(common_name, pattern) for pattern in self.ev)
+
+    def rank(self):
+        '''
+        configured order, with authorities over max_error_rate moved to the back
+        '''
+        def unhealthy(name):
+            return AuthorityMetrics.get(name, self.window).error_rate > self.max_error_rate
+        return sorted(self.order, key=lambda name: (unhealthy(name), self.order.index(name)))
+
+    def attempt(self, name, func):
+        '''
+        anything an authority raises, e.g. an AttributeError from a request that
+        never got a response, fails just this attempt as an AutocertError
+        '''
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        ar = AsyncRequests()
+        try:
+            authority = create_authority(name, ar, self.authorities_cfg[name], self.verbosity)
+            with AuthorityMetrics.timed(name):
+                return func(authority)
+        except AutocertError:
+            raise
+        except Exception as ex:
+            raise AuthorityAttemptError(name, ex)
+        finally:
+            with self.lock:
+                self.calls += list(ar.calls)
+            loop.close()
+
+    def abandon(self, common_name, name, future):
+        '''
+        done callback of an attempt that lost; what it issued is nobody's
+        '''
+        try:
+            crt, expiry, authority = future.result()
+        except AutocertError as ae:
+            app.logger.info(f'authority policy: abandoned {name} for {common_name} failed: {ae}')
+            return
+        app.logger.warning(f'authority policy: abandoned {name} issued an unused certificate for {common_name}; revoke {authority}')
+        with self.lock:
+            self.abandoned += [dict(common_name=common_name, authority=authority)]
+
+    def issue(self, common_name, func):
+        '''
+        func(authority) against the ranked authorities until one succeeds
+        '''
+        ev = self.is_ev(common_name)
+        candidates = self.rank()
+        hedge_after = None if ev else self.hedge_after
+        errors = {}
+        executor = ThreadPoolExecutor(max_workers=len(candidates))
+        running = {}
+        def start(count):
+            for name in candidates[:count]:
+                app.logger.info(f'authority policy ordering {common_name} from {name}')
+                running[executor.submit(self.attempt, name, func)] = name
+            del candidates[:count]
+        try:
+            start(len(candidates) if self.mode == RACE and not ev else 1)
+            while running:
+                done, _ = wait(running, timeout=hedge_after if candidates else None, return_when=FIRST_COMPLETED)
+                if not done:
+                    app.logger.warning(f'authority policy: {list(running.values())} slower than {hedge_after}s; hedging')
+                    start(1)
+                    continue
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        result = future.result()
+                        if running:
+                            app.logger.warning(f'authority policy kept {name} for {common_name}; abandoning {list(running.values())}')
+                        for loser, loser_name in running.items():
+                            loser.add_done_callback(lambda loser, loser_name=loser_name: self.abandon(common_name, loser_name, loser))
+                        return result
+                    except AutocertError as ae:
+                        app.logger.error(f'authority policy: {name} failed for {common_name}: {ae}')
+                        errors[name] = ae.message
+                if not running and candidates:
+                    start(1)
+            raise AllAuthoritiesFailedError(errors)
+        finally:
+            executor.shutdown(wait=False)
+
+    def create_certificate(self, organization_name, common_name, validity_years, csr, bug, sans=None, repeat_delta=None, whois_check=False):
+        def func(authority):
+            return authority.create_certificate(
+                organization_name,
+                common_name,
+                validity_years,
+                csr,
+                bug,
+                sans=sans,
+                repeat_delta=repeat_delta,
+                whois_check=whois_check)
+        return self.issue(common_name, func)
+
+    def create_certificates(self, organization_name, specs, validity_years, bug, repeat_delta=None, whois_check=False):
+        '''
+        batches fail over only: the items an authority fails are retried with
+        the next one
+        '''
+        results = [None] * len(specs)
+        remaining = list(range(len(specs)))
+        for name in self.rank():
+            if not remaining:
+                break
+            def func(authority):
+                return authority.create_certificates(
+                    organization_name,
+                    [specs[index] for index in remaining],
+                    validity_years,
+                    bug,
+                    repeat_delta=repeat_delta,
+                    whois_check=whois_check)
+            try:
+                with ThreadPoolExecutor(max_workers=1) as executor:
+                    batch = executor.submit(self.attempt, name, func).result()
+            except AutocertError as ae:
+                batch = [dict(error=ae.message)] * len(remaining)
+            for index, result in zip(remaining, batch):
+                results[index] = result
+            remaining = [index for index in remaining if 'error' in results[index]]
+        return results
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+cache: small json file backed caches shared by the api workers on this host
+'''
+
+import os
+import json
+import fcntl
+import tempfile
+import threading
+
+from contextlib import contextmanager
+
+from exceptions import AutocertError
+from config import CFG
+from app import app
+
+class CacheWriteError(AutocertError):
+    def __init__(self, filename, ex):
+        message = f'error writing cache file {filename}'
+        super(CacheWriteError, self).__init__(message)
+        self.errors = [ex]
+
+class Cache(object):
+    '''
+    a named dict persisted as json under cache.path; a missing or unreadable
+    file is just an empty cache
+
+    changes go through update(), which holds the cache locked against other
+    threads and other workers from load to save
+    '''
+
+    cache_path = str(CFG.get('cache', {}).get('path', '/data/autocert/cache'))
+
+    _lock = threading.Lock()
+
+    def __init__(self, name, cache_path=None):
+        self.filename = f'{cache_path or Cache.cache_path}/{name}.json'
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as ex:
+            app.logger.warning(f'ignoring unreadable cache file {self.filename}: {ex}')
+            return {}
+
+    def save(self, entries):
+        dirname = os.path.dirname(self.filename)
+        tmp = None
+        try:
+            os.makedirs(dirname, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=dirname, prefix=os.path.basename(self.filename)+'.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.filename)
+        except Exception as ex:
+            if tmp and os.path.exists(tmp):
+                os.remove(tmp)
+            raise CacheWriteError(self.filename, ex)
+        return entries
+
+    @contextmanager
+    def update(self):
+        '''
+        yields the loaded entries to change in place and saves them on the way
+        out, all under the lock; nothing is saved if the block raises
+        '''
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with Cache._lock, open(f'{self.filename}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                entries = self.load()
+                yield entries
+                self.save(entries)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -1,21 +1,257 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
+'''
+destination.aws: certificates imported into ACM and attached to ELB listeners
 
-from destination.base import DestinationBase
+every dest is an account and region (a boto3 profile and region); dests are
+worked on at the same time, one thread each, and the imports into them at most
+deploy.window at a time; boto3 clients are cached per (profile, region, service)
+so they and their connection pools are reused across deploys
+
+boto3 is optional and only imported once an aws destination is used
+'''
+
+import re
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
+
+from destination.base import DestinationBase, DestinationConnectivityError, UNCHANGED, UPDATED, FAILED, fingerprint
+from exceptions import AutocertError
 from config import CFG
+from app import app
+
+REMOVED = 'removed'
+
+TAG = 'autocert'
+
+PEM = re.compile(r'-----BEGIN CERTIFICATE-----.+?-----END CERTIFICATE-----', re.S)
+
+class AwsNotInstalledError(AutocertError):
+    def __init__(self):
+        message = 'the aws destination needs boto3; pip install boto3'
+        super(AwsNotInstalledError, self).__init__(message)
+
+class AwsDestinationError(AutocertError):
+    def __init__(self, dest, ex):
+        message = f'aws destination error dest={dest}: {ex}'
+        super(AwsDestinationError, self).__init__(message)
+        self.errors = [ex]
+
+def split_pem(crt):
+    '''
+    the leaf crt and the chain of intermediates following it
+    '''
+    pems = PEM.findall(crt)
+    if not pems:
+        return crt, None
+    return pems[0] + '\n', ''.join(pem + '\n' for pem in pems[1:]) or None
 
 class AwsDestination(DestinationBase):
+    name = 'aws'
+
+    _clients = {}
+    _lock = threading.Lock()
+
     def __init__(self, ar, cfg, verbosity=0):
         super(AwsDestination, self).__init__(ar, cfg, verbosity)
 
-    def fetch_certificate(self, bundles, dests):
-        raise NotImplementedError
+    def client(self, dest, service):
+        cfg = self.cfg[dest]
+        key = (cfg.get('profile', None), cfg.get('region', None), service)
+        with AwsDestination._lock:
+            client = AwsDestination._clients.get(key, None)
+            if client is None:
+                try:
+                    import boto3
+                except ImportError:
+                    raise AwsNotInstalledError()
+                session = boto3.session.Session(profile_name=key[0], region_name=key[1])
+                client = AwsDestination._clients[key] = session.client(service)
+            return client
 
-    def install_certificate(self, bundles, dests):
-        raise NotImplementedError
+    def fanout(self, func, items, workers=None):
+        '''
+        func(item) for every item on its own thread; returns item -> result,
+        with an AwsDestinationError as the result of any item that raised
+        '''
+        items = list(items)
+        if not items:
+            return {}
+        def call(item):
+            try:
+                return func(item)
+            except AutocertError as ae:
+                return ae
+            except Exception as ex:
+                dest = item[-1] if isinstance(item, tuple) else item
+                app.logger.error(f'aws: {func.__name__} failed for {item}: {ex}')
+                return AwsDestinationError(dest, ex)
+        with ThreadPoolExecutor(max_workers=min(workers or len(items), len(items))) as executor:
+            return dict(zip(items, executor.map(call, items)))
 
-    def update_certificate(self, bundles, dests):
-        raise NotImplementedError
+    def has_connectivity(self, timeout, dests):
+        def check(dest):
+            self.client(dest, 'acm').list_certificates(MaxItems=1)
+        results = self.fanout(check, dests)
+        dest_ex_pairs = [(dest, result) for dest, result in results.items() if isinstance(result, AutocertError)]
+        if dest_ex_pairs:
+            raise DestinationConnectivityError(dest_ex_pairs)
+        return True
+
+    def inventory(self, names, dest):
+        '''
+        friendly_common_name -> [dict(arn, sha2)] for the certificates autocert
+        imported into dest; only certificates for one of the common names in
+        names are looked at any closer than the listing
+        '''
+        acm = self.client(dest, 'acm')
+        inventory = {}
+        for page in acm.get_paginator('list_certificates').paginate():
+            for summary in page['CertificateSummaryList']:
+                name = names.get(summary.get('DomainName', None), None)
+                if name is None:
+                    continue
+                arn = summary['CertificateArn']
+                tags = {tag['Key']: tag.get('Value', '') for tag in acm.list_tags_for_certificate(CertificateArn=arn).get('Tags', [])}
+                if tags.get(TAG, None) == name:
+                    crt = acm.get_certificate(CertificateArn=arn)['Certificate']
+                    inventory.setdefault(name, []).append(dict(arn=arn, sha2=fingerprint(crt)))
+        return inventory
+
+    def inventories(self, bundles, dests):
+        names = {bundle.common_name: bundle.friendly_common_name for bundle in bundles}
+        results = self.fanout(lambda dest: self.inventory(names, dest), dests)
+        for dest, result in results.items():
+            if isinstance(result, AutocertError):
+                raise result
+        return results
+
+    def listeners(self, dest, common_name):
+        return [
+            listener_arn
+            for pattern, listener_arns in self.cfg[dest].get('listeners', {}).items()
+            if fnmatch(common_name, pattern)
+            for listener_arn in listener_arns]
+
+    def attach(self, dest, common_name, arn):
+        elbv2 = self.client(dest, 'elbv2')
+        for listener_arn in self.listeners(dest, common_name):
+            elbv2.add_listener_certificates(ListenerArn=listener_arn, Certificates=[dict(CertificateArn=arn)])
+
+    def detach(self, dest, common_name, arn):
+        elbv2 = self.client(dest, 'elbv2')
+        for listener_arn in self.listeners(dest, common_name):
+            elbv2.remove_listener_certificates(ListenerArn=listener_arn, Certificates=[dict(CertificateArn=arn)])
+
+    def fetch_certificates(self, bundles, dests):
+        app.logger.info(f'fetch_certificates: bundles={bundles} dests={dests}')
+        self.require_connectivity(dests)
+        inventories = self.inventories(bundles, dests)
+        for bundle in bundles:
+            aws_detail = bundle.destinations.get(self.name, {})
+            for dest in dests:
+                entries = inventories[dest].get(bundle.friendly_common_name, [])
+                matches = [entry for entry in entries if entry['sha2'] == bundle.sha2]
+                if entries:
+                    entry = (matches or entries)[0]
+                    aws_detail[dest] = dict(matched=bool(matches), arn=entry['arn'])
+            if aws_detail:
+                bundle.destinations[self.name] = aws_detail
+        return bundles
+
+    def plan_certificates(self, bundles, dests):
+        '''
+        a change per (bundle, dest) without the bundle's crt imported; arn is
+        the certificate to reimport over, keeping its listeners, or None
+        '''
+        self.require_connectivity(dests)
+        inventories = self.inventories(bundles, dests)
+        plan = []
+        for bundle in bundles:
+            aws_detail = bundle.destinations.get(self.name, {})
+            for dest in dests:
+                entries = inventories[dest].get(bundle.friendly_common_name, [])
+                matches = [entry for entry in entries if entry['sha2'] == bundle.sha2]
+                if matches:
+                    aws_detail[dest] = dict(matched=True, arn=matches[0]['arn'], status=UNCHANGED)
+                else:
+                    plan += [dict(
+                        bundle_name=bundle.bundle_name,
+                        dest=dest,
+                        sha2=bundle.sha2,
+                        installed=entries[0]['sha2'] if entries else None,
+                        arn=entries[0]['arn'] if entries else None)]
+            bundle.destinations[self.name] = aws_detail
+        return plan
+
+    def install_certificates(self, note, bundles, dests, plan=None, deploy_id=None):
+        '''
+        import every planned crt, over the certificate autocert imported before
+        when there is one, and attach the new ones to the dest's listeners
+        '''
+        self.require_connectivity(dests)
+        fetched = plan is None
+        if fetched:
+            plan = self.plan_certificates(bundles, dests)
+        planned = {(change['bundle_name'], change['dest']): change for change in plan}
+        by_name = {bundle.bundle_name: bundle for bundle in bundles}
+        for bundle in bundles:
+            aws_detail = bundle.destinations.get(self.name, {})
+            if not fetched:
+                for dest in dests:
+                    if (bundle.bundle_name, dest) not in planned:
+                        aws_detail[dest] = dict(matched=True, status=UNCHANGED)
+            bundle.destinations[self.name] = aws_detail
+        def install(item):
+            bundle_name, dest = item
+            bundle, change = by_name[bundle_name], planned[item]
+            certificate, chain = split_pem(bundle.crt)
+            kwargs = dict(Certificate=certificate, PrivateKey=bundle.key)
+            if chain:
+                kwargs['CertificateChain'] = chain
+            acm = self.client(dest, 'acm')
+            if change.get('arn', None):
+                return acm.import_certificate(CertificateArn=change['arn'], **kwargs)['CertificateArn']
+            arn = acm.import_certificate(
+                Tags=[dict(Key=TAG, Value=bundle.friendly_common_name), dict(Key='note', Value=note)],
+                **kwargs)['CertificateArn']
+            self.attach(dest, bundle.common_name, arn)
+            return arn
+        items = [item for item in planned if item[0] in by_name and item[1] in dests]
+        window = CFG.get('deploy', {}).get('window', None)
+        for (bundle_name, dest), result in self.fanout(install, items, workers=window).items():
+            if isinstance(result, AutocertError):
+                by_name[bundle_name].destinations[self.name][dest] = dict(matched=False, status=FAILED, error=result.message)
+            else:
+                by_name[bundle_name].destinations[self.name][dest] = dict(matched=True, arn=result, note=note, status=UPDATED)
+        app.logger.info(f'install_certificates: {len(items)} imported into {dests}')
+        return bundles
+
+    def remove_certificates(self, bundles, dests):
+        '''
+        detach and delete every certificate autocert imported for the bundles
+        '''
+        self.require_connectivity(dests)
+        inventories = self.inventories(bundles, dests)
+        items = [
+            (bundle.bundle_name, entry['arn'], dest)
+            for bundle in bundles
+            for dest in dests
+            for entry in inventories[dest].get(bundle.friendly_common_name, [])]
+        by_name = {bundle.bundle_name: bundle for bundle in bundles}
+        def remove(item):
+            bundle_name, arn, dest = item
+            self.detach(dest, by_name[bundle_name].common_name, arn)
+            self.client(dest, 'acm').delete_certificate(CertificateArn=arn)
+        for (bundle_name, arn, dest), result in self.fanout(remove, items).items():
+            aws_detail = by_name[bundle_name].destinations.setdefault(self.name, {})
+            if isinstance(result, AutocertError):
+                aws_detail[dest] = dict(arn=arn, status=FAILED, error=result.message)
+            else:
+                aws_detail[dest] = dict(arn=arn, status=REMOVED)
+        return bundles
 
-    def remove_certificate(self, bundles, dests):
+    def update_certificates(self, bundles, dests):
         raise NotImplementedError
@@ -3,13 +3,108 @@
 '''
 destination.base
 '''
+import os
+import re
+import json
+import tempfile
 import itertools
 from pprint import pformat
 from attrdict import AttrDict
 
+from destination.health import HealthMonitor
 from exceptions import AutocertError
+from utils import pki
+from config import CFG
 from app import app
 
+UNCHANGED = 'unchanged'
+UPDATED = 'updated'
+FAILED = 'failed'
+
+def fingerprint(crt):
+    try:
+        return pki.get_sha2(crt)
+    except Exception:
+        return None
+
+def write_atomic(filename, content, mode):
+    write_atomic_all([(filename, content, mode)])
+
+def write_atomic_all(files):
+    '''
+    files are (filename, content, mode); every one is written to a temp file
+    next to it first and they are only renamed over the originals once all of
+    them were written, so a failed write leaves every original in place
+    '''
+    tmps = []
+    try:
+        for filename, content, mode in files:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename) or '.', prefix=os.path.basename(filename)+'.', suffix='.tmp')
+            tmps += [(tmp, filename)]
+            os.fchmod(fd, mode)
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+        while tmps:
+            tmp, filename = tmps[0]
+            os.replace(tmp, filename)
+            tmps.pop(0)
+    except Exception:
+        for tmp, filename in tmps:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise
+
+class SnapshotNotFoundError(AutocertError):
+    def __init__(self, deploy_id):
+        message = f'no snapshot found for deploy_id={deploy_id}'
+        super(SnapshotNotFoundError, self).__init__(message)
+
+def snapshot_dir(deploy_id, name=None):
+    if not re.fullmatch(r'[0-9a-f]{32}', str(deploy_id)):
+        raise SnapshotNotFoundError(deploy_id)
+    path = os.path.join(str(CFG.get('deploy', {}).get('snapshot_path', '/data/autocert/snapshots')), deploy_id)
+    return os.path.join(path, name) if name else path
+
+def save_snapshot(deploy_id, name, dest, entries):
+    '''
+    entries replaced on dest by deploy_id, kept 0600 since they hold private
+    keys; an entry already snapshotted for this deploy is never overwritten
+    '''
+    path = snapshot_dir(deploy_id, name)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    filename = os.path.join(path, f'{dest}.json')
+    snapshot = load_snapshot(filename)
+    for key, entry in entries.items():
+        snapshot.setdefault(key, entry)
+    write_atomic(filename, json.dumps(snapshot), 0o600)
+
+def load_snapshot(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def load_snapshots(deploy_id, name):
+    '''
+    dest -> entries for every dest of destination name deploy_id replaced entries on
+    '''
+    path = snapshot_dir(deploy_id, name)
+    if not os.path.isdir(path):
+        return {}
+    return {
+        filename[:-len('.json')]: load_snapshot(os.path.join(path, filename))
+        for filename in sorted(os.listdir(path))
+        if filename.endswith('.json')}
+
+def snapshot_destinations(deploy_id):
+    path = snapshot_dir(deploy_id)
+    if not os.path.isdir(path):
+        raise SnapshotNotFoundError(deploy_id)
+    return sorted(os.listdir(path))
+
 class DestinationConnectivityError(AutocertError):
     def __init__(self, dest_ex_pairs):
         msg = ''
@@ -43,6 +138,8 @@ class DestsDontMatchPathsError(AutocertError):
         super(DestsDontMatchPathsError, self).__init__(message)
 
 class DestinationBase(object):
+    name = None
+
     def __init__(self, ar, cfg, verbosity):
         self.ar = ar
         self.cfg = AttrDict(cfg)
@@ -100,7 +197,17 @@ class DestinationBase(object):
                 kws = [self.keywords(path=path, dest=dest, **kw) for path, dest in zip(paths, dests)]
         app.logger.debug('requests kws =')
         app.logger.debug(pformat(kws))
-        return self.ar.requests(method, *kws)
+        return self.windowed(method, kws)
+
+    def windowed(self, method, kws):
+        '''
+        send kws through the async runner at most deploy.window at a time
+        '''
+        window = CFG.get('deploy', {}).get('window', None) or len(kws)
+        calls = []
+        for index in range(0, len(kws), window):
+            calls += self.ar.requests(method, *kws[index:index+window])
+        return calls
 
     def gets(self, paths=None, dests=None, jsons=None, **kw):
         return self.requests('GET', paths=paths, dests=dests, jsons=jsons, **kw)
@@ -117,6 +224,14 @@ class DestinationBase(object):
     def has_connectivity(self, timeout, dests):
         raise NotImplementedError
 
+    def require_connectivity(self, dests):
+        '''
+        raise for any of dests the health monitor last found unreachable
+        '''
+        unhealthy = HealthMonitor().unhealthy(self.name, dests)
+        if unhealthy:
+            raise DestinationConnectivityError(list(unhealthy.items()))
+
     def add_destinations(self, cert, dests, **items):
         '''
         does this belong here?
@@ -126,10 +241,31 @@ class DestinationBase(object):
             cert['destinations'][dest] = items
         return cert
 
+    def failures(self, bundles, dests):
+        '''
+        bundle_name -> {dest: error} for the dests install_certificates reported failed
+        '''
+        failures = {}
+        for bundle in bundles:
+            details = bundle.destinations.get(self.name, {})
+            failed = {
+                dest: details[dest].get('error', None)
+                for dest in dests
+                if details.get(dest, {}).get('status', None) == FAILED}
+            if failed:
+                failures[bundle.bundle_name] = failed
+        return failures
+
     def fetch_certificates(self, bundles, dests):
         raise NotImplementedError
 
-    def install_certificates(self, note, bundles, dests):
+    def plan_certificates(self, bundles, dests):
+        raise NotImplementedError
+
+    def install_certificates(self, note, bundles, dests, plan=None, deploy_id=None):
+        raise NotImplementedError
+
+    def rollback_certificates(self, deploy_id, dests=None):
         raise NotImplementedError
 
     def update_certificates(self, bundles, dests):
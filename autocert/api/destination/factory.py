@@ -6,8 +6,9 @@ destination.factory
 
 from destination.zeus import ZeusDestination
 from destination.aws import AwsDestination
+from destination.pemdir import PemDirDestination
+from destination.health import HealthMonitor
 from exceptions import AutocertError
-from config import CFG
 from app import app
 
 class DestinationFactoryError(AutocertError):
@@ -15,15 +16,20 @@ class DestinationFactoryError(AutocertError):
         msg = f'destination factory error with {destination}'
         super(DestinationFactoryError, self).__init__(msg)
 
-def create_destination(destination, ar, cfg, timeout, verbosity):
-    d = None
+def build_destination(destination, ar, cfg, verbosity):
     if destination == 'aws':
-        d = AwsDestination(ar, cfg, verbosity)
+        return AwsDestination(ar, cfg, verbosity)
     elif destination == 'zeus':
-        d = ZeusDestination(ar, cfg, verbosity)
-    else:
-        raise DestinationFactoryError(destination)
-    dests = list(CFG.destinations.zeus.keys())
-    if d.has_connectivity(timeout, dests):
-        return d
+        return ZeusDestination(ar, cfg, verbosity)
+    elif destination == 'pemdir':
+        return PemDirDestination(ar, cfg, verbosity)
+    raise DestinationFactoryError(destination)
 
+def create_destination(destination, ar, cfg, timeout, verbosity):
+    '''
+    connectivity comes from the health monitor's cache; only dests whose
+    entry is stale are probed here, and unreachable dests fail when used
+    '''
+    d = build_destination(destination, ar, cfg, verbosity)
+    HealthMonitor().refresh(destination, d, list(cfg.keys()), timeout=timeout)
+    return d
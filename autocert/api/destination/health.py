@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+destination.health: cached reachability of every configured destination
+
+a background thread per api worker probes every destination each
+health.interval seconds; building a destination only probes the dests whose
+entry is older than health.ttl, so an unreachable traffic manager costs its
+timeout once per ttl instead of on every request
+'''
+
+import time
+import asyncio
+import threading
+import traceback
+
+from utils.asyncrequests import AsyncRequests
+from config import CFG
+from app import app
+
+class HealthMonitor(object):
+    '''
+    status per (destination, dest): ok, error and when it was checked
+    '''
+
+    _entries = {}
+    _lock = threading.Lock()
+    _thread = None
+
+    def __init__(self):
+        cfg = CFG.get('health', {})
+        self.ttl = cfg.get('ttl', 60)
+        self.interval = cfg.get('interval', 30)
+        self.timeout = cfg.get('timeout', 2)
+
+    @classmethod
+    def entry(cls, name, dest):
+        with cls._lock:
+            return cls._entries.get((name, dest), None)
+
+    def stale(self, name, dests, now=None):
+        now = now or time.time()
+        def is_stale(entry):
+            return entry is None or now - entry['checked'] > self.ttl
+        return [dest for dest in dests if is_stale(HealthMonitor.entry(name, dest))]
+
+    def probe(self, name, destination, dests, timeout=None):
+        '''
+        all dests at once, falling back to one at a time to find which failed
+        '''
+        timeout = timeout or self.timeout
+        def check(dests):
+            try:
+                destination.has_connectivity(timeout, dests)
+                return None
+            except NotImplementedError:
+                return None
+            except Exception as ex:
+                return repr(ex)
+        results = {dest: None for dest in dests}
+        if check(dests):
+            results = {dest: check([dest]) for dest in dests}
+        now = time.time()
+        with HealthMonitor._lock:
+            for dest, error in results.items():
+                HealthMonitor._entries[(name, dest)] = dict(ok=error is None, error=error, checked=now)
+        for dest, error in results.items():
+            if error:
+                app.logger.warning(f'destination {name}:{dest} is unreachable: {error}')
+        return results
+
+    def refresh(self, name, destination, dests, timeout=None):
+        stale = self.stale(name, dests)
+        if stale:
+            self.probe(name, destination, stale, timeout=timeout)
+
+    def unhealthy(self, name, dests):
+        entries = {dest: HealthMonitor.entry(name, dest) for dest in dests}
+        return {dest: entry['error'] for dest, entry in entries.items() if entry and not entry['ok']}
+
+    def probe_all(self):
+        from destination.factory import build_destination
+        ar = AsyncRequests()
+        for name, cfg in CFG.get('destinations', {}).items():
+            destination = build_destination(name, ar, cfg, 0)
+            self.probe(name, destination, list(cfg.keys()))
+
+    def run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            while True:
+                try:
+                    self.probe_all()
+                except Exception:
+                    app.logger.error(traceback.format_exc())
+                time.sleep(self.interval)
+        finally:
+            loop.close()
+
+    def start(self):
+        with HealthMonitor._lock:
+            if HealthMonitor._thread:
+                return
+            HealthMonitor._thread = threading.Thread(target=self.run, name='autocert-health', daemon=True)
+            HealthMonitor._thread.start()
+
+    @classmethod
+    def all_metrics(cls):
+        with cls._lock:
+            return [
+                dict(destination=name, dest=dest, **entry)
+                for (name, dest), entry in sorted(cls._entries.items())]
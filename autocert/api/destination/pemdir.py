@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+destination.pemdir: key and crt files in a local directory, e.g. for nginx
+
+every dest is a directory and an optional reload command; a deploy writes each
+changed bundle's <friendly_common_name>.key and .crt, renaming them into place
+only once both were written, and then runs the reload command once for the whole batch, not once per bundle
+'''
+
+import os
+import shlex
+import subprocess
+
+from destination.base import DestinationBase, DestinationConnectivityError, UNCHANGED, UPDATED, FAILED, fingerprint, write_atomic_all
+from exceptions import AutocertError
+from app import app
+
+REMOVED = 'removed'
+
+class PemDirReloadError(AutocertError):
+    def __init__(self, dest, reload, ex):
+        message = f'pemdir reload error dest={dest} reload={reload}: {ex}'
+        super(PemDirReloadError, self).__init__(message)
+        self.errors = [ex]
+
+class PemDirDestination(DestinationBase):
+    name = 'pemdir'
+
+    def __init__(self, ar, cfg, verbosity=0):
+        super(PemDirDestination, self).__init__(ar, cfg, verbosity)
+
+    def filename(self, dest, bundle, ext):
+        return os.path.join(str(self.cfg[dest]['path']), bundle.friendly_common_name + ext)
+
+    def has_connectivity(self, timeout, dests):
+        dest_ex_pairs = []
+        for dest in dests:
+            path = str(self.cfg[dest]['path'])
+            if not os.path.isdir(path) or not os.access(path, os.W_OK):
+                dest_ex_pairs += [(dest, NotADirectoryError(f'{path} is not a writable directory'))]
+        if dest_ex_pairs:
+            raise DestinationConnectivityError(dest_ex_pairs)
+        return True
+
+    def installed(self, dest, bundle):
+        try:
+            with open(self.filename(dest, bundle, '.crt'), 'r') as f:
+                return fingerprint(f.read())
+        except FileNotFoundError:
+            return None
+
+    def reload(self, dest):
+        reload = self.cfg[dest].get('reload', None)
+        if not reload:
+            return
+        app.logger.info(f'pemdir: reloading {dest} with {reload}')
+        try:
+            subprocess.run(shlex.split(reload), check=True, timeout=self.cfg[dest].get('timeout', 30))
+        except Exception as ex:
+            raise PemDirReloadError(dest, reload, ex)
+
+    def fetch_certificates(self, bundles, dests):
+        app.logger.info(f'fetch_certificates: bundles={bundles} dests={dests}')
+        self.require_connectivity(dests)
+        for bundle in bundles:
+            pemdir_detail = bundle.destinations.get(self.name, {})
+            for dest in dests:
+                if os.path.exists(self.filename(dest, bundle, '.crt')):
+                    pemdir_detail[dest] = dict(matched=self.installed(dest, bundle) == bundle.sha2)
+            if pemdir_detail:
+                bundle.destinations[self.name] = pemdir_detail
+        return bundles
+
+    def plan_certificates(self, bundles, dests):
+        self.require_connectivity(dests)
+        plan = []
+        for bundle in bundles:
+            pemdir_detail = bundle.destinations.get(self.name, {})
+            for dest in dests:
+                sha2 = self.installed(dest, bundle)
+                if sha2 == bundle.sha2:
+                    pemdir_detail[dest] = dict(matched=True, status=UNCHANGED)
+                else:
+                    plan += [dict(bundle_name=bundle.bundle_name, dest=dest, sha2=bundle.sha2, installed=sha2)]
+            bundle.destinations[self.name] = pemdir_detail
+        return plan
+
+    def install_certificates(self, note, bundles, dests, plan=None, deploy_id=None):
+        '''
+        write the changed key and crt files, then reload every dest written to
+        once; a failed reload fails every bundle written to that dest
+        '''
+        self.require_connectivity(dests)
+        fetched = plan is None
+        if fetched:
+            plan = self.plan_certificates(bundles, dests)
+        planned = {(change['bundle_name'], change['dest']) for change in plan}
+        written = {dest: [] for dest in dests}
+        for bundle in bundles:
+            pemdir_detail = bundle.destinations.get(self.name, {})
+            for dest in dests:
+                if (bundle.bundle_name, dest) not in planned:
+                    if not fetched:
+                        pemdir_detail[dest] = dict(matched=True, status=UNCHANGED)
+                    continue
+                try:
+                    write_atomic_all([
+                        (self.filename(dest, bundle, '.key'), bundle.key, 0o600),
+                        (self.filename(dest, bundle, '.crt'), bundle.crt, 0o644)])
+                    pemdir_detail[dest] = dict(matched=True, note=note, status=UPDATED)
+                    written[dest] += [bundle]
+                except Exception as ex:
+                    app.logger.error(f'pemdir: writing {bundle.friendly_common_name} to {dest} failed: {ex}')
+                    pemdir_detail[dest] = dict(matched=False, note=note, status=FAILED, error=str(ex))
+            bundle.destinations[self.name] = pemdir_detail
+        for dest, bundles_written in written.items():
+            if not bundles_written:
+                continue
+            try:
+                self.reload(dest)
+            except PemDirReloadError as pre:
+                app.logger.error(pre)
+                for bundle in bundles_written:
+                    bundle.destinations[self.name][dest] = dict(matched=True, note=note, status=FAILED, error=pre.message)
+        return bundles
+
+    def remove_certificates(self, bundles, dests):
+        self.require_connectivity(dests)
+        for dest in dests:
+            removed = set()
+            for bundle in bundles:
+                for ext in ('.key', '.crt'):
+                    try:
+                        os.remove(self.filename(dest, bundle, ext))
+                        removed.add(bundle.bundle_name)
+                    except FileNotFoundError:
+                        pass
+                if bundle.bundle_name in removed:
+                    bundle.destinations.setdefault(self.name, {})[dest] = dict(status=REMOVED)
+            if removed:
+                self.reload(dest)
+        return bundles
+
+    def update_certificates(self, bundles, dests):
+        raise NotImplementedError
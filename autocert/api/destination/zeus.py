@@ -1,19 +1,26 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
+import uuid
+
 from asyncio import TimeoutError
 from aiohttp import ClientConnectorError
 
-from destination.base import DestinationBase, DestinationConnectivityError
+from destination.base import DestinationBase, DestinationConnectivityError, UNCHANGED, UPDATED, FAILED, fingerprint
+from destination.base import SnapshotNotFoundError, save_snapshot, load_snapshots
 from exceptions import AutocertError
 from utils.dictionary import merge, head, body, head_body, keys_ending
 from utils.newline import windows2unix
 from utils.yaml import yaml_format
+from cache import Cache
 from config import CFG
 from app import app
 
 ZEUS_PATH = 'ssl/server_keys/'
 
+RESTORED = 'restored'
+
 def compose_json(key, csr, crt, note):
     return dict(properties=dict(basic=dict(
         private=key,
@@ -27,6 +34,8 @@ class ZeusSSLServerKeysError(AutocertError):
         super(ZeusSSLServerKeysError, self).__init__(message)
 
 class ZeusDestination(DestinationBase):
+    name = 'zeus'
+
     def __init__(self, ar, cfg, verbosity):
         super(ZeusDestination, self).__init__(ar, cfg, verbosity)
 
@@ -50,72 +59,241 @@ class ZeusDestination(DestinationBase):
         return True
 
     def fetch_certificates(self, bundles, dests):
+        '''
+        matched when a dest has the bundle's crt installed (by fingerprint) and
+        unmatched when it has a different crt installed under the same name
+        '''
         app.logger.info(f'fetch_certificates: bundles={bundles} dests={dests}')
-        details = self._get_installed_certificates_details(bundles, dests)
+        self.require_connectivity(dests)
+        installed = self._get_installed_fingerprints(bundles, dests)
+        details = self._index_by_fingerprint(installed)
         if details:
             for bundle in bundles:
-                detail_key = (bundle.friendly_common_name, bundle.crt[:40])
-                destinations = details.get(detail_key, {})
-                if destinations:
-                    for dest, (key, csr, crt, note) in destinations.items():
-                        zeus_detail = bundle.destinations.get('zeus', {})
-                        matched = crt == bundle.crt
-                        zeus_detail[dest] = dict(
-                            matched=matched,
-                            note=note)
-                        bundle.destinations['zeus'] = zeus_detail
+                name, sha2 = bundle.friendly_common_name, bundle.sha2
+                zeus_detail = bundle.destinations.get('zeus', {})
+                for dest, note in details.get((name, sha2), {}).items():
+                    zeus_detail[dest] = dict(matched=True, note=note)
+                for dest in dests:
+                    entry = installed.get((name, dest), None)
+                    if entry and entry['sha2'] != sha2:
+                        zeus_detail[dest] = dict(matched=False, note=entry['note'])
+                if zeus_detail:
+                    bundle.destinations['zeus'] = zeus_detail
         return bundles
 
-    def install_certificates(self, note, bundles, dests):
-        paths, jsons = zip(*[(ZEUS_PATH+bundle.friendly_common_name, compose_json(bundle.key, bundle.csr, bundle.crt, note)) for bundle in bundles])
+    def plan_certificates(self, bundles, dests):
+        '''
+        a change per (bundle, dest) whose installed crt fingerprint differs from
+        the bundle's; the rest are reported unchanged on the bundles
+        '''
+        self.require_connectivity(dests)
+        installed = self._get_installed_fingerprints(bundles, dests, fresh=True)
+        plan = []
+        for bundle in bundles:
+            zeus_detail = bundle.destinations.get('zeus', {})
+            for dest in dests:
+                entry = installed.get((bundle.friendly_common_name, dest), None)
+                if entry and entry['sha2'] == bundle.sha2:
+                    zeus_detail[dest] = dict(matched=True, note=entry['note'], status=UNCHANGED)
+                else:
+                    plan += [dict(
+                        bundle_name=bundle.bundle_name,
+                        dest=dest,
+                        sha2=bundle.sha2,
+                        installed=entry['sha2'] if entry else None,
+                        replaces=entry is not None)]
+            bundle.destinations['zeus'] = zeus_detail
+        return plan
+
+    def install_certificates(self, note, bundles, dests, plan=None, deploy_id=None):
+        '''
+        only PUT the bundles whose crt fingerprint differs from what each dest
+        has installed, or exactly the changes in plan without fetching anything;
+        every bundle is reported unchanged, updated or failed per dest
 
-        app.logger.info(f'install_certificates:\n{locals}')
-        calls = self.puts(paths=paths, dests=dests, jsons=jsons, verify_ssl=False)
-        bundles = self.fetch_certificates(bundles, dests)
+        the entries about to be replaced are snapshotted under deploy_id first,
+        so rollback_certificates can put them back
+        '''
+        self.require_connectivity(dests)
+        fetched = plan is None
+        if fetched:
+            plan = self.plan_certificates(bundles, dests)
+        planned = {(change['bundle_name'], change['dest']): change for change in plan}
+        changes = []
+        for bundle in bundles:
+            zeus_detail = bundle.destinations.get('zeus', {})
+            for dest in dests:
+                if (bundle.bundle_name, dest) in planned:
+                    changes += [(bundle, dest)]
+                elif not fetched:
+                    zeus_detail[dest] = dict(matched=True, status=UNCHANGED)
+            bundle.destinations['zeus'] = zeus_detail
+        app.logger.info(f'install_certificates: {len(bundles) * len(dests) - len(changes)} unchanged, {len(changes)} to put')
+        if changes:
+            deploy_id = deploy_id or uuid.uuid4().hex
+            replaced = [
+                (bundle, dest) for bundle, dest in changes
+                if planned[(bundle.bundle_name, dest)].get('replaces', True)]
+            self._snapshot(deploy_id, replaced)
+            paths, jsons, change_dests = zip(*[
+                (ZEUS_PATH+bundle.friendly_common_name, compose_json(bundle.key, bundle.csr, bundle.crt, note), dest)
+                for bundle, dest in changes])
+            calls = self.puts(paths=paths, dests=change_dests, jsons=jsons, product=False, verify_ssl=False)
+            updated = {}
+            for (bundle, dest), call in zip(changes, calls):
+                if call.recv.status in (200, 201):
+                    bundle.destinations['zeus'][dest] = dict(matched=True, note=note, status=UPDATED, deploy_id=deploy_id)
+                    updated[(bundle.friendly_common_name, dest)] = dict(sha2=bundle.sha2, note=note)
+                else:
+                    app.logger.error(f'install_certificates: {bundle.friendly_common_name} to {dest} failed; status={call.recv.status}')
+                    bundle.destinations['zeus'][dest] = dict(matched=False, note=note, status=FAILED, error=call.recv.status)
+            self._record_inventory(updated)
         return bundles
 
+    def rollback_certificates(self, deploy_id, dests=None):
+        '''
+        PUT back every server key deploy_id replaced, on all of its dests at once;
+        returns dest -> friendly_common_name -> restored or failed
+        '''
+        snapshots = load_snapshots(deploy_id, self.name)
+        if dests:
+            snapshots = {dest: entries for dest, entries in snapshots.items() if dest in dests}
+        items = [(dest, name, basic) for dest, entries in snapshots.items() for name, basic in entries.items()]
+        if not items:
+            raise SnapshotNotFoundError(deploy_id)
+        self.require_connectivity(list(snapshots.keys()))
+        app.logger.info(f'rollback_certificates: restoring {len(items)} server key(s) replaced by {deploy_id}')
+        calls = self.puts(
+            paths=[ZEUS_PATH+name for dest, name, basic in items],
+            dests=[dest for dest, name, basic in items],
+            jsons=[dict(properties=dict(basic=basic)) for dest, name, basic in items],
+            product=False,
+            verify_ssl=False)
+        results, restored = {dest: {} for dest in snapshots}, {}
+        for (dest, name, basic), call in zip(items, calls):
+            if call.recv.status in (200, 201):
+                results[dest][name] = RESTORED
+                restored[(name, dest)] = dict(sha2=fingerprint(windows2unix(basic.get('public', 'missing'))), note=basic.get('note', ''))
+            else:
+                app.logger.error(f'rollback_certificates: {name} on {dest} failed; status={call.recv.status}')
+                results[dest][name] = FAILED
+        self._record_inventory(restored)
+        return results
+
     def update_certificates(self, bundles, dests):
         raise NotImplementedError
 
     def remove_certificates(self, bundles, dests):
         raise NotImplementedError
 
+    def _snapshot(self, deploy_id, replaced):
+        '''
+        fetch the entries about to be replaced, all at once, and save them before
+        anything is PUT; a failed fetch stops the install
+        '''
+        if not replaced:
+            return
+        calls = self.gets(
+            paths=[ZEUS_PATH+bundle.friendly_common_name for bundle, dest in replaced],
+            dests=[dest for bundle, dest in replaced],
+            product=False,
+            verify_ssl=False)
+        snapshots = {}
+        for (bundle, dest), call in zip(replaced, calls):
+            if call.recv.status == 404:
+                continue
+            if call.recv.status != 200:
+                raise ZeusSSLServerKeysError(call)
+            snapshots.setdefault(dest, {})[bundle.friendly_common_name] = dict(call.recv.json.properties.basic)
+        for dest, entries in snapshots.items():
+            save_snapshot(deploy_id, self.name, dest, entries)
+        app.logger.info(f'install_certificates: snapshotted {len(replaced)} server key(s) as {deploy_id}')
+
     def _get_installed_summary(self, bundles, dests):
+        '''
+        children of ssl/server_keys/ on each dest
+        '''
         app.logger.debug(f'_get_installed_summary:\n{locals}')
-        friendly_common_names = [bundle.friendly_common_name for bundle in bundles]
         calls = self.gets(paths=[ZEUS_PATH], dests=dests, timeout=10, verify_ssl=False)
         assert len(dests) == len(calls)
-        summary = []
+        summary = {}
         for dest, call in zip(dests, calls):
             if call.recv.status != 200:
                 raise ZeusSSLServerKeysError(call)
-            for child in call.recv.json.children:
-                if child.name in friendly_common_names:
-                    summary += [(child.name, ZEUS_PATH+child.name, dest)]
+            summary[dest] = {child.name for child in call.recv.json.children}
         return summary
 
+    def _sync_inventory(self, bundles, dests, fresh=False):
+        '''
+        cached sha2 and note per dest and server key name; only the bundles'
+        names that are new to the cache or older than cache.zeus_ttl are fetched
+        and names no longer listed are dropped, so private keys never leave zeus
+
+        with fresh every one of the bundles' names is fetched regardless of the
+        ttl; plan and install decide what to PUT from it, so a crt changed on
+        zeus since it was cached can't be mistaken for unchanged
+        '''
+        cache = Cache('zeus-inventory')
+        cached = cache.load()
+        names = {bundle.friendly_common_name for bundle in bundles}
+        now = time.time()
+        ttl = CFG.get('cache', {}).get('zeus_ttl', 3600)
+        summary = self._get_installed_summary(bundles, dests)
+        fetches = []
+        for dest, listed in summary.items():
+            for name in sorted(listed & names):
+                entry = cached.get(dest, {}).get(name, None)
+                if fresh or entry is None or now - entry['checked'] > ttl:
+                    fetches += [(name, dest)]
+        fetched = {}
+        if fetches:
+            paths, fetch_dests = zip(*[(ZEUS_PATH+name, dest) for name, dest in fetches])
+            calls = self.gets(paths=paths, dests=fetch_dests, product=False, verify_ssl=False)
+            for (name, dest), call in zip(fetches, calls):
+                if call.recv.status != 200:
+                    raise ZeusSSLServerKeysError(call)
+                basic = call.recv.json.properties.basic
+                fetched[(name, dest)] = dict(
+                    sha2=fingerprint(windows2unix(basic.get('public', 'missing'))),
+                    note=basic.get('note', ''),
+                    checked=now)
+        with cache.update() as entries:
+            for dest, listed in summary.items():
+                entries[dest] = {name: entry for name, entry in entries.get(dest, {}).items() if name in listed}
+            for (name, dest), entry in fetched.items():
+                entries[dest][name] = entry
+        app.logger.info(f'zeus inventory: {len(fetches)} server key(s) fetched across {len(dests)} dest(s)')
+        return entries
+
+    def _record_inventory(self, updated):
+        if not updated:
+            return
+        now = time.time()
+        with Cache('zeus-inventory').update() as entries:
+            for (name, dest), entry in updated.items():
+                entries.setdefault(dest, {})[name] = dict(checked=now, **entry)
+
+    def _get_installed_fingerprints(self, bundles, dests, fresh=False):
+        '''
+        sha2 and note of the crt installed under each (friendly_common_name, dest)
+        '''
+        entries = self._sync_inventory(bundles, dests, fresh=fresh)
+        names = {bundle.friendly_common_name for bundle in bundles}
+        return {
+            (name, dest): dict(sha2=entry['sha2'], note=entry['note'])
+            for dest in dests
+            for name, entry in entries.get(dest, {}).items()
+            if name in names}
+
     def _get_installed_certificates_details(self, bundles, dests):
+        '''
+        note per dest keyed by (friendly_common_name, sha2)
+        '''
         app.logger.debug(f'_get_installed_certificates_details:\n{locals}')
-        summary = self._get_installed_summary(bundles, dests)
+        return self._index_by_fingerprint(self._get_installed_fingerprints(bundles, dests))
+
+    def _index_by_fingerprint(self, installed):
         details = {}
-        if summary:
-            common_names, paths, dests = zip(*summary)
-            calls = self.gets(paths=paths, dests=dests, product=False, verify_ssl=False)
-            for common_name, path, dest, call in zip(common_names, paths, dests, calls):
-                try:
-                    crt = windows2unix(call.recv.json.properties.basic.get('public', 'missing'))
-                    csr = windows2unix(call.recv.json.properties.basic.get('request', 'missing'))
-                    key = windows2unix(call.recv.json.properties.basic.get('private', 'missing'))
-                    note = call.recv.json.properties.basic.get('note', '')
-                except Exception as ex:
-                    app.logger.debug(f'call.send.url={call.send.url}')
-                    app.logger.debug(f'call.recv.json=\n{call.recv.json}')
-                    raise ex
-                details[(common_name, crt[:40])] = details.get((common_name, crt[:40]), {})
-                details[(common_name, crt[:40])][dest] = (
-                    key,
-                    csr,
-                    crt,
-                    note)
+        for (name, dest), entry in installed.items():
+            details.setdefault((name, entry['sha2']), {})[dest] = entry['note']
         return details
-
@@ -3,6 +3,7 @@
 
 import os
 import re
+import threading
 
 from flask import make_response, jsonify
 from pprint import pprint, pformat
@@ -14,6 +15,7 @@ from flask import jsonify
 
 from destination.factory import create_destination
 from authority.factory import create_authority
+from authority.policy import AuthorityPolicy, POLICY
 from utils.asyncrequests import AsyncRequests
 from utils.dictionary import merge, head, head_body
 from utils import timestamp
@@ -22,6 +24,53 @@ from app import app
 
 from bundle import Bundle
 
+class Lazy(object):
+    '''
+    authorities or destinations built on first access; instances are kept per
+    thread for the life of the worker and rebound to the AsyncRequests and
+    verbosity of whichever endpoint uses them
+
+    what is saved is the construction (config parsing, clients such as aws'
+    boto3 ones, connectivity checks), not http sessions: those belong to the
+    AsyncRequests, which is still made per endpoint so the calls reported in a
+    response stay scoped to that request
+    '''
+
+    _local = threading.local()
+
+    def __init__(self, kind, cfgs, ar, verbosity, build):
+        self.kind = kind
+        self.cfgs = cfgs
+        self.ar = ar
+        self.verbosity = verbosity
+        self.build = build
+
+    def __contains__(self, name):
+        return name in self.cfgs
+
+    def __iter__(self):
+        return iter(self.cfgs)
+
+    def __getitem__(self, name):
+        cfg = self.cfgs[name]
+        cache = Lazy._local.__dict__.setdefault(self.kind, {})
+        key = (name, dumps(cfg, sort_keys=True, default=str))
+        instance = cache.get(key, None)
+        if instance is None:
+            app.logger.debug(f'building {self.kind}.{name} for thread {threading.get_ident()}')
+            instance = cache[key] = self.build(name, self.ar, cfg)
+        instance.ar = self.ar
+        instance.verbosity = self.verbosity
+        return instance
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
 class EndpointBase(object):
     _sorting_funcs = dict(
         default=lambda bundle: bundle.common_name,
@@ -33,17 +82,25 @@ class EndpointBase(object):
         self.cfg = AttrDict(cfg)
         self.args = AttrDict(args)
         self.verbosity = self.args.verbosity
-        authorities = self.cfg.authorities
-        self.authorities = AttrDict({
-            a: create_authority(a, self.ar, authorities[a], self.verbosity) for a in authorities
-        })
-        destinations = self.cfg.destinations
-        self.destinations = AttrDict({
-            d: create_destination(d, self.ar, destinations[d], self.args.timeout, self.verbosity) for d in destinations
-        })
+        self.authorities = Lazy(
+            'authorities',
+            self.cfg.authorities,
+            self.ar,
+            self.verbosity,
+            lambda name, ar, cfg: create_authority(name, ar, cfg, self.verbosity))
+        self.destinations = Lazy(
+            'destinations',
+            self.cfg.destinations,
+            self.ar,
+            self.verbosity,
+            lambda name, ar, cfg: create_destination(name, ar, cfg, self.args.timeout, self.verbosity))
 
     @property
     def authority(self):
+        if self.args.get('authority', None) == POLICY:
+            if getattr(self, '_policy', None) is None:
+                self._policy = AuthorityPolicy(self.cfg.get('authority_policy', {}), self.cfg.authorities, self.verbosity)
+            return self._policy
         return self.authorities[self.args.authority]
 
     @property
@@ -61,14 +118,22 @@ class EndpointBase(object):
     def execute(self, **kwargs):
         raise NotImplementedError
 
-    def transform(self, bundles):
+    def progress(self, message):
+        '''
+        replaced by the job runner to record progress on queued jobs
+        '''
+        app.logger.info(message)
+
+    def transform(self, bundles, calls=None):
         bundles = [bundle.transform(self.verbosity) for bundle in sorted(bundles, key=self.sorting_func)]
         json = dict(
             count=len(bundles),
             bundles=bundles,
         )
         if self.args.call_detail:
-            calls = [self.transform_call(call) for call in self.ar.calls]
+            policy = getattr(self, '_policy', None)
+            calls = list(self.ar.calls) + list(calls or []) + (policy.calls if policy else [])
+            calls = [self.transform_call(call) for call in calls]
             json['calls'] = calls
         return json
 
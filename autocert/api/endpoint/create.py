@@ -6,14 +6,17 @@ autocert.create
 
 import os
 
+from contextlib import contextmanager
 from pprint import pformat
 from attrdict import AttrDict
 from datetime import timedelta
 
 from endpoint.base import EndpointBase
+from authority.policy import AuthorityMetrics, POLICY
 from exceptions import AutocertError
 from config import CFG
-from utils import pki
+from keys import create_modhash_key_and_csr, get_key_type, RSA
+from keypool import KeyPool, executor
 from app import app
 
 from bundle import Bundle
@@ -23,29 +26,49 @@ class UnknownCertificateAuthorityError(AutocertError):
         message = f'unknown certificate authority: {authority}'
         super(UnknownCertificateAuthorityError, self).__init__(message)
 
+class MissingCommonNameError(AutocertError):
+    def __init__(self):
+        message = 'create requires either a common_name or a batch'
+        super(MissingCommonNameError, self).__init__(message)
+
 class CreateEndpoint(EndpointBase):
     def __init__(self, cfg, args):
         super(CreateEndpoint, self).__init__(cfg, args)
 
     def execute(self):
+        if self.args.get('batch', None):
+            return self.execute_batch()
+        if not self.args.get('common_name', None):
+            raise MissingCommonNameError()
         status = 201
-        modhash, key, csr = pki.create_modhash_key_and_csr(
+        self.progress(f'creating key and csr for {self.args.common_name}')
+        key = self.args.key
+        key_type = self.args.get('key_type', None) or CFG.key.get('key_type', RSA)
+        if key or self.args.csr:
+            key_type = get_key_type(key or self.args.csr)
+        if not key and not self.args.csr:
+            pool = KeyPool.get(key_type, CFG.key.public_exponent, CFG.key.key_size)
+            key = pool.take() if pool else None
+        modhash, key, csr = create_modhash_key_and_csr(
             self.args.common_name,
+            key_type=key_type,
             public_exponent=CFG.key.public_exponent,
             key_size=CFG.key.key_size,
-            key=self.args.key,
+            key=key,
             csr=self.args.csr,
             oids=self.cfg.csr.oids,
             sans=self.args.sans)
-        crt, expiry, authority = self.authority.create_certificate(
-            self.args.organization_name,
-            self.args.common_name,
-            self.args.validity_years,
-            csr,
-            self.args.bug,
-            sans=sorted(list(self.args.sans)),
-            repeat_delta=self.args.repeat_delta,
-            whois_check=self.args.whois_check)
+        self.progress(f'ordering certificate from {self.args.authority}')
+        with self.timed():
+            crt, expiry, authority = self.authority.create_certificate(
+                self.args.organization_name,
+                self.args.common_name,
+                self.args.validity_years,
+                csr,
+                self.args.bug,
+                sans=sorted(list(self.args.sans)),
+                repeat_delta=self.args.repeat_delta,
+                whois_check=self.args.whois_check)
         bundle = Bundle(
             self.args.common_name,
             modhash,
@@ -58,8 +81,106 @@ class CreateEndpoint(EndpointBase):
             authority=authority)
         bundle.to_disk()
         if self.args.destinations:
+            self.progress(f'installing {bundle.bundle_name}')
             note = 'bug ' + self.args.bug
             for name, dests in self.args.destinations.items():
                 bundle = self.destinations[name].install_certificates(note, [bundle], dests)[0]
         json = self.transform([bundle])
         return json, status
+
+    def execute_batch(self):
+        '''
+        many certificates in one request: keys and csrs are made in parallel, the
+        orders go to the authority as one batch and each item reports its own
+        success or failure
+        '''
+        status = 201
+        specs = [dict(common_name=item['common_name'], sans=sorted(item.get('sans', None) or [])) for item in self.args.batch]
+        key_type = self.args.get('key_type', None) or CFG.key.get('key_type', RSA)
+        self.progress(f'creating keys and csrs for {len(specs)} certificates')
+        errors = {}
+        ordered = []
+        for spec, result in zip(specs, self.create_modhashes_keys_and_csrs(specs, key_type)):
+            if isinstance(result, Exception):
+                errors[spec['common_name']] = str(result)
+            else:
+                spec['modhash'], spec['key'], spec['csr'] = result
+                ordered += [spec]
+        self.progress(f'ordering {len(ordered)} certificates from {self.args.authority}')
+        with self.timed():
+            results = self.authority.create_certificates(
+                self.args.organization_name,
+                [dict(common_name=spec['common_name'], csr=spec['csr'], sans=spec['sans']) for spec in ordered],
+                self.args.validity_years,
+                self.args.bug,
+                repeat_delta=self.args.repeat_delta,
+                whois_check=self.args.whois_check) if ordered else []
+        bundles = []
+        for spec, result in zip(ordered, results):
+            if 'error' in result:
+                errors[spec['common_name']] = result['error']
+                continue
+            bundle = Bundle(
+                spec['common_name'],
+                spec['modhash'],
+                spec['key'],
+                spec['csr'],
+                result['crt'],
+                self.args.bug,
+                sans=spec['sans'],
+                expiry=result['expiry'],
+                authority=result['authority'])
+            bundle.to_disk()
+            bundles += [bundle]
+        if bundles and self.args.destinations:
+            self.progress(f'installing {len(bundles)} bundles')
+            note = 'bug ' + self.args.bug
+            for name, dests in self.args.destinations.items():
+                bundles = self.destinations[name].install_certificates(note, bundles, dests)
+        json = self.transform(bundles)
+        if errors:
+            json['errors'] = errors
+            app.logger.error(f'batch create failed for {len(errors)} of {len(specs)} certificates:\n{pformat(errors)}')
+        if not bundles:
+            status = 500
+        return json, status
+
+    @contextmanager
+    def timed(self):
+        '''
+        the policy records its own per-authority metrics
+        '''
+        if self.args.authority == POLICY:
+            yield
+        else:
+            with AuthorityMetrics.timed(self.args.authority):
+                yield
+
+    def create_modhashes_keys_and_csrs(self, specs, key_type):
+        '''
+        pooled keys are used first; the remaining keys and all csrs are made by a
+        process pool so a batch doesn't generate its keys one after the other;
+        a failed item yields its exception instead of (modhash, key, csr)
+        '''
+        pool = KeyPool.get(key_type, CFG.key.public_exponent, CFG.key.key_size)
+        keys = [pool.take() if pool else None for spec in specs]
+        oids = dict(self.cfg.csr.oids)
+        futures = [
+            executor().submit(
+                create_modhash_key_and_csr,
+                spec['common_name'],
+                key_type=key_type,
+                public_exponent=CFG.key.public_exponent,
+                key_size=CFG.key.key_size,
+                key=key,
+                oids=oids,
+                sans=spec['sans'])
+            for spec, key in zip(specs, keys)]
+        results = []
+        for future in futures:
+            try:
+                results += [future.result()]
+            except Exception as ex:
+                app.logger.error(f'failed to create key and csr: {ex}')
+                results += [ex]
+        return results
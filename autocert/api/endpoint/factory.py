@@ -10,6 +10,7 @@ from endpoint.query import QueryEndpoint
 from endpoint.create import CreateEndpoint
 from endpoint.update import UpdateEndpoint
 from endpoint.revoke import RevokeEndpoint
+from endpoint.rollback import RollbackEndpoint
 
 method2endpoint = dict(
     GET=ListEndpoint,
@@ -23,7 +24,8 @@ command2endpoint = dict(
     create=CreateEndpoint,
     deploy=UpdateEndpoint,
     renew=UpdateEndpoint,
-    revoke=RevokeEndpoint)
+    revoke=RevokeEndpoint,
+    rollback=RollbackEndpoint)
 
 def create_endpoint(method, cfg, args):
     if cfg is None:
@@ -29,8 +29,10 @@ class ListEndpoint(EndpointBase):
             expired=self.args.expired)
         bundles2 = []
         if self.verbosity > 1:
-            #FIXME: this should be driven by the yml in the cert tarball
-            bundles1 = self.authorities.digicert.display_certificates(bundles)
+            names = sorted(set([name for bundle in bundles for name in (bundle.authority or {})]))
+            for name in names:
+                self.authorities[name].display_certificates([bundle for bundle in bundles if name in (bundle.authority or {})])
+            bundles1 = bundles
             for name, dests in self.args.destinations.items():
                 print(f'name={name} dests={dests}')
                 bundles2.extend(self.destinations[name].fetch_certificates(bundles1, dests))
@@ -5,7 +5,7 @@ import os
 import re
 
 from attrdict import AttrDict
-from fnmatch import fnmatch
+from fnmatch import fnmatch, translate
 from ruamel import yaml
 from datetime import datetime, timedelta
 
@@ -15,11 +15,68 @@ from config import CFG
 from endpoint.base import EndpointBase
 from utils.yaml import yaml_format
 
-from utils import sift
+GLOB_CHARS = '*?['
 
-import traceback
+def is_glob(pattern):
+    return any(char in pattern for char in GLOB_CHARS)
 
-TIMEDELTA_ZERO = timedelta(0)
+def literal_prefix(pattern):
+    '''
+    the part of a glob pattern before its first glob character
+    '''
+    for index, char in enumerate(pattern):
+        if char in GLOB_CHARS:
+            return pattern[:index]
+    return pattern
+
+def compile_patterns(patterns):
+    '''
+    compile a list of glob patterns into a single regex
+    '''
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return re.compile('|'.join([translate(pattern) for pattern in patterns]))
+
+class OrderFilter(object):
+    '''
+    filter a batch of digicert orders; the patterns are compiled and the within
+    window computed once, then each column is compared across all orders
+
+    domain name patterns match any of the dns_names, or only the common_name
+    with common_name_only
+    '''
+    def __init__(self, domain_name_pns, statuses, within=None, now=None, common_name_only=False):
+        self.domains = compile_patterns(domain_name_pns)
+        self.common_name_only = common_name_only
+        self.statuses = compile_patterns(statuses)
+        self.window = None
+        if isinstance(within, int):
+            now = now if now else datetime.utcnow()
+            # valid_till is a YYYY-MM-DD string, so the window compares as strings
+            self.window = (now.date().isoformat(), (now + timedelta(within)).date().isoformat())
+
+    def __call__(self, orders):
+        orders = list(orders)
+        certificates = [order.get('certificate', None) or {} for order in orders]
+        statuses = [order.get('status', None) or '' for order in orders]
+        valid_tills = [certificate.get('valid_till', None) for certificate in certificates]
+        mask = [
+            bool(valid_till) and bool(self.statuses.match(status))
+            for status, valid_till in zip(statuses, valid_tills)]
+        if self.window:
+            lower, upper = self.window
+            mask = [
+                keep and isinstance(valid_till, str) and lower < valid_till <= upper
+                for keep, valid_till in zip(mask, valid_tills)]
+        domains = self.domains.match
+        if self.common_name_only:
+            names = [[certificate.get('common_name', None) or ''] for certificate in certificates]
+        else:
+            names = [certificate.get('dns_names', None) or [] for certificate in certificates]
+        mask = [
+            keep and any(domains(name) for name in dns_names)
+            for keep, dns_names in zip(mask, names)]
+        return [order for keep, order in zip(mask, orders) if keep]
 
 class QueryEndpoint(EndpointBase):
     def __init__(self, cfg, args):
@@ -30,33 +87,42 @@ class QueryEndpoint(EndpointBase):
             return self.query_digicert(**kwargs)
         return dict(query='results'), 200
 
-    def filter(self, order):
-        try:
-            status = order['status']
-            certificate = order['certificate']
-            common_name = certificate.get('common_name', 'UNDEF')
-            dns_names = certificate.get('dns_names', [])
-            valid_till = certificate['valid_till']
-            if sift.fnmatches(dns_names, self.args.domain_name_pns):
-                if sift.fnmatches([status], self.args.status):
-                    if isinstance(self.args.within, int):
-                        within = timedelta(self.args.within)
-                        delta = datetime.strptime(valid_till, '%Y-%m-%d') - datetime.utcnow()
-                        return TIMEDELTA_ZERO < delta and delta < within
-                    return True
-        except Exception as ex:
-            app.logger.debug('FILTER_EX: ' + traceback.format_exc())
-        return False
+    def filter(self, orders):
+        return OrderFilter(
+            self.args.domain_name_pns,
+            self.args.status,
+            within=self.args.within,
+            common_name_only=self.args.get('common_name_only', False))(orders)
+
+    def server_filters(self):
+        '''
+        constraints digicert can apply to order/certificate itself; the local
+        filter still runs on what comes back, so these only need to be a superset
+
+        digicert searches the common name, not the sans, so the domain name
+        pattern is only searched for there with common_name_only
+        '''
+        filters = {}
+        if len(self.args.status) == 1 and not is_glob(self.args.status[0]):
+            filters['status'] = self.args.status[0]
+        if isinstance(self.args.within, int):
+            today = datetime.utcnow().date()
+            filters['valid_till'] = '{0}...{1}'.format(today, today + timedelta(self.args.within))
+        if self.args.get('common_name_only', False) and len(self.args.domain_name_pns) == 1:
+            prefix = literal_prefix(self.args.domain_name_pns[0])
+            if prefix:
+                filters['search'] = prefix
+        return filters
 
     def query_digicert(self, **kwargs):
-        call = self.authorities.digicert._get_certificate_order_summary()
+        filters = self.server_filters()
+        app.logger.debug(f'query_digicert: filters={filters}')
+        call = self.authorities.digicert._get_certificate_order_summary(filters=filters)
         def get_orders(call): #FIXME: ugly hack to compile all orders from 'prev' linked list structure
             if call:
                 return get_orders(call.get('prev', None)) + list(call.recv.json.orders)
             return []
-        results = [dict(order) for order in get_orders(call) if self.filter(order)]
+        results = [dict(order) for order in self.filter(get_orders(call))]
         if self.args.result_detail == 'detailed':
-            order_ids = [result['id'] for result in results]
-            calls = self.authorities.digicert._get_certificate_order_detail(order_ids)
-            results = [call.recv.json for call in calls]
+            results = self.authorities.digicert._get_certificate_order_detail_cached(results)
         return dict(count=len(results), results=results), 200
@@ -18,12 +18,21 @@ class RevokeEndpoint(EndpointBase):
         bundle_name_pns = [self.sanitize(bundle_name_pn) for bundle_name_pn in self.args.bundle_name_pns]
         bundles = Bundle.bundles(bundle_name_pns)
         blacklist.check(bundles, self.args.blacklist_overrides)
-        bundles = self.authority.revoke_certificates(
+        self.progress(f'revoking {len(bundles)} bundle(s)')
+        revoked, errors = self.authority.revoke_certificates(
             bundles,
-            self.args.bug)
+            self.args.bug,
+            persist=self.persist)
+        json = self.transform(revoked)
+        if errors:
+            json['errors'] = errors
+            if not revoked:
+                status = 500
+        return json, status
+
+    def persist(self, bundles):
         for bundle in bundles:
             bundle.expiry = Bundle.timestamp
             bundle.to_disk()
-        json = self.transform(bundles)
-        return json, status
+        self.progress(f'revoked {len(bundles)} bundle(s)')
 
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+autocert.rollback
+'''
+
+from endpoint.base import EndpointBase
+from destination.base import snapshot_destinations
+from exceptions import AutocertError
+from app import app
+
+class RollbackEndpoint(EndpointBase):
+    def __init__(self, cfg, args):
+        super(RollbackEndpoint, self).__init__(cfg, args)
+
+    def execute(self, **kwargs):
+        '''
+        put back what a deploy replaced, on every destination it has a snapshot for
+        '''
+        status = 201
+        deploy_id = self.args.deploy_id
+        destinations = self.args.get('destinations', None) or {}
+        names = [name for name in snapshot_destinations(deploy_id) if not destinations or name in destinations]
+        self.progress(f'rolling back deploy {deploy_id} on {names}')
+        restored, errors = {}, {}
+        for name in names:
+            try:
+                restored[name] = self.destinations[name].rollback_certificates(deploy_id, dests=destinations.get(name, None))
+            except AutocertError as ae:
+                app.logger.error(ae)
+                errors[name] = ae.message
+        json = dict(deploy_id=deploy_id, restored=restored)
+        if errors:
+            json['errors'] = errors
+            if not restored:
+                status = 500
+        if self.args.call_detail:
+            json['calls'] = [self.transform_call(call) for call in self.ar.calls]
+        return json, status
@@ -9,6 +9,8 @@ from attrdict import AttrDict
 
 from endpoint.base import EndpointBase
 from exceptions import AutocertError
+from pipeline import RenewalPipeline
+from rollout import RollingDeploy, DEPLOYED, PlanMismatchError, save_plan, load_plan, drop_plan
 from utils.yaml import yaml_format
 from app import app
 import blacklist
@@ -28,9 +30,14 @@ class DeployError(AutocertError):
 class UpdateEndpoint(EndpointBase):
     def __init__(self, cfg, args):
         super(UpdateEndpoint, self).__init__(cfg, args)
+        self.deploy_id = None
 
     def execute(self, **kwargs):
         status = 201
+        if self.args.get('apply_plan', None):
+            return self.apply(**kwargs)
+        if not self.args.get('bundle_name_pns', None):
+            raise MissingUpdateArgumentsError(self.args)
         bundle_name_pns = [self.sanitize(bundle_name_pn) for bundle_name_pn in self.args.bundle_name_pns]
         bundles = Bundle.bundles(bundle_name_pns)
         blacklist.check(bundles, self.args.blacklist_overrides)
@@ -39,31 +46,124 @@ class UpdateEndpoint(EndpointBase):
         if authority == None and destinations == None:
             raise MissingUpdateArgumentsError(self.args)
         if self.args.get('authority', None):
-            bundles = self.renew(bundles, **kwargs)
+            return self.renew(bundles, **kwargs)
         if self.args.get('destinations', None):
-            bundles = self.deploy(bundles, **kwargs)
+            if self.args.get('plan', False):
+                return self.plan(bundles, **kwargs)
+            bundles, outcomes, calls = self.deploy(bundles, **kwargs)
+            return self.deployment(bundles, outcomes, calls)
         json = self.transform(bundles)
         return json, status
 
     def renew(self, bundles, **kwargs):
-        crts, expiries, authorities = self.authority.renew_certificates(
-            bundles,
-            self.args.organization_name,
-            self.args.validity_years,
-            self.args.bug,
-            self.args.sans,
-            self.args.repeat_delta,
-            self.args.whois_check)
-        for bundle, crt, expiry, authority in zip(bundles, crts, expiries, authorities):
-            bundle.crt = crt
-            bundle.expiry = expiry
-            bundle.authority = authority
-            bundle.to_disk()
-        return bundles
+        '''
+        renews (and deploys, when destinations are given) through the chunked
+        pipeline; every bundle gets an outcome in the result
+        '''
+        status = 201
+        pipeline = RenewalPipeline(self.cfg, self.args, progress=self.progress)
+        renewed, outcomes, calls = pipeline.run(bundles)
+        json = self.transform(renewed, calls=calls)
+        json['outcomes'] = outcomes
+        if self.args.get('destinations', None) and not self.args.get('stage', False):
+            json['deploy_id'] = pipeline.rollout.deploy_id
+        if bundles and not renewed:
+            status = 500
+        return json, status
+
+    def deployment(self, bundles, outcomes, calls):
+        status = 201
+        json = self.transform(bundles, calls=calls)
+        json['deploy'] = outcomes
+        if self.deploy_id:
+            json['deploy_id'] = self.deploy_id
+        if bundles and not self.deployed(outcomes, any):
+            status = 500
+        return json, status
+
+    def plan(self, bundles, **kwargs):
+        '''
+        the PUTs deploy would make, saved under a plan id for deploy --apply-plan;
+        nothing is installed and, with --promote, nothing is written
+        '''
+        status = 201
+        promote = self.args.get('promote', False)
+        if promote:
+            bundles = [bundle for bundle in bundles if bundle.promote()]
+        self.progress(f'planning deploy of {len(bundles)} bundle(s)')
+        rollout = RollingDeploy(self.cfg, self.args, progress=self.progress)
+        changes, errors, calls = rollout.plan(bundles, self.args.destinations)
+        json = self.transform(bundles, calls=calls)
+        json['plan'] = dict(changes=changes)
+        if errors:
+            json['plan']['errors'] = errors
+            status = 500
+        else:
+            json['plan'] = save_plan(dict(
+                note='bug {bug}'.format(**self.args),
+                promote=promote,
+                bundles={bundle.bundle_name: bundle.sha2 for bundle in bundles},
+                destinations=dict(self.args.destinations),
+                changes=changes))
+        return json, status
+
+    def apply(self, **kwargs):
+        '''
+        make exactly the changes of a saved plan, provided none of its bundles
+        changed since it was made
+        '''
+        plan = load_plan(self.args.apply_plan)
+        bundles = [Bundle.from_disk(bundle_name) for bundle_name in plan['bundles']]
+        blacklist.check(bundles, self.args.get('blacklist_overrides', None))
+        if plan['promote']:
+            for bundle in bundles:
+                bundle.promote()
+        mismatched = [bundle.bundle_name for bundle in bundles if bundle.sha2 != plan['bundles'][bundle.bundle_name]]
+        if mismatched:
+            raise PlanMismatchError(plan['id'], mismatched)
+        self.progress(f'applying deploy plan {plan["id"]} to {len(bundles)} bundle(s)')
+        rollout = RollingDeploy(self.cfg, self.args, progress=self.progress)
+        self.deploy_id = rollout.deploy_id
+        bundles, outcomes, calls = rollout.run(plan['note'], bundles, plan['destinations'], plan=plan['changes'])
+        if self.deployed(outcomes, all):
+            if plan['promote']:
+                for bundle in bundles:
+                    bundle.to_disk()
+            drop_plan(plan['id'])
+        return self.deployment(bundles, outcomes, calls)
 
     def deploy(self, bundles, **kwargs):
-        installed_bundles = []
+        if self.args.get('promote', False):
+            return self.promote(bundles, **kwargs)
+        self.progress(f'deploying {len(bundles)} bundle(s)')
+        return self.install(bundles)
+
+    def promote(self, bundles, **kwargs):
+        '''
+        install the crts staged by renew --stage; bundles are only written with
+        their promoted crt once every dest has it, so a failed deploy leaves the
+        crt staged on disk
+        '''
+        staged = [bundle for bundle in bundles if bundle.pending]
+        skipped = [bundle.bundle_name for bundle in bundles if not bundle.pending]
+        if skipped:
+            app.logger.info(f'nothing staged to promote for {skipped}')
+        self.progress(f'promoting {len(staged)} staged bundle(s)')
+        for bundle in staged:
+            bundle.promote()
+        installed_bundles, outcomes, calls = self.install(staged)
+        if self.deployed(outcomes, all):
+            for bundle in staged:
+                bundle.to_disk()
+        else:
+            app.logger.error(f'promote didnt reach every dest; leaving {[b.bundle_name for b in staged]} staged')
+        return installed_bundles, outcomes, calls
+
+    def install(self, bundles):
         note = 'bug {bug}'.format(**self.args)
-        for name, dests in self.args.destinations.items():
-            installed_bundles += self.destinations[name].install_certificates(note, bundles, dests)
-        return installed_bundles
+        rollout = RollingDeploy(self.cfg, self.args, progress=self.progress)
+        self.deploy_id = rollout.deploy_id
+        return rollout.run(note, bundles, self.args.destinations)
+
+    def deployed(self, outcomes, which):
+        return which(outcome['status'] == DEPLOYED for dests in outcomes.values() for outcome in dests.values())
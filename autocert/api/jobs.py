@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+jobs: sqlite backed queue so create|renew|deploy|revoke can run outside of the
+gunicorn request; every api worker runs a few job threads that claim queued
+jobs from the shared database, so any worker can report on any job
+'''
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import asyncio
+import threading
+import traceback
+
+from contextlib import closing
+
+from exceptions import AutocertError
+from utils import timestamp
+from config import CFG
+from app import app
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+JOB_METHODS = ('PUT', 'POST', 'DELETE')
+
+# commands that are safe to run again from the start after a worker died in
+# the middle of them; create and renew may already have placed a paid order
+IDEMPOTENT_COMMANDS = ('deploy', 'rollback')
+
+SCHEMA = '''
+create table if not exists jobs (
+    id text primary key,
+    method text not null,
+    cfg text,
+    args text not null,
+    status text not null,
+    progress text,
+    result text,
+    http_status integer,
+    pid integer,
+    submitted text not null,
+    started text,
+    finished text
+)
+'''
+
+class JobNotFoundError(AutocertError):
+    def __init__(self, job_id):
+        message = f'job not found job_id={job_id}'
+        super(JobNotFoundError, self).__init__(message)
+
+class OrphanedJobError(AutocertError):
+    def __init__(self, job_id, pid):
+        message = f'job {job_id} was left running by pid={pid}, which no longer exists; check its progress before retrying'
+        super(OrphanedJobError, self).__init__(message)
+
+def now():
+    return str(timestamp.utcnow())
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class JobQueue(object):
+    '''
+    jobs table plus the job threads of this process
+    '''
+
+    jobs_path = str(CFG.get('jobs', {}).get('path', '/data/autocert/jobs.db'))
+
+    _threads = []
+    _lock = threading.Lock()
+
+    def __init__(self, jobs_path=None):
+        self.filename = jobs_path or JobQueue.jobs_path
+        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        with closing(self.connect()) as db:
+            db.execute(SCHEMA)
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def submit(self, method, cfg, args):
+        job_id = uuid.uuid4().hex
+        with closing(self.connect()) as db:
+            db.execute(
+                'insert into jobs (id, method, cfg, args, status, submitted) values (?, ?, ?, ?, ?, ?)',
+                (job_id, method, json.dumps(cfg), json.dumps(args), QUEUED, now()))
+        return job_id
+
+    def get(self, job_id):
+        with closing(self.connect()) as db:
+            row = db.execute('select * from jobs where id = ?', (job_id,)).fetchone()
+        if row is None:
+            raise JobNotFoundError(job_id)
+        job = dict(
+            id=row['id'],
+            command=json.loads(row['args']).get('command', None),
+            status=row['status'],
+            progress=json.loads(row['progress']) if row['progress'] else [],
+            submitted=row['submitted'],
+            started=row['started'],
+            finished=row['finished'])
+        if row['result']:
+            job['result'] = json.loads(row['result'])
+            job['http_status'] = row['http_status']
+        return job
+
+    def active(self):
+        '''
+        ids of the jobs still queued or running
+        '''
+        with closing(self.connect()) as db:
+            return [row['id'] for row in db.execute('select id from jobs where status in (?, ?)', (QUEUED, RUNNING))]
+
+    def claim(self):
+        db = self.connect()
+        try:
+            db.execute('begin immediate')
+            row = db.execute('select * from jobs where status = ? order by submitted, rowid limit 1', (QUEUED,)).fetchone()
+            if row:
+                db.execute(
+                    'update jobs set status = ?, pid = ?, started = ? where id = ?',
+                    (RUNNING, os.getpid(), now(), row['id']))
+            db.execute('commit')
+            return row
+        except Exception:
+            db.execute('rollback')
+            raise
+        finally:
+            db.close()
+
+    def progress(self, job_id, message):
+        app.logger.info(f'job {job_id}: {message}')
+        with closing(self.connect()) as db:
+            row = db.execute('select progress from jobs where id = ?', (job_id,)).fetchone()
+            progress = json.loads(row['progress']) if row['progress'] else []
+            progress += [f'{now()} {message}']
+            db.execute('update jobs set progress = ? where id = ?', (json.dumps(progress), job_id))
+
+    def finish(self, job_id, status, result, http_status):
+        with closing(self.connect()) as db:
+            db.execute(
+                'update jobs set status = ?, result = ?, http_status = ?, finished = ? where id = ?',
+                (status, json.dumps(result, cls=app.json_encoder), http_status, now(), job_id))
+
+    def requeue_orphans(self):
+        '''
+        jobs left running by a worker that no longer exists are queued again
+        when their command is idempotent and failed otherwise, for the operator
+        to retry
+        '''
+        with closing(self.connect()) as db:
+            rows = db.execute('select id, args, pid from jobs where status = ?', (RUNNING,)).fetchall()
+        for row in rows:
+            if row['pid'] is not None and is_alive(row['pid']):
+                continue
+            command = json.loads(row['args']).get('command', None)
+            if command in IDEMPOTENT_COMMANDS:
+                app.logger.warning(f'requeueing orphaned {command} job {row["id"]} from pid={row["pid"]}')
+                with closing(self.connect()) as db:
+                    db.execute('update jobs set status = ?, pid = null where id = ? and status = ?', (QUEUED, row['id'], RUNNING))
+            else:
+                ae = OrphanedJobError(row['id'], row['pid'])
+                app.logger.error(ae)
+                self.finish(row['id'], FAILED, dict(errors={ae.name: ae.message}), 500)
+
+    def run(self, row):
+        from endpoint.factory import create_endpoint
+        job_id = row['id']
+        cfg = json.loads(row['cfg']) if row['cfg'] else None
+        args = json.loads(row['args'])
+        try:
+            endpoint = create_endpoint(row['method'], cfg, args)
+            endpoint.progress = lambda message: self.progress(job_id, message)
+            result, http_status = endpoint.execute()
+            status = DONE
+        except AutocertError as ae:
+            app.logger.error(ae)
+            result, http_status, status = dict(errors={ae.name: ae.message}), 500, FAILED
+        except Exception as ex:
+            tb = traceback.format_exc()
+            app.logger.error(tb)
+            result, http_status, status = dict(errors={ex.__class__.__name__: tb}), 500, FAILED
+        self.finish(job_id, status, result, http_status)
+
+    def work(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        poll_interval = CFG.get('jobs', {}).get('poll_interval', 1)
+        try:
+            while True:
+                try:
+                    row = self.claim()
+                    if row:
+                        self.run(row)
+                    else:
+                        time.sleep(poll_interval)
+                except Exception:
+                    app.logger.error(traceback.format_exc())
+                    time.sleep(poll_interval)
+        finally:
+            loop.close()
+
+    def start(self):
+        with JobQueue._lock:
+            if JobQueue._threads:
+                return
+            self.requeue_orphans()
+            workers = CFG.get('jobs', {}).get('workers', 2)
+            for n in range(workers):
+                thread = threading.Thread(target=self.work, name=f'autocert-job-{n}', daemon=True)
+                thread.start()
+                JobQueue._threads += [thread]
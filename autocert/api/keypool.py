@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+keypool: private keys generated ahead of time by a process pool so that create
+only has to build the csr
+
+keys are only ever held in memory; each one is handed out exactly once and the
+pool is cleared when the worker exits
+
+the pools and create share one process pool per api worker; its processes
+are spawned rather than forked, since forking a threaded gunicorn worker or
+scheduler can copy a lock some other thread holds into the child
+'''
+
+import os
+import time
+import atexit
+import threading
+import multiprocessing
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from keys import generate_key
+from config import CFG
+from app import app
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def executor():
+    '''
+    the worker's process pool for generating keys and csrs, key.pool.workers
+    (or a cpu count) processes wide
+    '''
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            pool_cfg = CFG.key.get('pool', None) or {}
+            _executor = ProcessPoolExecutor(
+                max_workers=pool_cfg.get('workers', None) or os.cpu_count() or 1,
+                mp_context=multiprocessing.get_context('spawn'))
+        return _executor
+
+class KeyPool(object):
+    '''
+    keeps up to depth keys ready for one key spec, refilling in the background
+    '''
+
+    _pools = {}
+    _lock = threading.Lock()
+
+    def __init__(self, key_type, public_exponent, key_size, depth):
+        self.key_type = key_type
+        self.public_exponent = public_exponent
+        self.key_size = key_size
+        self.depth = depth
+        self.ready = deque()
+        self.pending = 0
+        self.lock = threading.RLock()
+        self.counts = dict(hits=0, misses=0, generated=0, failed=0)
+        self.last_refill = None
+
+    @classmethod
+    def get(cls, key_type, public_exponent, key_size):
+        '''
+        the pool for this key spec, or None when key.pool is not configured
+        '''
+        pool_cfg = CFG.key.get('pool', None)
+        if not pool_cfg or not pool_cfg.get('depth', 0):
+            return None
+        spec = (key_type, public_exponent, key_size)
+        with cls._lock:
+            pool = cls._pools.get(spec, None)
+            if pool is None:
+                pool = cls._pools[spec] = KeyPool(
+                    key_type,
+                    public_exponent,
+                    key_size,
+                    pool_cfg.depth)
+        pool.refill()
+        return pool
+
+    def take(self):
+        '''
+        a ready key, or None if the pool is empty and the caller should
+        generate one inline
+        '''
+        with self.lock:
+            key = self.ready.popleft() if self.ready else None
+            self.counts['hits' if key else 'misses'] += 1
+        self.refill()
+        return key
+
+    def refill(self):
+        with self.lock:
+            missing = self.depth - len(self.ready) - self.pending
+            for _ in range(missing):
+                self.pending += 1
+                future = executor().submit(generate_key, self.key_type, self.public_exponent, self.key_size)
+                future.add_done_callback(self._generated)
+            if missing > 0:
+                self.last_refill = time.time()
+
+    def _generated(self, future):
+        with self.lock:
+            self.pending -= 1
+            try:
+                self.ready.append(future.result())
+                self.counts['generated'] += 1
+            except Exception as ex:
+                self.counts['failed'] += 1
+                app.logger.error(f'key pool failed to generate a key: {ex}')
+
+    def clear(self):
+        with self.lock:
+            self.ready.clear()
+
+    @property
+    def metrics(self):
+        with self.lock:
+            return dict(
+                key_type=self.key_type,
+                key_size=self.key_size,
+                depth=self.depth,
+                ready=len(self.ready),
+                pending=self.pending,
+                last_refill=self.last_refill,
+                **self.counts)
+
+    @classmethod
+    def all_metrics(cls):
+        return [pool.metrics for pool in cls._pools.values()]
+
+@atexit.register
+def _clear_pools():
+    for pool in KeyPool._pools.values():
+        pool.clear()
+    with _executor_lock:
+        if _executor:
+            _executor.shutdown(wait=False)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+keys: rsa and ecdsa key generation, csr creation and modhash
+
+rsa keeps going through utils.pki; ecdsa keys have no modulus, so their modhash
+is the md5 of the DER encoded public key instead, which is the same for the
+.key, .csr and .crt of a bundle:
+
+    openssl pkey -in name-of-file.key -pubout -outform DER | md5sum
+'''
+
+import hashlib
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, ec
+
+from exceptions import AutocertError
+from utils import pki
+
+RSA = 'rsa'
+ECDSA_P256 = 'ecdsa-p256'
+ECDSA_P384 = 'ecdsa-p384'
+
+CURVES = {
+    ECDSA_P256: (ec.SECP256R1, hashes.SHA256),
+    ECDSA_P384: (ec.SECP384R1, hashes.SHA384),
+}
+
+KEY_TYPES = [RSA] + sorted(CURVES.keys())
+
+# maps the csr.oids config onto x509 name attributes
+OIDS = [
+    ('org_name', NameOID.ORGANIZATION_NAME),
+    ('org_addr1', NameOID.STREET_ADDRESS),
+    ('org_city', NameOID.LOCALITY_NAME),
+    ('org_state', NameOID.STATE_OR_PROVINCE_NAME),
+    ('org_zip', NameOID.POSTAL_CODE),
+    ('org_country', NameOID.COUNTRY_NAME),
+    ('org_contact_firstname', NameOID.GIVEN_NAME),
+    ('org_contact_lastname', NameOID.SURNAME),
+    ('org_contact_email', NameOID.EMAIL_ADDRESS),
+]
+
+class UnknownKeyTypeError(AutocertError):
+    def __init__(self, key_type):
+        message = f'unknown key type {key_type}; choices={KEY_TYPES}'
+        super(UnknownKeyTypeError, self).__init__(message)
+
+def key2pem(key):
+    return key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption()).decode('utf-8')
+
+def generate_key(key_type, public_exponent, key_size):
+    if key_type == RSA:
+        key = rsa.generate_private_key(
+            public_exponent=public_exponent,
+            key_size=key_size,
+            backend=default_backend())
+    elif key_type in CURVES:
+        curve, _ = CURVES[key_type]
+        key = ec.generate_private_key(curve(), default_backend())
+    else:
+        raise UnknownKeyTypeError(key_type)
+    return key2pem(key)
+
+def get_key_type(pem):
+    '''
+    the key type of a pem private key or csr
+    '''
+    if 'REQUEST' in pem.split('\n')[0]:
+        public_key = x509.load_pem_x509_csr(pem.encode('utf-8'), default_backend()).public_key()
+    else:
+        public_key = serialization.load_pem_private_key(pem.encode('utf-8'), password=None, backend=default_backend()).public_key()
+    if isinstance(public_key, rsa.RSAPublicKey):
+        return RSA
+    for key_type, (curve, _) in CURVES.items():
+        if isinstance(public_key, ec.EllipticCurvePublicKey) and public_key.curve.name == curve.name:
+            return key_type
+    raise UnknownKeyTypeError(public_key.__class__.__name__)
+
+def public_modhash(public_key):
+    der = public_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo)
+    return hashlib.md5(der).hexdigest()
+
+def create_ec_csr(key, key_type, common_name, oids=None, sans=None):
+    _, hash_type = CURVES[key_type]
+    attrs = [x509.NameAttribute(NameOID.COMMON_NAME, common_name)]
+    oids = oids if oids else {}
+    attrs += [x509.NameAttribute(oid, str(oids[name])) for name, oid in OIDS if oids.get(name, None)]
+    builder = x509.CertificateSigningRequestBuilder().subject_name(x509.Name(attrs))
+    if sans:
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName([x509.DNSName(san) for san in sans]),
+            critical=False)
+    csr = builder.sign(key, hash_type(), default_backend())
+    return csr.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+def create_modhash_key_and_csr(common_name, key_type=RSA, public_exponent=None, key_size=None, key=None, csr=None, oids=None, sans=None):
+    if key_type == RSA:
+        return pki.create_modhash_key_and_csr(
+            common_name,
+            public_exponent=public_exponent,
+            key_size=key_size,
+            key=key,
+            csr=csr,
+            oids=oids,
+            sans=sans)
+    if key_type not in CURVES:
+        raise UnknownKeyTypeError(key_type)
+    if csr:
+        req = x509.load_pem_x509_csr(csr.encode('utf-8'), default_backend())
+        return public_modhash(req.public_key()), key, csr
+    if not key:
+        key = generate_key(key_type, public_exponent, key_size)
+    private_key = serialization.load_pem_private_key(key.encode('utf-8'), password=None, backend=default_backend())
+    csr = create_ec_csr(private_key, key_type, common_name, oids=oids, sans=sans)
+    return public_modhash(private_key.public_key()), key, csr
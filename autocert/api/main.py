@@ -12,6 +12,10 @@ from pprint import pformat
 
 from endpoint.factory import create_endpoint
 from exceptions import AutocertError
+from jobs import JobQueue, JobNotFoundError, JOB_METHODS
+from keypool import KeyPool
+from authority.policy import AuthorityMetrics
+from destination.health import HealthMonitor
 from config import CFG
 from app import app
 
@@ -85,6 +89,12 @@ def initialize():
         PPID = os.getppid()
         USER = pwd.getpwuid(os.getuid())[0]
         print(f'starting api with log level={LEVEL}, pid={PID}, ppid={PPID} by user={USER}')
+        try:
+            JobQueue().start()
+        except Exception as ex:
+            app.logger.error(f'job threads not started: {ex}')
+        HealthMonitor().start()
+        KeyPool.get(CFG.key.get('key_type', 'rsa'), CFG.key.public_exponent, CFG.key.key_size)
 
 def log_request(user, hostname, ip, method, path, json):
     app.logger.info(f'{user}@{hostname} from {ip} ran {method} {path} with json=\n"{json}"')
@@ -132,8 +142,14 @@ def route():
         request.path,
         json)
     try:
-        endpoint = create_endpoint(request.method, cfg, json)
-        json, status = endpoint.execute()
+        if json.get('job', None) and request.method in JOB_METHODS:
+            queue = JobQueue()
+            job_id = queue.submit(request.method, cfg, json)
+            queue.start()
+            json, status = dict(job=dict(id=job_id, status='queued', url=f'/autocert/jobs/{job_id}')), 202
+        else:
+            endpoint = create_endpoint(request.method, cfg, json)
+            json, status = endpoint.execute()
     except AutocertError as ae:
         app.logger.error(ae)
         status = 500
@@ -148,6 +164,37 @@ def route():
         raise EmptyJsonError(json)
     return make_response(jsonify(json), status)
 
+@app.route('/autocert/metrics', methods=['GET'])
+def metrics():
+    json = request.json if request.json else {}
+    log_request(
+        json.get('user', 'unknown'),
+        json.get('hostname', 'unknown'),
+        request.remote_addr,
+        request.method,
+        request.path,
+        json)
+    return jsonify(dict(
+        pid=os.getpid(),
+        keypool=KeyPool.all_metrics(),
+        authorities=AuthorityMetrics.all_metrics(),
+        destinations=HealthMonitor.all_metrics()))
+
+@app.route('/autocert/jobs/<job_id>', methods=['GET'])
+def job(job_id):
+    json = request.json if request.json else {}
+    log_request(
+        json.get('user', 'unknown'),
+        json.get('hostname', 'unknown'),
+        request.remote_addr,
+        request.method,
+        request.path,
+        json)
+    try:
+        return make_response(jsonify(dict(job=JobQueue().get(job_id))), 200)
+    except JobNotFoundError as jnfe:
+        return make_response(jsonify(dict(errors={jnfe.name: jnfe.message})), 404)
+
 @app.errorhandler(AutocertError)
 def unhandled_error(ae):
     import traceback
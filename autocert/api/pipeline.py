@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+pipeline: renews bundles in chunks with a bounded number of chunks in flight
+
+every chunk runs renew (order, approve, download) -> write -> deploy on its own
+thread, event loop, AsyncRequests and authority, so one chunk writing or
+deploying doesn't hold up the next one ordering; every bundle gets an outcome
+and a failing chunk never takes the rest of the run with it
+
+with args.stage the renewed crts are written as each bundle's pending crt and
+nothing is deployed until deploy --promote; otherwise every chunk deploys
+through one RollingDeploy, so the deploy limits, stop_on_failure and the
+deploy_id to roll back are shared by the whole run
+'''
+
+import asyncio
+import threading
+
+from attrdict import AttrDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from authority.factory import create_authority
+from authority.policy import AuthorityMetrics, POLICY
+from rollout import RollingDeploy, DEPLOYED
+from utils.asyncrequests import AsyncRequests
+from exceptions import AutocertError
+from config import CFG
+from app import app
+
+RENEW = 'renew'
+WRITE = 'write'
+DEPLOY = 'deploy'
+STAGES = (RENEW, WRITE, DEPLOY)
+
+RENEWED = 'renewed'
+FAILED = 'failed'
+
+class RenewalCountError(AutocertError):
+    def __init__(self, expected, crts, authorities):
+        message = f'expected {expected} certificates but the authority returned {crts}; authorities={authorities}'
+        super(RenewalCountError, self).__init__(message)
+
+class PolicyRenewalError(AutocertError):
+    def __init__(self):
+        message = f'renewals reorder from each bundle\'s own authority; --authority {POLICY} only applies to create'
+        super(PolicyRenewalError, self).__init__(message)
+
+def renewed(stage, **kwargs):
+    return dict(status=RENEWED, stage=stage, **kwargs)
+
+def failed(stage, error, **kwargs):
+    return dict(status=FAILED, stage=stage, error=error.message if isinstance(error, AutocertError) else str(error), **kwargs)
+
+class RenewalPipeline(object):
+    '''
+    renew_cfg.chunk_size bundles go to the authority per order batch and at
+    most renew_cfg.in_flight chunks are worked on at the same time
+    '''
+
+    def __init__(self, cfg, args, progress=None):
+        if args.get('authority', None) == POLICY:
+            raise PolicyRenewalError()
+        renew_cfg = CFG.get('renew', {})
+        self.cfg = AttrDict(cfg)
+        self.args = AttrDict(args)
+        self.chunk_size = renew_cfg.get('chunk_size', 25)
+        self.in_flight = renew_cfg.get('in_flight', 4)
+        self.lock = threading.Lock()
+        self._progress = progress or app.logger.info
+        self.rollout = RollingDeploy(cfg, args, progress=self.progress)
+
+    def progress(self, message):
+        with self.lock:
+            self._progress(message)
+
+    def run(self, bundles):
+        '''
+        returns the renewed (and deployed) bundles, an outcome per bundle_name and
+        the calls made by every chunk
+        '''
+        chunks = [bundles[index:index+self.chunk_size] for index in range(0, len(bundles), self.chunk_size)]
+        self.progress(f'renewing {len(bundles)} bundle(s) in {len(chunks)} chunk(s) of up to {self.chunk_size}')
+        results, outcomes, calls = [], {}, []
+        with ThreadPoolExecutor(max_workers=max(1, min(self.in_flight, len(chunks)))) as executor:
+            futures = {executor.submit(self.run_chunk, number, chunk): chunk for number, chunk in enumerate(chunks)}
+            for future in as_completed(futures):
+                try:
+                    chunk_results, chunk_outcomes, chunk_calls = future.result()
+                except Exception as ex:
+                    app.logger.exception(ex)
+                    chunk_results, chunk_outcomes, chunk_calls = [], {b.bundle_name: failed(RENEW, ex) for b in futures[future]}, []
+                results += chunk_results
+                outcomes.update(chunk_outcomes)
+                calls += chunk_calls
+        count = len([outcome for outcome in outcomes.values() if outcome['status'] == FAILED])
+        self.progress(f'renewed {len(bundles) - count} of {len(bundles)} bundle(s)')
+        return results, outcomes, calls
+
+    def run_chunk(self, number, chunk):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        ar = AsyncRequests()
+        outcomes, order_ids = {}, {}
+        calls = []
+        try:
+            bundles = self.renew(ar, number, chunk, outcomes, order_ids)
+            bundles = self.write(number, bundles, outcomes)
+            if self.args.get('destinations', None) and not self.args.get('stage', False):
+                bundles = self.deploy(number, bundles, outcomes, calls)
+        finally:
+            loop.close()
+        for bundle_name, order_id in order_ids.items():
+            outcomes[bundle_name]['order_id'] = order_id
+        return bundles, outcomes, list(ar.calls) + calls
+
+    def renew(self, ar, number, chunk, outcomes, order_ids):
+        '''
+        every bundle is its own order, so a bundle the authority fails only fails
+        itself; the order_id of every order placed goes into order_ids so a
+        failure can be followed up on its own
+        '''
+        self.progress(f'chunk {number}: ordering {len(chunk)} certificate(s)')
+        authority = create_authority(self.args.authority, ar, self.cfg.authorities[self.args.authority], self.args.verbosity)
+        try:
+            with AuthorityMetrics.timed(self.args.authority):
+                results = authority.renew_certificates_results(
+                    chunk,
+                    self.args.organization_name,
+                    self.args.validity_years,
+                    self.args.bug,
+                    self.args.sans,
+                    self.args.repeat_delta,
+                    self.args.whois_check)
+            if len(results) != len(chunk):
+                raise RenewalCountError(len(chunk), len(results), [result.get('authority', None) for result in results])
+        except AutocertError as ae:
+            app.logger.error(ae)
+            outcomes.update({bundle.bundle_name: failed(RENEW, ae) for bundle in chunk})
+            return []
+        renewed_bundles = []
+        for bundle, result in zip(chunk, results):
+            order_id = result.get('order_id', None) or result.get('authority', {}).get(self.args.authority, {}).get('order_id', None)
+            if order_id:
+                order_ids[bundle.bundle_name] = order_id
+            if 'error' in result:
+                app.logger.error(f'chunk {number}: failed to renew {bundle.bundle_name}: {result["error"]}')
+                outcomes[bundle.bundle_name] = failed(RENEW, result['error'])
+                continue
+            if self.args.get('stage', False):
+                bundle.stage(result['crt'], result['expiry'], result['authority'])
+            else:
+                bundle.crt = result['crt']
+                bundle.expiry = result['expiry']
+                bundle.authority = result['authority']
+            outcomes[bundle.bundle_name] = renewed(RENEW)
+            renewed_bundles += [bundle]
+        return renewed_bundles
+
+    def write(self, number, bundles, outcomes):
+        written = []
+        for bundle in bundles:
+            try:
+                bundle.to_disk()
+                outcomes[bundle.bundle_name] = renewed(WRITE)
+                written += [bundle]
+            except Exception as ex:
+                app.logger.error(f'chunk {number}: failed to write {bundle.bundle_name}: {ex}')
+                outcomes[bundle.bundle_name] = failed(WRITE, ex)
+        return written
+
+    def deploy(self, number, bundles, outcomes, calls):
+        '''
+        a bundle fails to deploy when any dest failed it, or failed or was
+        skipped as a whole
+        '''
+        if not bundles:
+            return bundles
+        deploy_id = self.rollout.deploy_id
+        self.progress(f'chunk {number}: deploying {len(bundles)} bundle(s) as {deploy_id}')
+        note = 'bug {bug}'.format(**self.args)
+        try:
+            bundles, deploy_outcomes, deploy_calls = self.rollout.run(note, bundles, self.args.destinations)
+            calls += deploy_calls
+        except AutocertError as ae:
+            app.logger.error(ae)
+            outcomes.update({bundle.bundle_name: failed(DEPLOY, ae, deploy_id=deploy_id) for bundle in bundles})
+            return []
+        errors = {}
+        for name, dests in deploy_outcomes.items():
+            for dest, outcome in dests.items():
+                if outcome['status'] == DEPLOYED:
+                    continue
+                failing = outcome.get('errors', None)
+                bundle_names = list(failing.keys()) if isinstance(failing, dict) else [bundle.bundle_name for bundle in bundles]
+                for bundle_name in bundle_names:
+                    errors.setdefault(bundle_name, []).append(f'{name} {outcome["status"]} on {dest}')
+        deployed = []
+        for bundle in bundles:
+            if bundle.bundle_name in errors:
+                outcomes[bundle.bundle_name] = failed(DEPLOY, '; '.join(errors[bundle.bundle_name]), deploy_id=deploy_id)
+            else:
+                outcomes[bundle.bundle_name] = renewed(DEPLOY, deploy_id=deploy_id)
+                deployed += [bundle]
+        return deployed
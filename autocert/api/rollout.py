@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+rollout: deploys bundles to a fleet of dests in rolling waves
+
+every destination (zeus, aws, ...) rolls through its dests deploy.wave_size at
+a time, updating at most deploy.per_destination of them at once, with no more
+than deploy.concurrency dests being updated across all destinations; with
+deploy.stop_on_failure the first failed dest stops every later wave so a bad
+bundle never reaches the whole fleet; whatever a deploy replaced can be put
+back with rollback <deploy_id>
+
+deploy --plan fetches what every dest has installed, one thread per destination,
+and saves the changes it would make under a plan id; deploy --apply-plan makes
+exactly those changes without fetching again
+'''
+
+import copy
+import uuid
+import asyncio
+import threading
+
+from attrdict import AttrDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from destination.factory import create_destination
+from utils.asyncrequests import AsyncRequests
+from utils import timestamp
+from exceptions import AutocertError
+from cache import Cache
+from config import CFG
+from app import app
+
+DEPLOYED = 'deployed'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+class PlanNotFoundError(AutocertError):
+    def __init__(self, plan_id):
+        message = f'deploy plan not found plan_id={plan_id}'
+        super(PlanNotFoundError, self).__init__(message)
+
+class PlanMismatchError(AutocertError):
+    def __init__(self, plan_id, mismatched):
+        message = f'bundles changed since deploy plan {plan_id} was made: {mismatched}'
+        super(PlanMismatchError, self).__init__(message)
+
+def save_plan(plan):
+    plan_id = uuid.uuid4().hex
+    with Cache('deploy-plans').update() as plans:
+        plans[plan_id] = dict(plan, id=plan_id, created=str(timestamp.utcnow()))
+    return plans[plan_id]
+
+def load_plan(plan_id):
+    plans = Cache('deploy-plans').load()
+    if plan_id not in plans:
+        raise PlanNotFoundError(plan_id)
+    return plans[plan_id]
+
+def drop_plan(plan_id):
+    with Cache('deploy-plans').update() as plans:
+        plans.pop(plan_id, None)
+
+def deployed():
+    return dict(status=DEPLOYED)
+
+def failed(errors):
+    return dict(status=FAILED, errors=errors)
+
+def skipped():
+    return dict(status=SKIPPED)
+
+class RollingDeploy(object):
+    '''
+    each dest is installed on its own thread, event loop, AsyncRequests and
+    destination; results are merged back into the bundles under a lock
+    '''
+
+    def __init__(self, cfg, args, progress=None):
+        deploy_cfg = CFG.get('deploy', {})
+        self.cfg = AttrDict(cfg)
+        self.args = AttrDict(args)
+        self.concurrency = deploy_cfg.get('concurrency', 8)
+        self.per_destination = deploy_cfg.get('per_destination', 2)
+        self.wave_size = deploy_cfg.get('wave_size', 2)
+        self.stop_on_failure = deploy_cfg.get('stop_on_failure', True)
+        self.deploy_id = uuid.uuid4().hex
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        self._progress = progress or app.logger.info
+
+    def progress(self, message):
+        with self.lock:
+            self._progress(message)
+
+    def waves(self, dests):
+        return [dests[index:index+self.wave_size] for index in range(0, len(dests), self.wave_size)]
+
+    def plan(self, bundles, destinations):
+        '''
+        returns the changes per destination, the errors of the destinations
+        that couldn't be planned and the calls made fetching
+        '''
+        changes, errors, calls = {}, {}, []
+        def plan_destination(name, dests):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            ar = AsyncRequests()
+            try:
+                with self.slots:
+                    destination = create_destination(name, ar, self.cfg.destinations[name], self.args.timeout, self.args.verbosity)
+                    return destination.plan_certificates(bundles, list(dests))
+            finally:
+                with self.lock:
+                    calls.extend(ar.calls)
+                loop.close()
+        with ThreadPoolExecutor(max_workers=max(1, len(destinations))) as executor:
+            futures = {executor.submit(plan_destination, name, dests): name for name, dests in destinations.items()}
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    changes[name] = future.result()
+                except NotImplementedError:
+                    errors[name] = f'{name} cant plan a deploy'
+                except Exception as ex:
+                    app.logger.error(f'{name}: plan failed: {ex}')
+                    errors[name] = ex.message if isinstance(ex, AutocertError) else str(ex)
+        return changes, errors, calls
+
+    def run(self, note, bundles, destinations, plan=None):
+        '''
+        returns the bundles with their per dest status, an outcome per
+        destination and dest and the calls made by every install; with plan,
+        only the planned changes are made
+        '''
+        if not bundles:
+            return bundles, {}, []
+        outcomes, calls = {name: {} for name in destinations}, []
+        with ThreadPoolExecutor(max_workers=max(1, len(destinations))) as executor:
+            futures = [
+                executor.submit(self.roll, name, list(dests), note, bundles, outcomes[name], calls, plan.get(name, []) if plan is not None else None)
+                for name, dests in destinations.items()]
+            for future in futures:
+                future.result()
+        return bundles, outcomes, calls
+
+    def roll(self, name, dests, note, bundles, outcomes, calls, plan=None):
+        for number, wave in enumerate(self.waves(dests)):
+            if self.stopped.is_set():
+                app.logger.warning(f'{name}: skipping wave {number} {wave} after an earlier failure')
+                outcomes.update({dest: skipped() for dest in wave})
+                continue
+            self.progress(f'{name}: wave {number} deploying {len(bundles)} bundle(s) to {wave}')
+            with ThreadPoolExecutor(max_workers=max(1, min(self.per_destination, len(wave)))) as executor:
+                futures = {
+                    executor.submit(self.install, name, dest, note, bundles, calls, self.planned(plan, dest)): dest
+                    for dest in wave}
+                for future in as_completed(futures):
+                    dest = futures[future]
+                    try:
+                        errors = future.result()
+                    except Exception as ex:
+                        app.logger.error(f'{name}: deploy to {dest} failed: {ex}')
+                        errors = ex.message if isinstance(ex, AutocertError) else str(ex)
+                    outcomes[dest] = failed(errors) if errors else deployed()
+                    if errors and self.stop_on_failure:
+                        self.stopped.set()
+
+    def planned(self, plan, dest):
+        if plan is None:
+            return None
+        return [change for change in plan if change['dest'] == dest]
+
+    def install(self, name, dest, note, bundles, calls, plan=None):
+        '''
+        returns bundle_name -> error for every bundle dest failed to install
+        '''
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        ar = AsyncRequests()
+        copies = []
+        for bundle in bundles:
+            bundle = copy.copy(bundle)
+            bundle.destinations = {}
+            copies += [bundle]
+        try:
+            with self.slots:
+                destination = create_destination(name, ar, self.cfg.destinations[name], self.args.timeout, self.args.verbosity)
+                installed = destination.install_certificates(note, copies, [dest], plan=plan, deploy_id=self.deploy_id)
+        finally:
+            with self.lock:
+                calls += list(ar.calls)
+            loop.close()
+        with self.lock:
+            originals = {bundle.bundle_name: bundle for bundle in bundles}
+            for bundle in installed:
+                originals[bundle.bundle_name].destinations.setdefault(name, {}).update(bundle.destinations.get(name, {}))
+        return {bundle_name: errors[dest] for bundle_name, errors in destination.failures(installed, [dest]).items()}
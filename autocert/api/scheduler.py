@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+scheduler: queues renew jobs for bundles as they come within scheduler.threshold
+days of expiring; run it next to the api, which works off the queued jobs:
+
+    python3 scheduler.py [--once]
+
+bundles are kept in a min-heap by expiry, so the scheduler only wakes up when
+the next bundle crosses the threshold (or every scheduler.interval seconds to
+pick up new bundles); due bundles are grouped by authority, organization and
+the destinations they were last deployed to, so each renew job shares its
+org/domain lookups and deploys the renewed crts where the old ones are served
+(or, with scheduler.stage, leaves them staged for deploy --promote); every
+scheduled renewal is persisted so a restart doesn't queue the same expiry twice
+'''
+
+import sys
+import heapq
+import sqlite3
+import asyncio
+import platform
+
+from time import sleep
+from datetime import timedelta
+from contextlib import closing
+from argparse import ArgumentParser
+
+from authority.factory import create_authority
+from utils.asyncrequests import AsyncRequests
+from utils import timestamp
+from jobs import JobQueue, JobNotFoundError, QUEUED, RUNNING, FAILED
+from config import CFG
+from app import app
+
+from bundle import Bundle
+
+SCHEMA = '''
+create table if not exists scheduled (
+    bundle_name text not null,
+    expiry text not null,
+    job_id text not null,
+    day text not null,
+    scheduled text not null,
+    primary key (bundle_name, expiry)
+)
+'''
+
+def get_authority_name(bundle):
+    return list(bundle.authority.keys())[0] if bundle.authority else None
+
+def get_destinations(bundle):
+    '''
+    destination name -> dests the bundle was last deployed to, as a hashable key
+    '''
+    return tuple(sorted(
+        (name, tuple(sorted(dests)))
+        for name, dests in (bundle.destinations or {}).items()
+        if dests))
+
+class Scheduler(object):
+    '''
+    min-heap of bundle expiries plus the scheduled table
+    '''
+
+    scheduler_path = str(CFG.get('scheduler', {}).get('path', '/data/autocert/scheduler.db'))
+
+    def __init__(self, scheduler_path=None, queue=None):
+        cfg = CFG.get('scheduler', {})
+        self.filename = scheduler_path or Scheduler.scheduler_path
+        self.queue = queue or JobQueue()
+        self.threshold = timedelta(days=cfg.get('threshold', 30))
+        self.interval = cfg.get('interval', 3600)
+        self.batch_size = cfg.get('batch_size', 25)
+        self.concurrency = cfg.get('concurrency', 2)
+        self.daily_budget = cfg.get('daily_budget', 100)
+        self.organization_name = cfg.get('organization_name', None)
+        self.validity_years = cfg.get('validity_years', 1)
+        self.bug = str(cfg.get('bug', 'autocert-scheduler'))
+        self.repeat_delta = cfg.get('repeat_delta', 90)
+        self.timeout = cfg.get('timeout', 2)
+        self.stage = cfg.get('stage', False)
+        self.heap = []
+        with closing(self.connect()) as db:
+            db.execute(SCHEMA)
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def load(self, bundles=None):
+        '''
+        rebuild the heap, leaving out staged bundles and bundles whose current
+        expiry already has a renewal scheduled
+        '''
+        if bundles is None:
+            bundles = Bundle.bundles(['*'])
+        with closing(self.connect()) as db:
+            rows = db.execute('select bundle_name, expiry, job_id from scheduled').fetchall()
+        scheduled = {(row['bundle_name'], row['expiry']) for row in rows if self.settled(row)}
+        self.heap = [
+            (bundle.expiry, bundle.bundle_name, bundle)
+            for bundle in bundles
+            if bundle.expiry and not bundle.pending and (bundle.bundle_name, str(bundle.expiry)) not in scheduled]
+        heapq.heapify(self.heap)
+        app.logger.info(f'scheduler loaded {len(self.heap)} of {len(bundles)} bundle(s)')
+
+    def settled(self, row):
+        '''
+        a scheduled renewal counts unless its job failed or reported its bundle
+        as failed, in which case it is retried
+        '''
+        try:
+            job = self.queue.get(row['job_id'])
+        except JobNotFoundError:
+            return False
+        if job['status'] == FAILED:
+            return False
+        outcome = job.get('result', {}).get('outcomes', {}).get(row['bundle_name'], {})
+        return outcome.get('status', None) != 'failed'
+
+    def due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] - now <= self.threshold:
+            due += [heapq.heappop(self.heap)[2]]
+        return due
+
+    def defer(self, bundles):
+        for bundle in bundles:
+            heapq.heappush(self.heap, (bundle.expiry, bundle.bundle_name, bundle))
+
+    def budget(self, day):
+        with closing(self.connect()) as db:
+            used = db.execute('select count(*) from scheduled where day = ?', (day,)).fetchone()[0]
+        return max(0, self.daily_budget - used)
+
+    def in_flight(self):
+        '''
+        scheduler jobs still queued or running; only the queue's active jobs are
+        looked up, not the whole scheduled history
+        '''
+        active = self.queue.active()
+        if not active:
+            return 0
+        with closing(self.connect()) as db:
+            placeholders = ', '.join('?' * len(active))
+            return db.execute(f'select count(distinct job_id) from scheduled where job_id in ({placeholders})', active).fetchone()[0]
+
+    def organizations(self, bundles):
+        '''
+        organization_name per bundle_name; digicert order details are fetched in
+        one batch, everything else falls back to scheduler.organization_name
+        '''
+        organizations = {bundle.bundle_name: self.organization_name for bundle in bundles}
+        digicert = [bundle for bundle in bundles if get_authority_name(bundle) == 'digicert']
+        if digicert and 'digicert' in CFG.authorities:
+            authority = create_authority('digicert', AsyncRequests(), CFG.authorities.digicert, 0)
+            order_ids = [bundle.authority['digicert']['order_id'] for bundle in digicert]
+            for bundle, call in zip(digicert, authority._get_certificate_order_detail(order_ids)):
+                if call.recv.status == 200:
+                    organizations[bundle.bundle_name] = call.recv.json.organization.name
+        return organizations
+
+    def group(self, bundles):
+        organizations = self.organizations(bundles)
+        groups = {}
+        for bundle in bundles:
+            key = (get_authority_name(bundle), organizations[bundle.bundle_name], get_destinations(bundle))
+            if None in key:
+                app.logger.warning(f'scheduler skipping {bundle.bundle_name}: authority={key[0]} organization={key[1]}')
+                continue
+            groups.setdefault(key, []).append(bundle)
+        return groups
+
+    def renew_args(self, authority, organization_name, destinations, bundles):
+        '''
+        renew and deploy to destinations, or only stage with scheduler.stage
+        '''
+        return dict(
+            command='renew',
+            bundle_name_pns=[bundle.bundle_name for bundle in bundles],
+            authority=authority,
+            organization_name=organization_name,
+            validity_years=self.validity_years,
+            bug=self.bug,
+            sans=[],
+            repeat_delta=self.repeat_delta,
+            whois_check=False,
+            destinations={name: list(dests) for name, dests in destinations} or None,
+            stage=self.stage,
+            blacklist_overrides=[''],
+            call_detail=None,
+            sorting='default',
+            verbosity=0,
+            timeout=self.timeout,
+            job='detach',
+            user='autocert-scheduler',
+            hostname=platform.node())
+
+    def record(self, bundles, job_id, day, now):
+        with closing(self.connect()) as db:
+            db.executemany(
+                'insert or replace into scheduled (bundle_name, expiry, job_id, day, scheduled) values (?, ?, ?, ?, ?)',
+                [(bundle.bundle_name, str(bundle.expiry), job_id, day, str(now)) for bundle in bundles])
+
+    def tick(self, now=None):
+        '''
+        queue renew jobs for everything due, within the daily budget and the
+        number of scheduler jobs allowed in flight; the rest waits on the heap
+        '''
+        now = now or timestamp.utcnow()
+        day = str(now.date())
+        due = self.due(now)
+        if not due:
+            return []
+        budget = self.budget(day)
+        slots = self.concurrency - self.in_flight()
+        self.defer(due[budget:])
+        job_ids = []
+        for (authority, organization_name, destinations), bundles in self.group(due[:budget]).items():
+            for index in range(0, len(bundles), self.batch_size):
+                chunk = bundles[index:index+self.batch_size]
+                if slots <= 0:
+                    self.defer(chunk)
+                    continue
+                job_id = self.queue.submit('PUT', None, self.renew_args(authority, organization_name, destinations, chunk))
+                self.record(chunk, job_id, day, now)
+                app.logger.info(f'scheduler queued job {job_id} renewing {len(chunk)} {authority} bundle(s) for {organization_name}')
+                job_ids += [job_id]
+                slots -= 1
+        return job_ids
+
+    def wait(self, now):
+        '''
+        seconds until the next bundle is due, capped at scheduler.interval
+        '''
+        if not self.heap:
+            return self.interval
+        seconds = (self.heap[0][0] - self.threshold - now).total_seconds()
+        return max(1, min(self.interval, seconds))
+
+    def run(self, once=False):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            while True:
+                self.load()
+                self.tick()
+                if once:
+                    return
+                sleep(self.wait(timestamp.utcnow()))
+        finally:
+            loop.close()
+
+def main(args=None):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--once',
+        action='store_true',
+        help='schedule what is due now and exit')
+    ns = parser.parse_args(args)
+    Scheduler().run(once=ns.once)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
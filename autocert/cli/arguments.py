@@ -25,6 +25,17 @@ ORGANIZATIONS = [
     'c', 'Mozilla Corporation',
 ]
 
+KEY_TYPES = [
+    'rsa',
+    'ecdsa-p256',
+    'ecdsa-p384',
+]
+
+JOB_MODES = [
+    'wait',
+    'detach',
+]
+
 STATUS_TYPES = [
     'issued',
     'pending',
@@ -51,6 +62,14 @@ def bug_type(string):
 def x509_file(path):
     return open(path).read()
 
+def batch_file(path):
+    '''
+    one certificate per line: <common-name> [san ...]; lines starting with # are skipped
+    '''
+    with open(path) as f:
+        lines = [line.split() for line in f.read().strip().split('\n') if line.strip() and not line.startswith('#')]
+    return [dict(common_name=line[0], sans=line[1:]) for line in lines]
+
 def organization_type(string):
     if string == 'f':
         return 'Mozilla Foundation'
@@ -90,6 +109,11 @@ def get_authorities(authorities=None, **kwargs):
         return list(authorities.keys())
     return []
 
+def get_policies(authority_policy=None, **kwargs):
+    if authority_policy is not None:
+        return ['policy']
+    return []
+
 def get_destinations(destinations=None, **kwargs):
     d = []
     if destinations is not None:
@@ -223,6 +247,11 @@ ARGS = {
         action='store_true',
         help='show expired bundles'
     ),
+    ('--common-name-only',): dict(
+        action='store_true',
+        help='match domain name patterns against the common name only, not the sans; '
+            'lets digicert narrow the orders by search before they are sent'
+    ),
     ('--count',): dict(
         action='store_true',
         help='add count to bundles|result json|yaml returned from api calls'
@@ -234,6 +263,45 @@ ARGS = {
         nargs='+',
         help='default=%(default)s; choose which status type(s) to return; choices=[%(choices)s]'
     ),
+    ('--job',): dict(
+        const=JOB_MODES[0],
+        choices=JOB_MODES,
+        nargs='?',
+        help='const="%(const)s"; run as a background job on the api and either wait for it or detach; choices=[%(choices)s]'
+    ),
+    ('--wait',): dict(
+        action='store_true',
+        help='wait for the job to finish'
+    ),
+    ('job_id',): dict(
+        metavar='job-id',
+        help='the id of a job returned by --job detach'
+    ),
+    ('--stage',): dict(
+        action='store_true',
+        help='order and download the renewed crt but keep it pending until deploy --promote'
+    ),
+    ('--promote',): dict(
+        action='store_true',
+        help='deploy only bundles with a crt pending from renew --stage, making it current'
+    ),
+    ('--plan',): dict(
+        action='store_true',
+        help='fetch what every destination has installed and save the changes deploy would make as a plan'
+    ),
+    ('--apply-plan',): dict(
+        metavar='PLAN-ID',
+        help='make exactly the changes of a plan saved by deploy --plan, without fetching again'
+    ),
+    ('deploy_id',): dict(
+        metavar='deploy-id',
+        help='the deploy_id returned by the deploy to roll back'
+    ),
+    ('--key-type',): dict(
+        metavar='TYPE',
+        choices=KEY_TYPES,
+        help='default is the api key.key_type; type of key to generate; choices=[%(choices)s]'
+    ),
     ('-K','--key'): dict(
         type=x509_file,
         help='optionally provide key to be used in generating csr and crt; key will be stored in bundle'
@@ -242,6 +310,12 @@ ARGS = {
         type=x509_file,
         help='optionally provide csr to be used in generating crt; key will not, but csr will be stored in bundle'
     ),
+    ('-B', '--batch-file'): dict(
+        metavar='FILEPATH',
+        dest='batch',
+        type=batch_file,
+        help='create a certificate per line of FILEPATH, each line being <common-name> [san ...]; replaces common-name'
+    ),
     ('common_name',): dict(
         metavar='common-name',
         help='the commmon-name to be used for the certificate'
@@ -31,6 +31,7 @@ from cli.namespace import jsonify
 from cli.arguments import add_argument
 from cli.utils import pki
 from cli.config import CFG
+from cli.jobs import wait_for_job
 from cli import requests
 from requests.exceptions import ConnectionError, ReadTimeout
 
@@ -51,6 +52,7 @@ METHODS = {
     'create': 'POST',
     'renew': 'PUT',
     'deploy': 'PUT',
+    'rollback': 'PUT',
     'revoke': 'DELETE',
 }
 
@@ -170,6 +172,12 @@ def do_request(ns):
     if status in (200, 201, 202, 203, 204):
         try:
             json = response.json()
+            if 'job' in json and getattr(ns, 'job', None) == 'wait':
+                job = wait_for_job(ns, json['job']['id'])
+                if job['status'] == 'failed':
+                    output_print(job['result'], ns.output)
+                    return -1
+                json = job['result']
             display(ns, json)
         except JSONDecodeError as jde:
             print(jde)
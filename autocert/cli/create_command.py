@@ -4,11 +4,11 @@
 cli.create
 '''
 
-from cli.arguments import add_argument, get_authorities, get_destinations
+from cli.arguments import add_argument, get_authorities, get_policies, get_destinations
 
 def add_parser(subparsers, api_config):
     parser = subparsers.add_parser('create')
-    authorities = get_authorities(**api_config)
+    authorities = get_authorities(**api_config) + get_policies(**api_config)
     destinations = get_destinations(**api_config)
     add_argument(parser, '-o', '--organization-name')
     add_argument(parser, '-b', '--bug')
@@ -20,6 +20,7 @@ def add_parser(subparsers, api_config):
         choices=destinations)
     add_argument(parser, '-s', '--sans')
     add_argument(parser, '-S', '--sans-file')
+    add_argument(parser, '--key-type')
     add_argument(parser, '-K', '--key')
     add_argument(parser, '-C', '--csr')
     add_argument(parser, '-y', '--validity-years')
@@ -29,4 +30,6 @@ def add_parser(subparsers, api_config):
     add_argument(parser, '-n', '--nerf')
     add_argument(parser, '-v', '--verbose')
     add_argument(parser, '--count')
-    add_argument(parser, 'common_name')
+    add_argument(parser, '--job')
+    add_argument(parser, '-B', '--batch-file')
+    add_argument(parser, 'common_name', nargs='?')
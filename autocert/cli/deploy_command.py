@@ -17,4 +17,8 @@ def add_parser(subparsers, api_config):
     add_argument(parser, '-v', '--verbose')
     add_argument(parser, '--blacklist-overrides',)
     add_argument(parser, '--count',)
-    add_argument(parser, 'bundle_name_pns')
+    add_argument(parser, '--promote')
+    add_argument(parser, '--plan')
+    add_argument(parser, '--apply-plan')
+    add_argument(parser, '--job')
+    add_argument(parser, 'bundle_name_pns', nargs='*')
@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+cli.job
+'''
+
+from cli.arguments import add_argument
+from cli.jobs import fetch_job, wait_for_job
+
+def do_job(ns):
+    from cli.cli import output_print
+    job = wait_for_job(ns, ns.job_id) if ns.wait else fetch_job(ns, ns.job_id)
+    output_print(dict(job=job), ns.output)
+    return 0 if job['status'] != 'failed' else -1
+
+def add_parser(subparsers, api_config):
+    parser = subparsers.add_parser('job')
+    add_argument(parser, '--wait')
+    add_argument(parser, 'job_id')
+    parser.set_defaults(func=do_job)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+cli.jobs: fetch and wait on background jobs run by the api
+'''
+
+import time
+
+from cli import requests
+
+PENDING = ('queued', 'running')
+
+class FetchJobError(Exception):
+    def __init__(self, response):
+        message = f'response = {response.text}'
+        super(FetchJobError, self).__init__(message)
+
+def fetch_job(ns, job_id):
+    response = requests.get(ns.api_url / f'autocert/jobs/{job_id}')
+    if response.status_code == 200:
+        return response.json()['job']
+    raise FetchJobError(response)
+
+def wait_for_job(ns, job_id, interval=2):
+    job = fetch_job(ns, job_id)
+    while job['status'] in PENDING:
+        time.sleep(interval)
+        job = fetch_job(ns, job_id)
+    return job
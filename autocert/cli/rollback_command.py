@@ -0,0 +1,18 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+cli.rollback
+'''
+
+from cli.arguments import add_argument, get_destinations
+
+def add_parser(subparsers, api_config):
+    parser = subparsers.add_parser('rollback')
+    destinations = get_destinations(**api_config)
+    add_argument(parser, '-d', '--destinations',
+        required=False,
+        choices=destinations)
+    add_argument(parser, '-c', '--call-detail')
+    add_argument(parser, '-v', '--verbose')
+    add_argument(parser, '--job')
+    add_argument(parser, 'deploy_id')
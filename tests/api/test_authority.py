@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from urlpath import URL
+
+from authority.base import (
+    AuthorityBase,
+    JsonsDontMatchPathsError,
+    UnknownPairingError,
+    pair,
+    ZIP,
+    BROADCAST,
+    PRODUCT)
+
+class RecordingAsyncRequests(object):
+    def __init__(self):
+        self.sent = []
+
+    def requests(self, method, *kws):
+        self.sent += [(method, kw) for kw in kws]
+        return list(kws)
+
+@pytest.fixture
+def authority():
+    cfg = dict(baseurl=URL('https://authority.test/services/v2'), auth=['keyname', 'keypswd'])
+    return AuthorityBase(RecordingAsyncRequests(), cfg, 0)
+
+PATHS = ['request/1/status', 'request/2/status', 'request/3/status']
+JSONS = [dict(n=1), dict(n=2), dict(n=3)]
+
+def test_pair_zip():
+    assert pair(PATHS, JSONS, ZIP) == list(zip(PATHS, JSONS))
+
+def test_pair_zip_length_mismatch():
+    with pytest.raises(JsonsDontMatchPathsError):
+        pair(PATHS, JSONS[:2], ZIP)
+
+def test_pair_broadcast():
+    assert pair(PATHS, JSONS[:1], BROADCAST) == [(path, JSONS[0]) for path in PATHS]
+
+def test_pair_broadcast_requires_single_json():
+    with pytest.raises(JsonsDontMatchPathsError):
+        pair(PATHS, JSONS, BROADCAST)
+
+def test_pair_product():
+    assert len(pair(PATHS, JSONS, PRODUCT)) == len(PATHS) * len(JSONS)
+
+def test_pair_inferred():
+    assert pair(PATHS, JSONS[:1]) == pair(PATHS, JSONS[:1], BROADCAST)
+    assert pair(PATHS, JSONS) == pair(PATHS, JSONS, ZIP)
+
+def test_pair_unknown():
+    with pytest.raises(UnknownPairingError):
+        pair(PATHS, JSONS, 'bogus')
+
+def test_requests_makes_one_call_per_path(authority):
+    authority.puts(paths=PATHS, jsons=JSONS)
+    assert len(authority.ar.sent) == len(PATHS)
+    for (method, kw), path, json in zip(authority.ar.sent, PATHS, JSONS):
+        assert method == 'PUT'
+        assert kw['url'].endswith(path)
+        assert kw['json'] == json
+
+def test_requests_broadcast_body(authority):
+    authority.puts(paths=PATHS, jsons=[dict(status='approved')], pairing=BROADCAST)
+    assert len(authority.ar.sent) == len(PATHS)
+    assert all(kw['json'] == dict(status='approved') for _, kw in authority.ar.sent)
+
+def test_requests_windowed(authority):
+    class CountingAsyncRequests(RecordingAsyncRequests):
+        def __init__(self):
+            super(CountingAsyncRequests, self).__init__()
+            self.batches = []
+        def requests(self, method, *kws):
+            self.batches += [len(kws)]
+            return super(CountingAsyncRequests, self).requests(method, *kws)
+    authority.ar = CountingAsyncRequests()
+    authority.cfg['concurrency'] = 2
+    calls = authority.gets(paths=PATHS)
+    assert len(calls) == len(PATHS)
+    assert authority.ar.batches == [2, 1]
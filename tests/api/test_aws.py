@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from datetime import datetime, timedelta
+
+moto = pytest.importorskip('moto')
+boto3 = pytest.importorskip('boto3')
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from destination.aws import AwsDestination, REMOVED, split_pem
+from destination.base import UNCHANGED, UPDATED
+from destination.health import HealthMonitor
+from bundle import Bundle
+
+mock_aws = getattr(moto, 'mock_aws', None) or moto.mock_acm
+
+DESTS = ['usw2', 'use1']
+
+def self_signed(common_name):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.utcnow()
+    crt = x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(
+        key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+        now - timedelta(days=1)).not_valid_after(now + timedelta(days=90)).sign(key, hashes.SHA256(), default_backend())
+    return (
+        key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()).decode(),
+        crt.public_bytes(serialization.Encoding.PEM).decode())
+
+def bundle(common_name='www.example.com'):
+    key, crt = self_signed(common_name)
+    return Bundle(common_name, 'e8a7fcfbe48df21daede665d78984dec', key, None, crt, '1234567')
+
+@pytest.fixture
+def aws(monkeypatch):
+    for var in ('AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY', 'AWS_SECURITY_TOKEN', 'AWS_SESSION_TOKEN'):
+        monkeypatch.setenv(var, 'testing')
+    monkeypatch.setattr(AwsDestination, '_clients', {})
+    monkeypatch.setattr(HealthMonitor, '_entries', {})
+    with mock_aws():
+        yield AwsDestination(None, dict(usw2=dict(region='us-west-2'), use1=dict(region='us-east-1')), 0)
+
+def statuses(bundle):
+    return {dest: detail['status'] for dest, detail in bundle.destinations['aws'].items()}
+
+def test_split_pem():
+    certificate, chain = split_pem('-----BEGIN CERTIFICATE-----\na\n-----END CERTIFICATE-----\n-----BEGIN CERTIFICATE-----\nb\n-----END CERTIFICATE-----\n')
+    assert 'a' in certificate and 'b' not in certificate
+    assert 'b' in chain
+
+def test_has_connectivity(aws):
+    assert aws.has_connectivity(1, DESTS)
+
+def test_install_is_idempotent(aws):
+    b = bundle()
+    aws.install_certificates('bug 1234567', [b], DESTS)
+    assert statuses(b) == dict(usw2=UPDATED, use1=UPDATED)
+    again = bundle()
+    again.key, again.crt = b.key, b.crt
+    aws.install_certificates('bug 1234567', [again], DESTS)
+    assert statuses(again) == dict(usw2=UNCHANGED, use1=UNCHANGED)
+
+def test_renewal_reimports_over_the_same_arn(aws):
+    b = bundle()
+    aws.install_certificates('bug 1234567', [b], DESTS)
+    arn = b.destinations['aws']['usw2']['arn']
+    renewed = bundle()
+    aws.install_certificates('bug 1234567', [renewed], DESTS)
+    assert renewed.destinations['aws']['usw2']['arn'] == arn
+    fetched = aws.fetch_certificates([renewed], DESTS)[0]
+    assert fetched.destinations['aws']['usw2']['matched'] is True
+
+def test_remove(aws):
+    b = bundle()
+    aws.install_certificates('bug 1234567', [b], DESTS)
+    aws.remove_certificates([b], DESTS)
+    assert statuses(b) == dict(usw2=REMOVED, use1=REMOVED)
+    assert boto3.client('acm', region_name='us-west-2').list_certificates()['CertificateSummaryList'] == []
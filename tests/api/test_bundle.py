@@ -87,3 +87,17 @@ def test_json_roundtrip(bundle):
         destinations=destinations,
         timestamp=timestamp)
     assert bundle == bundle2
+
+def test_stage_and_promote(bundle, tmpdir):
+    bundle_path = str(tmpdir.mkdir('bundle_path'))
+    authority = dict(digicert=dict(order_id=1298369))
+    bundle.stage('renewed crt', EXPIRY, authority)
+    bundle.to_disk(bundle_path=bundle_path)
+    staged = Bundle.from_disk(bundle.bundle_name, bundle_path=bundle_path)
+    assert staged.crt == CRT
+    assert staged.pending['crt'] == 'renewed crt'
+    assert staged.promote()
+    assert staged.crt == 'renewed crt'
+    assert staged.authority == authority
+    assert staged.pending is None
+    assert not staged.promote()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import Cache
+
+def test_concurrent_updates_are_not_lost(tmpdir):
+    def bump(n):
+        for i in range(50):
+            with Cache('counter', str(tmpdir)).update() as entries:
+                entries[f'{n}-{i}'] = i
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(bump, range(4)))
+    assert len(Cache('counter', str(tmpdir)).load()) == 200
+    assert [name for name in os.listdir(str(tmpdir)) if name.endswith('.tmp')] == []
+
+def test_failed_update_saves_nothing(tmpdir):
+    cache = Cache('counter', str(tmpdir))
+    cache.save(dict(a=1))
+    try:
+        with cache.update() as entries:
+            entries['b'] = 2
+            raise ValueError
+    except ValueError:
+        pass
+    assert cache.load() == dict(a=1)
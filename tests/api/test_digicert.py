@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import zipfile
+import pytest
+
+from urlpath import URL
+from attrdict import AttrDict
+
+from authority.digicert import DigicertAuthority, DownloadCertificateError, unzip_certificates, error_code
+from cache import Cache
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+CRT = open(DIR+'/crt').read()
+
+ARCHIVE = 'certificate/download/format/{format_type}?certificate_ids={certificate_ids}'
+
+def zip_certificates(crts):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as zf:
+        for certificate_id, crt in crts.items():
+            zf.writestr(f'{certificate_id}.pem', crt)
+    return buf.getvalue()
+
+class StandInDigicert(object):
+    '''
+    stands in for AsyncRequests talking to digicert; serves an archive holding
+    the ids in archived and per certificate downloads for everything else
+    '''
+    def __init__(self, archived=None, issued=None):
+        self.archived = archived or []
+        self.issued = issued
+        self.urls = []
+
+    def requests(self, method, *kws):
+        calls = []
+        for kw in kws:
+            url = kw['url']
+            self.urls += [url]
+            if '/order/certificate/' in url:
+                order_id = int(url.split('/')[-1])
+                recv = dict(status=200, text='', json=dict(id=order_id, certificate=dict(id=order_id+1000)))
+            elif 'certificate_ids=' in url:
+                content = zip_certificates({certificate_id: CRT for certificate_id in self.archived})
+                recv = dict(status=200, text='', json={}, content=content)
+            else:
+                certificate_id = int(url.split('/')[-4])
+                issued = self.issued is None or certificate_id in self.issued
+                recv = dict(status=200 if issued else 404, text=CRT if issued else '', json={})
+            calls += [AttrDict(send=dict(method=method, url=url), recv=recv)]
+        return calls
+
+def digicert(ar, archive=ARCHIVE):
+    cfg = dict(baseurl=URL('https://digicert.test/services/v2'), auth=['keyname', 'keypswd'])
+    if archive:
+        cfg['archive'] = archive
+    return DigicertAuthority(ar, cfg, 0)
+
+def test_unzip_certificates():
+    crts = unzip_certificates(zip_certificates({11: CRT, 12: CRT}))
+    assert crts == {'11': CRT, '12': CRT}
+
+def test_download_uses_single_archive():
+    ar = StandInDigicert(archived=[11, 12, 13])
+    crts = digicert(ar)._download_certificates([11, 12, 13])
+    assert crts == [CRT] * 3
+    assert len(ar.urls) == 1
+
+def test_download_falls_back_for_missing():
+    ar = StandInDigicert(archived=[11])
+    crts = digicert(ar)._download_certificates([11, 12, 13])
+    assert crts == [CRT] * 3
+    assert len(ar.urls) == 3
+
+def test_download_without_archive_is_per_certificate():
+    ar = StandInDigicert()
+    crts = digicert(ar, archive=None)._download_certificates([11, 12])
+    assert crts == [CRT] * 2
+    assert not any('certificate_ids=' in url for url in ar.urls)
+
+def test_download_error():
+    ar = StandInDigicert(issued=[11])
+    with pytest.raises(DownloadCertificateError):
+        digicert(ar, archive=None)._download_certificates([11, 12])
+
+def test_order_detail_cache(tmpdir, monkeypatch):
+    monkeypatch.setattr(Cache, 'cache_path', str(tmpdir))
+    ar = StandInDigicert()
+    orders = [dict(id=1, status='issued'), dict(id=2, status='issued')]
+    details = digicert(ar)._get_certificate_order_detail_cached(orders)
+    assert [detail.id for detail in details] == [1, 2]
+    assert len(ar.urls) == 2
+    digicert(ar)._get_certificate_order_detail_cached(orders)
+    assert len(ar.urls) == 2
+    orders[1]['status'] = 'revoked'
+    details = digicert(ar)._get_certificate_order_detail_cached(orders)
+    assert [detail.id for detail in details] == [1, 2]
+    assert len(ar.urls) == 3
+
+class StandInDigicertOrders(object):
+    '''
+    stands in for AsyncRequests while ordering; orders for common names in
+    rejected fail, orders for common names in undetailed have no order detail
+    and everything else is issued straight away
+    '''
+    def __init__(self, rejected=None, undetailed=None):
+        self.rejected = rejected or []
+        self.undetailed = undetailed or []
+        self.common_names = {}
+        self.sends = []
+
+    def requests(self, method, *kws):
+        calls = []
+        for kw in kws:
+            url = kw['url']
+            self.sends += [(method, url)]
+            if method == 'POST':
+                common_name = kw['json']['certificate']['common_name']
+                order_id = 100 + len(self.sends)
+                self.common_names[order_id] = common_name
+                if common_name in self.rejected:
+                    recv = dict(status=400, text='', json=dict(errors=[dict(code='invalid', message='rejected')]))
+                else:
+                    recv = dict(status=201, text='', json=dict(id=order_id, requests=[dict(id=order_id+500)]))
+            elif method == 'PUT':
+                recv = dict(status=204, text='', json={})
+            elif '/order/certificate/' in url and self.common_names.get(int(url.split('/')[-1]), None) in self.undetailed:
+                recv = dict(status=404, text='', json=dict(errors=[dict(code='not_found', message='order not found')]))
+            elif '/order/certificate/' in url:
+                order_id = int(url.split('/')[-1])
+                recv = dict(status=200, text='', json=dict(id=order_id, certificate=dict(id=order_id+1000, valid_till='2027-01-01')))
+            else:
+                recv = dict(status=200, text=CRT, json={})
+            calls += [AttrDict(send=dict(method=method, url=url), recv=recv)]
+        return calls
+
+def test_create_certificates_reports_per_spec(monkeypatch):
+    ar = StandInDigicertOrders(rejected=['c.example.com'])
+    authority = digicert(ar, archive=None)
+    authority.cfg['template'] = {}
+    monkeypatch.setattr(authority, '_get_organization_container_ids', lambda name: (1, 2))
+    monkeypatch.setattr(authority, '_get_domains', lambda organization_id, container_id: [AttrDict(name='example.com')])
+    specs = [
+        dict(common_name='a.example.com', csr='csr', sans=[]),
+        dict(common_name='b.example.org', csr='csr', sans=[]),
+        dict(common_name='c.example.com', csr='csr', sans=[]),
+    ]
+    results = authority.create_certificates('org', specs, 1, '1234567')
+    assert results[0]['crt'] == CRT
+    assert 'digicert' in results[0]['authority']
+    assert 'b.example.org' in results[1]['error']
+    assert 'error' in results[2]
+    assert len([send for send in ar.sends if send[0] == 'POST']) == 2
+
+class StandInDigicertRevocations(object):
+    '''
+    stands in for AsyncRequests while revoking; order ids in missing have no
+    detail, certificate ids in refused can't be revoked and request ids in
+    unapproved get an html 502 when approved
+    '''
+    def __init__(self, missing=None, refused=None, unapproved=None):
+        self.missing = missing or []
+        self.refused = refused or []
+        self.unapproved = unapproved or []
+        self.batches = []
+
+    def requests(self, method, *kws):
+        self.batches += [(method, len(kws))]
+        calls = []
+        for kw in kws:
+            url = kw['url']
+            parts = url.split('/')
+            if method == 'GET':
+                order_id = int(parts[-1])
+                found = order_id not in self.missing
+                recv = dict(status=200 if found else 404, text='', json=dict(certificate=dict(id=order_id+1000)) if found else dict(errors=[dict(message='not found')]))
+            elif url.endswith('/revoke'):
+                certificate_id = int(parts[-2])
+                refused = certificate_id in self.refused
+                recv = dict(status=400 if refused else 201, text='', json=dict(errors=[dict(code='refused')]) if refused else dict(id=certificate_id+1000))
+            elif int(parts[-2]) in self.unapproved:
+                recv = dict(status=502, text='<html>bad gateway</html>', json=None)
+            else:
+                recv = dict(status=204, text='', json={})
+            calls += [AttrDict(send=dict(method=method, url=url), recv=recv)]
+        return calls
+
+class StandInRevokedBundle(object):
+    def __init__(self, order_id):
+        self.bundle_name = f'b{order_id}'
+        self.authority = dict(digicert=dict(order_id=order_id))
+
+def test_create_certificates_missing_detail_fails_only_its_spec(monkeypatch):
+    ar = StandInDigicertOrders(undetailed=['b.example.com'])
+    authority = digicert(ar, archive=None)
+    authority.cfg['template'] = {}
+    monkeypatch.setattr(authority, '_get_organization_container_ids', lambda name: (1, 2))
+    monkeypatch.setattr(authority, '_get_domains', lambda organization_id, container_id: [AttrDict(name='example.com')])
+    specs = [dict(common_name=f'{name}.example.com', csr='csr', sans=[]) for name in 'abc']
+    results = authority.create_certificates('org', specs, 1, '1234567')
+    assert results[0]['crt'] == CRT and results[2]['crt'] == CRT
+    assert results[1]['error'] == 'order not found'
+    assert results[1]['order_id']
+
+def test_revoke_windows_report_per_bundle():
+    ar = StandInDigicertRevocations(missing=[2], refused=[1004])
+    authority = digicert(ar, archive=None)
+    authority.cfg['concurrency'] = 3
+    persisted = []
+    bundles = [StandInRevokedBundle(order_id) for order_id in range(1, 6)]
+    revoked, errors = authority.revoke_certificates(bundles, '1234567', persist=lambda done: persisted.append([b.bundle_name for b in done]))
+    assert [bundle.bundle_name for bundle in revoked] == ['b1', 'b3', 'b5']
+    assert sorted(errors.keys()) == ['b2', 'b4']
+    assert persisted == [['b1', 'b3'], ['b5']]
+    assert max(count for method, count in ar.batches) <= 3
+
+def test_error_code():
+    assert error_code(AttrDict(recv=dict(status=400, json=dict(errors=[dict(code='request_already_processed')])))) == 'request_already_processed'
+    assert error_code(AttrDict(recv=dict(status=400, json=dict(errors=[])))) is None
+    assert error_code(AttrDict(recv=dict(status=502, json=None))) is None
+
+def test_revoke_approval_without_errors_field():
+    ar = StandInDigicertRevocations(unapproved=[2003])
+    authority = digicert(ar, archive=None)
+    bundles = [StandInRevokedBundle(order_id) for order_id in range(1, 4)]
+    revoked, errors = authority.revoke_certificates(bundles, '1234567', persist=lambda done: None)
+    assert [bundle.bundle_name for bundle in revoked] == ['b1', 'b2']
+    assert list(errors.keys()) == ['b3']
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+
+from destination.health import HealthMonitor
+from destination.base import DestinationBase, DestinationConnectivityError
+
+class StandInDestination(DestinationBase):
+    name = 'standin'
+
+    def __init__(self, unreachable=None):
+        super(StandInDestination, self).__init__(None, {}, 0)
+        self.unreachable = unreachable or []
+        self.probes = []
+
+    def has_connectivity(self, timeout, dests):
+        self.probes += [list(dests)]
+        failed = [dest for dest in dests if dest in self.unreachable]
+        if failed:
+            raise DestinationConnectivityError([(dest, TimeoutError()) for dest in failed])
+        return True
+
+@pytest.fixture
+def monitor(monkeypatch):
+    monkeypatch.setattr(HealthMonitor, '_entries', {})
+    monitor = HealthMonitor()
+    monitor.ttl = 60
+    return monitor
+
+def test_probe_finds_unreachable_dest(monitor):
+    destination = StandInDestination(unreachable=['tm2'])
+    results = monitor.probe('standin', destination, ['tm1', 'tm2'])
+    assert results['tm1'] is None
+    assert 'TimeoutError' in results['tm2']
+    assert destination.probes == [['tm1', 'tm2'], ['tm1'], ['tm2']]
+
+def test_refresh_only_probes_stale(monitor):
+    destination = StandInDestination()
+    monitor.refresh('standin', destination, ['tm1'])
+    monitor.refresh('standin', destination, ['tm1', 'tm2'])
+    assert destination.probes == [['tm1'], ['tm2']]
+    HealthMonitor._entries[('standin', 'tm1')]['checked'] = time.time() - 120
+    monitor.refresh('standin', destination, ['tm1', 'tm2'])
+    assert destination.probes[-1] == ['tm1']
+
+def test_require_connectivity(monitor):
+    destination = StandInDestination(unreachable=['tm2'])
+    monitor.probe('standin', destination, ['tm1', 'tm2'])
+    destination.require_connectivity(['tm1'])
+    with pytest.raises(DestinationConnectivityError):
+        destination.require_connectivity(['tm1', 'tm2'])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import sqlite3
+import subprocess
+import pytest
+
+from jobs import JobQueue, JobNotFoundError, QUEUED, RUNNING, DONE, FAILED
+
+ARGS = dict(command='renew', bundle_name_pns=['common.name*'], job='detach')
+
+@pytest.fixture
+def queue(tmpdir):
+    return JobQueue(jobs_path=str(tmpdir.join('jobs.db')))
+
+def test_submit_and_get(queue):
+    job_id = queue.submit('PUT', None, ARGS)
+    job = queue.get(job_id)
+    assert job['status'] == QUEUED
+    assert job['command'] == 'renew'
+    assert 'result' not in job
+
+def test_get_unknown(queue):
+    with pytest.raises(JobNotFoundError):
+        queue.get('missing')
+
+def test_claim_is_fifo_and_exclusive(queue):
+    first = queue.submit('PUT', None, ARGS)
+    second = queue.submit('PUT', None, ARGS)
+    assert queue.claim()['id'] == first
+    assert queue.claim()['id'] == second
+    assert queue.claim() is None
+    assert queue.get(first)['status'] == RUNNING
+
+def test_progress_and_finish(queue):
+    job_id = queue.submit('PUT', None, ARGS)
+    queue.claim()
+    queue.progress(job_id, 'renewing 1 bundle(s)')
+    queue.finish(job_id, DONE, dict(count=1), 201)
+    job = queue.get(job_id)
+    assert job['status'] == DONE
+    assert job['progress'][0].endswith('renewing 1 bundle(s)')
+    assert job['result'] == dict(count=1)
+    assert job['http_status'] == 201
+
+def test_orphans_are_requeued_only_when_idempotent(queue):
+    renew = queue.submit('PUT', None, ARGS)
+    deploy = queue.submit('PUT', None, dict(ARGS, command='deploy'))
+    queue.claim()
+    queue.claim()
+    process = subprocess.Popen(['true'])
+    process.wait()
+    db = sqlite3.connect(queue.filename, isolation_level=None)
+    db.execute('update jobs set pid = ?', (process.pid,))
+    db.close()
+    queue.requeue_orphans()
+    job = queue.get(renew)
+    assert job['status'] == FAILED
+    assert 'OrphanedJobError' in job['result']['errors']
+    assert queue.get(deploy)['status'] == QUEUED
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import threading
+import pytest
+
+from endpoint.base import Lazy
+
+class StandIn(object):
+    def __init__(self, name, ar, cfg):
+        self.name = name
+        self.ar = ar
+        self.cfg = cfg
+
+@pytest.fixture
+def built(monkeypatch):
+    monkeypatch.setattr(Lazy, '_local', threading.local())
+    built = []
+    def build(name, ar, cfg):
+        built.append(name)
+        return StandIn(name, ar, cfg)
+    return built, build
+
+def test_built_on_first_access(built):
+    built, build = built
+    lazy = Lazy('standins', dict(digicert=dict(url='a'), letsencrypt=dict(url='b')), 'ar1', 0, build)
+    assert built == []
+    assert lazy.digicert is lazy['digicert']
+    assert built == ['digicert']
+    with pytest.raises(KeyError):
+        lazy['missing']
+    with pytest.raises(AttributeError):
+        lazy.missing
+
+def test_reused_and_rebound(built):
+    built, build = built
+    cfgs = dict(zeus=dict(url='a'))
+    first = Lazy('standins', cfgs, 'ar1', 0, build).zeus
+    second = Lazy('standins', cfgs, 'ar2', 1, build).zeus
+    assert first is second
+    assert second.ar == 'ar2' and second.verbosity == 1
+    assert built == ['zeus']
+    Lazy('standins', dict(zeus=dict(url='changed')), 'ar3', 0, build).zeus
+    assert built == ['zeus', 'zeus']
+
+def test_per_thread(built):
+    built, build = built
+    cfgs = dict(zeus=dict(url='a'))
+    Lazy('standins', cfgs, 'ar1', 0, build).zeus
+    thread = threading.Thread(target=lambda: Lazy('standins', cfgs, 'ar2', 0, build).zeus)
+    thread.start()
+    thread.join()
+    assert built == ['zeus', 'zeus']
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import pytest
+
+from base64 import urlsafe_b64decode
+from urlpath import URL
+from attrdict import AttrDict
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+
+from authority.letsencrypt import AcmeAccount, AcmeTimeoutError, LetsEncryptAuthority, b64, csr_domains
+
+# run against pebble with eg. PEBBLE_VA_ALWAYS_VALID=1 pebble and
+# AC_PEBBLE_DIRECTORY=https://localhost:14000/dir
+PEBBLE_DIRECTORY = os.environ.get('AC_PEBBLE_DIRECTORY', None)
+
+def unb64(data):
+    return urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def create_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+
+def create_csr(key, common_name, sans=None):
+    builder = x509.CertificateSigningRequestBuilder().subject_name(x509.Name([
+        x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+    if sans:
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName([x509.DNSName(san) for san in sans]),
+            critical=False)
+    csr = builder.sign(key, hashes.SHA256(), default_backend())
+    return csr.public_bytes(serialization.Encoding.PEM).decode('utf-8')
+
+class StandInLetsEncrypt(LetsEncryptAuthority):
+    '''
+    one order with one pending http-01 authorization that never turns valid
+    '''
+    account = AttrDict(thumbprint='thumbprint')
+
+    def __init__(self, challenge_path):
+        self.cfg = AttrDict(baseurl='https://acme.example.com/dir', challenge_path=challenge_path)
+        self.polls = 0
+
+    def _new_orders(self, account, csrs):
+        return ['order'], [AttrDict(authorizations=['authz'])]
+
+    def poll(self, account, urls, done, failed=None):
+        self.polls += 1
+        if self.polls == 1:
+            return [AttrDict(status='pending', challenges=[dict(type='http-01', token='token', url='challenge')])]
+        raise AcmeTimeoutError(urls)
+
+    def signed_posts(self, account, urls, payloads, retries=2):
+        return [AttrDict(recv=dict(status=200)) for url in urls]
+
+@pytest.fixture(scope='module')
+def account():
+    return AcmeAccount(create_key())
+
+def test_b64_is_unpadded():
+    assert b64(b'\xff') == '_w'
+
+def test_sign_with_jwk(account):
+    jws = json.loads(account.sign('https://acme.test/new-acct', 'NONCE', dict(termsOfServiceAgreed=True)))
+    protected = json.loads(unb64(jws['protected']))
+    assert protected == dict(alg='RS256', nonce='NONCE', url='https://acme.test/new-acct', jwk=account.jwk)
+    assert json.loads(unb64(jws['payload'])) == dict(termsOfServiceAgreed=True)
+    account.key.public_key().verify(
+        unb64(jws['signature']),
+        '{protected}.{payload}'.format(**jws).encode('utf-8'),
+        padding.PKCS1v15(),
+        hashes.SHA256())
+
+def test_sign_post_as_get_with_kid(account):
+    account.kid = 'https://acme.test/acct/1'
+    jws = json.loads(account.sign('https://acme.test/authz/1', 'NONCE', None))
+    protected = json.loads(unb64(jws['protected']))
+    assert protected['kid'] == account.kid
+    assert 'jwk' not in protected
+    assert jws['payload'] == ''
+    account.kid = None
+
+def test_take_nonces_hands_each_out_once(monkeypatch):
+    monkeypatch.setattr(LetsEncryptAuthority, '_nonces', {})
+    authority = StandInLetsEncrypt('unused')
+    authority.nonces.extend(str(n) for n in range(100))
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        taken = list(executor.map(lambda _: authority.take_nonces(25), range(4)))
+    assert sorted(nonce for nonces in taken for nonce in nonces) == sorted(str(n) for n in range(100))
+
+def test_failed_poll_removes_challenge_responses(tmpdir):
+    authority = StandInLetsEncrypt(str(tmpdir))
+    with pytest.raises(AcmeTimeoutError):
+        authority._create_certificates(['csr'])
+    assert authority.polls == 2
+    assert os.listdir(str(tmpdir)) == []
+
+def test_csr_domains():
+    csr = create_csr(create_key(), 'www.mozilla.org', sans=['www.mozilla.org', 'mozilla.org'])
+    assert csr_domains(csr) == ['www.mozilla.org', 'mozilla.org']
+
+@pytest.mark.skipif(not PEBBLE_DIRECTORY, reason='set AC_PEBBLE_DIRECTORY to run against pebble')
+def test_create_against_pebble(tmpdir):
+    from utils.asyncrequests import AsyncRequests
+    cfg = dict(
+        baseurl=URL(PEBBLE_DIRECTORY),
+        account_key_path=str(tmpdir.join('account.key')),
+        challenge_path=str(tmpdir.mkdir('acme-challenge')),
+        verify_ssl=False,
+        poll_interval=0.5)
+    authority = LetsEncryptAuthority(AsyncRequests(), cfg, 0)
+    csrs = [create_csr(create_key(), f'host{n}.autocert.test') for n in range(3)]
+    crts, expiries, authorities = authority._create_certificates(csrs)
+    assert len(crts) == len(expiries) == len(authorities) == 3
+    assert all(crt.startswith('-----BEGIN CERTIFICATE-----') for crt in crts)
+    assert all('certificate_url' in a['letsencrypt'] for a in authorities)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import pytest
+import tempfile
+
+from destination.pemdir import PemDirDestination, REMOVED
+from destination.base import UNCHANGED, UPDATED, FAILED
+from destination.health import HealthMonitor
+from bundle import Bundle
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+KEY = open(DIR+'/key').read()
+CSR = open(DIR+'/csr').read()
+CRT = open(DIR+'/crt').read()
+
+def bundle(common_name):
+    return Bundle(common_name, 'e8a7fcfbe48df21daede665d78984dec', KEY, CSR, CRT, '0000000')
+
+@pytest.fixture
+def pemdir(tmpdir, monkeypatch):
+    monkeypatch.setattr(HealthMonitor, '_entries', {})
+    certs = tmpdir.mkdir('certs')
+    reloads = tmpdir.join('reloads')
+    cfg = dict(nginx=dict(path=str(certs), reload=f"sh -c 'echo reload >> {reloads}'"))
+    return PemDirDestination(None, cfg, 0), certs, reloads
+
+def reload_count(reloads):
+    return len(reloads.readlines()) if reloads.exists() else 0
+
+def test_install_writes_and_reloads_once(pemdir):
+    destination, certs, reloads = pemdir
+    bundles = destination.install_certificates('bug 1234567', [bundle('a.example.com'), bundle('b.example.com')], ['nginx'])
+    assert {b.destinations['pemdir']['nginx']['status'] for b in bundles} == {UPDATED}
+    assert certs.join('a.example.com.crt').read() == CRT
+    assert certs.join('b.example.com.key').read() == KEY
+    assert stat.S_IMODE(os.stat(str(certs.join('a.example.com.key'))).st_mode) == 0o600
+    assert reload_count(reloads) == 1
+    assert [name for name in os.listdir(str(certs)) if name.endswith('.tmp')] == []
+
+def test_failed_write_keeps_the_old_pair(pemdir, monkeypatch):
+    destination, certs, reloads = pemdir
+    certs.join('a.example.com.key').write('old key')
+    certs.join('a.example.com.crt').write('old crt')
+    mkstemp = tempfile.mkstemp
+    def full_disk(prefix=None, **kwargs):
+        if prefix.endswith('.crt.'):
+            raise OSError('disk full')
+        return mkstemp(prefix=prefix, **kwargs)
+    monkeypatch.setattr(tempfile, 'mkstemp', full_disk)
+    bundles = destination.install_certificates('bug 1234567', [bundle('a.example.com')], ['nginx'])
+    assert bundles[0].destinations['pemdir']['nginx']['status'] == FAILED
+    assert certs.join('a.example.com.key').read() == 'old key'
+    assert certs.join('a.example.com.crt').read() == 'old crt'
+    assert sorted(os.listdir(str(certs))) == ['a.example.com.crt', 'a.example.com.key']
+    assert reload_count(reloads) == 0
+
+def test_unchanged_skips_write_and_reload(pemdir):
+    destination, certs, reloads = pemdir
+    destination.install_certificates('bug 1234567', [bundle('a.example.com')], ['nginx'])
+    bundles = destination.install_certificates('bug 1234567', [bundle('a.example.com')], ['nginx'])
+    assert bundles[0].destinations['pemdir']['nginx']['status'] == UNCHANGED
+    assert reload_count(reloads) == 1
+
+def test_fetch_matches_by_fingerprint(pemdir):
+    destination, certs, reloads = pemdir
+    certs.join('a.example.com.crt').write('missing')
+    assert destination.fetch_certificates([bundle('a.example.com')], ['nginx'])[0].destinations['pemdir']['nginx']['matched'] is False
+    destination.install_certificates('bug 1234567', [bundle('a.example.com')], ['nginx'])
+    assert destination.fetch_certificates([bundle('a.example.com')], ['nginx'])[0].destinations['pemdir']['nginx']['matched'] is True
+
+def test_failed_reload_fails_the_batch(pemdir):
+    _, certs, reloads = pemdir
+    destination = PemDirDestination(None, dict(nginx=dict(path=str(certs), reload='false')), 0)
+    bundles = destination.install_certificates('bug 1234567', [bundle('a.example.com'), bundle('b.example.com')], ['nginx'])
+    assert {b.destinations['pemdir']['nginx']['status'] for b in bundles} == {FAILED}
+    assert set(destination.failures(bundles, ['nginx']).keys()) == {b.bundle_name for b in bundles}
+
+def test_remove(pemdir):
+    destination, certs, reloads = pemdir
+    destination.install_certificates('bug 1234567', [bundle('a.example.com')], ['nginx'])
+    bundles = destination.remove_certificates([bundle('a.example.com')], ['nginx'])
+    assert bundles[0].destinations['pemdir']['nginx']['status'] == REMOVED
+    assert os.listdir(str(certs)) == []
+    assert reload_count(reloads) == 2
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from attrdict import AttrDict
+
+import pipeline
+from pipeline import RenewalPipeline, PolicyRenewalError, RENEWED, FAILED, RENEW, WRITE, DEPLOY
+from rollout import DEPLOYED
+from authority.digicert import OrderCertificateError
+from config import CFG
+
+class StandInBundle(object):
+    def __init__(self, bundle_name, unwritable=False):
+        self.bundle_name = bundle_name
+        self.unwritable = unwritable
+        self.written = False
+
+    def to_disk(self):
+        if self.unwritable:
+            raise IOError('disk full')
+        self.written = True
+
+class StandInAsyncRequests(object):
+    def __init__(self):
+        self.calls = []
+
+class StandInAuthority(object):
+    '''
+    fails the order of every bundle named in rejected and fails the download,
+    after ordering, of every bundle named in undownloaded
+    '''
+    def __init__(self, rejected, undownloaded):
+        self.rejected = rejected
+        self.undownloaded = undownloaded
+        self.chunks = []
+
+    def renew_certificates_results(self, bundles, *args):
+        self.chunks += [[bundle.bundle_name for bundle in bundles]]
+        results = []
+        for bundle in bundles:
+            order_id = int(bundle.bundle_name[1:]) + 100
+            if bundle.bundle_name in self.rejected:
+                results += [dict(error=OrderCertificateError(AttrDict(recv=dict(status=400))).message)]
+            elif bundle.bundle_name in self.undownloaded:
+                results += [dict(error='download failed', order_id=order_id)]
+            else:
+                results += [dict(crt='crt', expiry='expiry', authority=dict(digicert=dict(order_id=order_id)))]
+        return results
+
+class StandInRollout(object):
+    '''
+    fails every bundle named in rejected on tm2
+    '''
+    deploy_id = 'ab' * 16
+
+    def __init__(self, rejected):
+        self.rejected = rejected
+        self.runs = []
+
+    def run(self, note, bundles, destinations):
+        self.runs += [[bundle.bundle_name for bundle in bundles]]
+        rejected = {bundle.bundle_name: 500 for bundle in bundles if bundle.bundle_name in self.rejected}
+        outcomes = dict(zeus=dict(
+            tm1=dict(status=DEPLOYED),
+            tm2=dict(status=FAILED, errors=rejected) if rejected else dict(status=DEPLOYED)))
+        return bundles, outcomes, []
+
+@pytest.fixture
+def authority(monkeypatch):
+    authority = StandInAuthority(rejected=['b3'], undownloaded=['b5'])
+    monkeypatch.setattr(pipeline, 'AsyncRequests', StandInAsyncRequests)
+    monkeypatch.setattr(pipeline, 'create_authority', lambda *args: authority)
+    monkeypatch.setitem(CFG, 'renew', dict(chunk_size=2, in_flight=2))
+    return authority
+
+def run(bundles, destinations=None, authority='digicert'):
+    cfg = dict(authorities=dict(digicert={}), destinations={})
+    args = dict(authority=authority, organization_name='org', validity_years=1, bug='1234567',
+        sans=[], repeat_delta=None, whois_check=False, verbosity=0, destinations=destinations)
+    return RenewalPipeline(cfg, args).run(bundles)
+
+def test_orders_fail_independently(authority):
+    bundles = [StandInBundle(f'b{n}') for n in range(6)]
+    renewed, outcomes, calls = run(bundles)
+    assert sorted(len(chunk) for chunk in authority.chunks) == [2, 2, 2]
+    assert sorted(bundle.bundle_name for bundle in renewed) == ['b0', 'b1', 'b2', 'b4']
+    assert outcomes['b0'] == dict(status=RENEWED, stage=WRITE, order_id=100)
+    assert outcomes['b3']['status'] == FAILED and outcomes['b3']['stage'] == RENEW
+    assert 'order_id' not in outcomes['b3']
+
+def test_failed_downloads_keep_their_order_id(authority):
+    bundles = [StandInBundle('b4'), StandInBundle('b5')]
+    renewed, outcomes, calls = run(bundles)
+    assert [bundle.bundle_name for bundle in renewed] == ['b4']
+    assert outcomes['b5'] == dict(status=FAILED, stage=RENEW, error='download failed', order_id=105)
+    assert not bundles[1].written
+
+def test_policy_is_rejected(authority):
+    with pytest.raises(PolicyRenewalError):
+        run([StandInBundle('b0')], authority='policy')
+
+def test_write_failure_is_per_bundle(authority):
+    bundles = [StandInBundle('b0'), StandInBundle('b1', unwritable=True)]
+    renewed, outcomes, calls = run(bundles)
+    assert [bundle.bundle_name for bundle in renewed] == ['b0']
+    assert outcomes['b1'] == dict(status=FAILED, stage=WRITE, error='disk full', order_id=101)
+
+def test_deploy_goes_through_rolling_deploy(authority, monkeypatch):
+    rollout = StandInRollout(rejected=['b1'])
+    monkeypatch.setattr(pipeline, 'RollingDeploy', lambda *args, **kwargs: rollout)
+    bundles = [StandInBundle('b0'), StandInBundle('b1')]
+    renewed, outcomes, calls = run(bundles, destinations=dict(zeus=['tm1', 'tm2']))
+    assert rollout.runs == [['b0', 'b1']]
+    assert [bundle.bundle_name for bundle in renewed] == ['b0']
+    assert outcomes['b0'] == dict(status=RENEWED, stage=DEPLOY, deploy_id=rollout.deploy_id, order_id=100)
+    assert outcomes['b1']['status'] == FAILED and outcomes['b1']['deploy_id'] == rollout.deploy_id
+    assert 'tm2' in outcomes['b1']['error']
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import pytest
+
+from authority import policy
+from authority.policy import AuthorityPolicy, AuthorityMetrics, AllAuthoritiesFailedError, RACE
+from exceptions import AutocertError
+
+class StandInAsyncRequests(object):
+    def __init__(self):
+        self.calls = []
+
+class StandInAuthority(object):
+    def __init__(self, name, delay=0, fails=False, crashes=False):
+        self.name = name
+        self.delay = delay
+        self.fails = fails
+        self.crashes = crashes
+
+    def create_certificate(self, organization_name, common_name, *args, **kwargs):
+        time.sleep(self.delay)
+        if self.fails:
+            raise AutocertError(f'{self.name} failed')
+        if self.crashes:
+            None.recv
+        return 'crt', 'expiry', {self.name: {}}
+
+@pytest.fixture
+def authorities(monkeypatch):
+    authorities = dict(
+        primary=StandInAuthority('primary'),
+        secondary=StandInAuthority('secondary'))
+    monkeypatch.setattr(policy, 'AsyncRequests', StandInAsyncRequests)
+    monkeypatch.setattr(policy, 'create_authority', lambda name, ar, cfg, verbosity: authorities[name])
+    monkeypatch.setattr(AuthorityMetrics, '_metrics', {})
+    return authorities
+
+def create(cfg):
+    authority_policy = AuthorityPolicy(cfg, dict(primary={}, secondary={}), 0)
+    return authority_policy.create_certificate('org', 'www.example.com', 1, 'csr', '1234567')
+
+def test_failover_uses_secondary(authorities):
+    authorities['primary'].fails = True
+    crt, expiry, authority = create(dict(order=['primary', 'secondary']))
+    assert list(authority.keys()) == ['secondary']
+    assert AuthorityMetrics.get('primary').metrics['errors'] == 1
+
+def test_failover_on_unexpected_error(authorities):
+    authorities['primary'].crashes = True
+    crt, expiry, authority = create(dict(order=['primary', 'secondary']))
+    assert list(authority.keys()) == ['secondary']
+    assert AuthorityMetrics.get('primary').metrics['errors'] == 1
+
+def test_unhealthy_authority_goes_last(authorities):
+    for _ in range(3):
+        AuthorityMetrics.record('primary', 1.0, False)
+    policy = AuthorityPolicy(dict(order=['primary', 'secondary']), {}, 0)
+    assert policy.rank() == ['secondary', 'primary']
+
+def test_hedge_after_slow_primary(authorities):
+    authorities['primary'].delay = 2
+    crt, expiry, authority = create(dict(order=['primary', 'secondary'], hedge_after=0.1))
+    assert list(authority.keys()) == ['secondary']
+
+def test_ev_is_not_hedged(authorities):
+    authorities['primary'].delay = 0.5
+    crt, expiry, authority = create(dict(order=['primary', 'secondary'], hedge_after=0.1, ev=['*.example.com']))
+    assert list(authority.keys()) == ['primary']
+
+def test_race_keeps_first(authorities):
+    authorities['primary'].delay = 2
+    crt, expiry, authority = create(dict(mode=RACE, order=['primary', 'secondary']))
+    assert list(authority.keys()) == ['secondary']
+
+def test_race_loser_is_abandoned(authorities):
+    authorities['primary'].delay = 0.2
+    authority_policy = AuthorityPolicy(dict(mode=RACE, order=['primary', 'secondary']), dict(primary={}, secondary={}), 0)
+    crt, expiry, authority = authority_policy.create_certificate('org', 'www.example.com', 1, 'csr', '1234567')
+    assert list(authority.keys()) == ['secondary']
+    assert authority_policy.abandoned == []
+    time.sleep(0.5)
+    assert authority_policy.abandoned == [dict(common_name='www.example.com', authority=dict(primary={}))]
+
+def test_all_fail(authorities):
+    authorities['primary'].fails = True
+    authorities['secondary'].fails = True
+    with pytest.raises(AllAuthoritiesFailedError):
+        create(dict(order=['primary', 'secondary']))
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from datetime import datetime, timedelta
+
+from attrdict import AttrDict
+
+from endpoint.query import OrderFilter, QueryEndpoint, compile_patterns, literal_prefix
+
+NOW = datetime(2020, 1, 1, 12)
+
+def order(status='issued', dns_names=None, days=10):
+    dns_names = dns_names if dns_names else ['www.mozilla.org']
+    return dict(
+        status=status,
+        certificate=dict(
+            common_name=dns_names[0],
+            dns_names=dns_names,
+            valid_till=(NOW + timedelta(days)).strftime('%Y-%m-%d')))
+
+def test_compile_patterns():
+    regex = compile_patterns(['*.mozilla.org', 'mozilla.com'])
+    assert regex.match('www.mozilla.org')
+    assert regex.match('mozilla.com')
+    assert not regex.match('www.mozilla.com')
+
+def test_literal_prefix():
+    assert literal_prefix('www.*.org') == 'www.'
+    assert literal_prefix('*.mozilla.org') == ''
+    assert literal_prefix('mozilla.org') == 'mozilla.org'
+
+def test_filter_domains():
+    orders = [order(), order(dns_names=['www.example.com']), order(dns_names=['example.com', 'a.mozilla.org'])]
+    assert OrderFilter(['*.mozilla.org'], ['issued'])(orders) == [orders[0], orders[2]]
+
+def test_filter_statuses():
+    orders = [order(), order(status='pending'), order(status='revoked')]
+    assert OrderFilter('*', ['issued', 'pending'])(orders) == orders[:2]
+
+def test_filter_within():
+    orders = [order(days=-1), order(days=0), order(days=1), order(days=29), order(days=30), order(days=31)]
+    assert OrderFilter('*', ['issued'], within=30, now=NOW)(orders) == orders[2:5]
+
+def test_filter_skips_malformed():
+    orders = [dict(status='issued'), dict(certificate=dict(dns_names=['www.mozilla.org'])), order()]
+    assert OrderFilter('*', ['issued'], within=30, now=NOW)(orders) == orders[2:]
+
+def test_filter_san_only_match():
+    orders = [order(dns_names=['example.com', 'a.mozilla.org'])]
+    assert OrderFilter(['a.mozilla.org'], ['issued'])(orders) == orders
+    assert OrderFilter(['a.mozilla.org'], ['issued'], common_name_only=True)(orders) == []
+
+def server_filters(**args):
+    endpoint = QueryEndpoint.__new__(QueryEndpoint)
+    endpoint.args = AttrDict(dict(dict(status=['issued'], within=None, domain_name_pns=['a.mozilla.*']), **args))
+    return endpoint.server_filters()
+
+def test_search_only_for_common_name_only():
+    assert 'search' not in server_filters()
+    assert server_filters(common_name_only=True)['search'] == 'a.mozilla.'
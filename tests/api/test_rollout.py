@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+import pytest
+
+import rollout
+from rollout import RollingDeploy, DEPLOYED, FAILED, SKIPPED
+from destination.base import DestinationBase, UPDATED
+from destination.base import FAILED as DEST_FAILED
+
+class StandInAsyncRequests(object):
+    def __init__(self):
+        self.calls = []
+
+class StandInBundle(object):
+    def __init__(self, bundle_name):
+        self.bundle_name = bundle_name
+        self.destinations = {}
+
+class StandInDestination(DestinationBase):
+    name = 'standin'
+
+    def __init__(self, fleet):
+        super(StandInDestination, self).__init__(None, {}, 0)
+        self.fleet = fleet
+
+    def plan_certificates(self, bundles, dests):
+        return [dict(bundle_name=bundle.bundle_name, dest=dest) for bundle in bundles for dest in dests if dest != 'tm0']
+
+    def install_certificates(self, note, bundles, dests, plan=None, deploy_id=None):
+        fleet = self.fleet
+        fleet.plans[dests[0]] = plan
+        with fleet.lock:
+            fleet.active += 1
+            fleet.peak = max(fleet.peak, fleet.active)
+        time.sleep(0.05)
+        with fleet.lock:
+            fleet.active -= 1
+            fleet.installed += list(dests)
+        for bundle in bundles:
+            status = DEST_FAILED if dests[0] in fleet.failing else UPDATED
+            bundle.destinations[self.name] = {dests[0]: dict(status=status, error=500)}
+        return bundles
+
+class Fleet(object):
+    def __init__(self, failing=None):
+        self.failing = failing or []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.installed = []
+        self.plans = {}
+
+@pytest.fixture
+def fleet(monkeypatch):
+    fleet = Fleet()
+    monkeypatch.setattr(rollout, 'AsyncRequests', StandInAsyncRequests)
+    monkeypatch.setattr(rollout, 'create_destination', lambda name, ar, cfg, timeout, verbosity: StandInDestination(fleet))
+    return fleet
+
+DESTS = [f'tm{number}' for number in range(6)]
+
+def rolling_deploy(dests=DESTS):
+    cfg = dict(destinations=dict(standin={dest: {} for dest in dests}))
+    args = dict(timeout=1, verbosity=0)
+    return RollingDeploy(cfg, args)
+
+def deploy(wave_size=2, per_destination=2, concurrency=8, stop_on_failure=True, dests=DESTS, plan=None):
+    rolling = rolling_deploy(dests)
+    rolling.wave_size = wave_size
+    rolling.per_destination = per_destination
+    rolling.stop_on_failure = stop_on_failure
+    rolling.slots = threading.BoundedSemaphore(concurrency)
+    bundles = [StandInBundle('a'), StandInBundle('b')]
+    return rolling.run('bug 1234567', bundles, dict(standin=dests), plan=plan)
+
+def test_every_dest_deployed(fleet):
+    bundles, outcomes, calls = deploy()
+    assert {outcome['status'] for outcome in outcomes['standin'].values()} == {DEPLOYED}
+    assert sorted(bundles[0].destinations['standin'].keys()) == sorted(fleet.installed)
+    assert fleet.peak <= 2
+
+def test_global_concurrency(fleet):
+    deploy(wave_size=6, per_destination=6, concurrency=3)
+    assert fleet.peak <= 3
+
+def test_stop_on_first_failure(fleet):
+    fleet.failing = ['tm1']
+    bundles, outcomes, calls = deploy()
+    assert outcomes['standin']['tm1'] == dict(status=FAILED, errors=dict(a=500, b=500))
+    assert outcomes['standin']['tm0']['status'] == DEPLOYED
+    assert {outcomes['standin'][dest]['status'] for dest in ['tm2', 'tm3', 'tm4', 'tm5']} == {SKIPPED}
+    assert sorted(fleet.installed) == ['tm0', 'tm1']
+
+def test_keep_going(fleet):
+    fleet.failing = ['tm1']
+    bundles, outcomes, calls = deploy(stop_on_failure=False)
+    assert len(fleet.installed) == 6
+
+def test_plan_then_apply(fleet):
+    bundles = [StandInBundle('a'), StandInBundle('b')]
+    changes, errors, calls = rolling_deploy().plan(bundles, dict(standin=DESTS))
+    assert errors == {}
+    assert len(changes['standin']) == 10
+    assert fleet.installed == []
+    deploy(plan=changes)
+    assert fleet.plans['tm0'] == []
+    assert fleet.plans['tm1'] == [dict(bundle_name='a', dest='tm1'), dict(bundle_name='b', dest='tm1')]
+
+def test_plan_unsupported(fleet, monkeypatch):
+    monkeypatch.setattr(StandInDestination, 'plan_certificates', DestinationBase.plan_certificates)
+    changes, errors, calls = rolling_deploy().plan([StandInBundle('a')], dict(standin=DESTS))
+    assert changes == {}
+    assert list(errors.keys()) == ['standin']
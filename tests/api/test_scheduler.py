@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import pytest
+
+from contextlib import closing
+from datetime import datetime, timedelta
+
+from jobs import JobQueue, DONE
+from scheduler import Scheduler
+
+NOW = datetime(2026, 10, 1)
+
+class StandInBundle(object):
+    def __init__(self, bundle_name, days, authority='digicert', destinations=None):
+        self.bundle_name = bundle_name
+        self.expiry = NOW + timedelta(days=days)
+        self.authority = {authority: dict(order_id=1)}
+        self.destinations = destinations or {}
+        self.pending = None
+
+@pytest.fixture
+def scheduler(tmpdir, monkeypatch):
+    queue = JobQueue(jobs_path=str(tmpdir.join('jobs.db')))
+    scheduler = Scheduler(scheduler_path=str(tmpdir.join('scheduler.db')), queue=queue)
+    scheduler.threshold = timedelta(days=30)
+    scheduler.batch_size = 2
+    scheduler.concurrency = 10
+    scheduler.daily_budget = 100
+    monkeypatch.setattr(scheduler, 'organizations', lambda bundles: {b.bundle_name: 'org' for b in bundles})
+    return scheduler
+
+def test_due_is_ordered_by_expiry(scheduler):
+    scheduler.load([StandInBundle('c@3', 90), StandInBundle('a@1', 5), StandInBundle('b@2', 20)])
+    assert [bundle.bundle_name for bundle in scheduler.due(NOW)] == ['a@1', 'b@2']
+    assert scheduler.heap[0][1] == 'c@3'
+
+def test_tick_batches_and_persists(scheduler):
+    bundles = [StandInBundle(f'b{n}@{n}', n) for n in range(5)]
+    scheduler.load(bundles)
+    job_ids = scheduler.tick(NOW)
+    assert len(job_ids) == 3
+    scheduler.load(bundles)
+    assert scheduler.tick(NOW) == []
+
+def test_daily_budget_defers(scheduler):
+    scheduler.daily_budget = 3
+    bundles = [StandInBundle(f'b{n}@{n}', n) for n in range(5)]
+    scheduler.load(bundles)
+    scheduler.tick(NOW)
+    assert len(scheduler.heap) == 2
+    assert scheduler.tick(NOW) == []
+    assert scheduler.tick(NOW + timedelta(days=1))
+
+def test_concurrency_limits_jobs_in_flight(scheduler):
+    scheduler.concurrency = 1
+    scheduler.load([StandInBundle(f'b{n}@{n}', n) for n in range(4)])
+    assert len(scheduler.tick(NOW)) == 1
+    assert scheduler.tick(NOW) == []
+
+def test_failed_bundles_are_retried(scheduler):
+    bundles = [StandInBundle('a@1', 5), StandInBundle('b@2', 6)]
+    scheduler.load(bundles)
+    job_id, = scheduler.tick(NOW)
+    outcomes = {'a@1': dict(status='renewed'), 'b@2': dict(status='failed')}
+    scheduler.queue.finish(job_id, DONE, dict(outcomes=outcomes), 201)
+    scheduler.load(bundles)
+    assert [bundle.bundle_name for bundle in scheduler.due(NOW)] == ['b@2']
+
+def test_staged_bundles_are_not_scheduled(scheduler):
+    staged = StandInBundle('a@1', 5)
+    staged.pending = dict(crt='crt')
+    scheduler.load([staged, StandInBundle('b@2', 6)])
+    assert [bundle.bundle_name for bundle in scheduler.due(NOW)] == ['b@2']
+
+def test_renewals_deploy_where_bundles_were_deployed(scheduler):
+    zeus = dict(zeus=dict(tm1=dict(matched=True), tm2=dict(matched=True)))
+    scheduler.load([StandInBundle('a@1', 5, destinations=zeus), StandInBundle('b@2', 6)])
+    job_ids = scheduler.tick(NOW)
+    assert len(job_ids) == 2
+    args = {}
+    for job_id in job_ids:
+        with closing(scheduler.queue.connect()) as db:
+            row = db.execute('select args from jobs where id = ?', (job_id,)).fetchone()
+        job_args = json.loads(row['args'])
+        args[job_args['bundle_name_pns'][0]] = job_args
+    assert args['a@1']['destinations'] == dict(zeus=['tm1', 'tm2'])
+    assert args['b@2']['destinations'] is None
+    assert args['a@1']['stage'] is False
+
+def test_in_flight_counts_only_active_jobs(scheduler):
+    scheduler.load([StandInBundle('a@1', 5), StandInBundle('b@2', 6), StandInBundle('c@3', 7)])
+    scheduler.batch_size = 1
+    first, second, third = scheduler.tick(NOW)
+    scheduler.queue.finish(first, DONE, dict(outcomes={}), 201)
+    assert scheduler.in_flight() == 2
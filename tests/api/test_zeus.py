@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import stat
+import pytest
+
+from urlpath import URL
+from attrdict import AttrDict
+
+from destination import base
+from destination.zeus import ZeusDestination, ZEUS_PATH, UNCHANGED, UPDATED, FAILED, RESTORED
+from destination.base import SnapshotNotFoundError
+from bundle import Bundle
+from cache import Cache
+
+DIR = os.path.dirname(os.path.realpath(__file__))
+KEY = open(DIR+'/key').read()
+CSR = open(DIR+'/csr').read()
+CRT = open(DIR+'/crt').read()
+
+DESTS = ['tm1', 'tm2']
+
+class StandInZeus(object):
+    '''
+    stands in for AsyncRequests talking to traffic managers; installed holds
+    dest -> name -> basic properties and rejected the dests refusing PUTs
+    '''
+    def __init__(self, installed=None, rejected=None):
+        self.installed = installed or {dest: {} for dest in DESTS}
+        self.rejected = rejected or []
+        self.sent = []
+
+    def requests(self, method, *kws):
+        calls = []
+        for kw in kws:
+            url = URL(kw['url'])
+            dest = url.hostname
+            name = str(url).partition(ZEUS_PATH.rstrip('/'))[2].lstrip('/')
+            self.sent += [(method, dest, name)]
+            if method == 'PUT':
+                status = 500 if dest in self.rejected else 201
+                if status == 201:
+                    self.installed[dest][name] = kw['json']['properties']['basic']
+                recv = dict(status=status, json={})
+            elif name in self.installed[dest]:
+                recv = dict(status=200, json=dict(properties=dict(basic=self.installed[dest][name])))
+            elif name:
+                recv = dict(status=404, json={})
+            else:
+                recv = dict(status=200, json=dict(children=[dict(name=name) for name in self.installed[dest]]))
+            calls += [AttrDict(send=dict(method=method, url=str(url)), recv=recv)]
+        return calls
+
+@pytest.fixture(autouse=True)
+def cache_path(tmpdir, monkeypatch):
+    monkeypatch.setattr(Cache, 'cache_path', str(tmpdir))
+
+def zeus(ar):
+    cfg = {dest: dict(baseurl=URL(f'https://{dest}/api/tm/3.5/config/active'), auth=['user', 'pswd']) for dest in DESTS}
+    return ZeusDestination(ar, cfg, 0)
+
+def bundle():
+    return Bundle('common.name', 'e8a7fcfbe48df21daede665d78984dec', KEY, CSR, CRT, '0000000')
+
+def installed(crt, note='bug 0000000'):
+    return dict(public=crt, request=CSR, private=KEY, note=note)
+
+def puts(ar):
+    return [(dest, name) for method, dest, name in ar.sent if method == 'PUT']
+
+def test_install_puts_only_changed():
+    name = bundle().friendly_common_name
+    ar = StandInZeus(installed=dict(tm1={name: installed(CRT)}, tm2={name: installed('missing')}))
+    bundles = zeus(ar).install_certificates('bug 1234567', [bundle()], DESTS)
+    assert puts(ar) == [('tm2', name)]
+    detail = bundles[0].destinations['zeus']
+    assert detail['tm1']['status'] == UNCHANGED
+    assert detail['tm1']['note'] == 'bug 0000000'
+    assert detail['tm2']['status'] == UPDATED
+
+def test_install_twice_is_free():
+    ar = StandInZeus()
+    zeus(ar).install_certificates('bug 1234567', [bundle()], DESTS)
+    assert len(puts(ar)) == 2
+    ar.sent = []
+    bundles = zeus(ar).install_certificates('bug 1234567', [bundle()], DESTS)
+    assert puts(ar) == []
+    assert {detail['status'] for detail in bundles[0].destinations['zeus'].values()} == {UNCHANGED}
+
+def test_install_reports_failed_dest():
+    ar = StandInZeus(rejected=['tm2'])
+    destination = zeus(ar)
+    bundles = destination.install_certificates('bug 1234567', [bundle()], DESTS)
+    detail = bundles[0].destinations['zeus']
+    assert detail['tm1']['status'] == UPDATED
+    assert detail['tm2']['status'] == FAILED
+    assert destination.failures(bundles, DESTS) == {bundles[0].bundle_name: dict(tm2=500)}
+
+def test_inventory_keyed_by_fingerprint():
+    name = bundle().friendly_common_name
+    ar = StandInZeus(installed=dict(tm1={name: installed(CRT)}, tm2={name: installed('missing')}))
+    details = zeus(ar)._get_installed_certificates_details([bundle()], DESTS)
+    assert set(details[(name, bundle().sha2)].keys()) == {'tm1'}
+    assert set(details[(name, None)].keys()) == {'tm2'}
+
+def test_fetch_matches_by_fingerprint():
+    name = bundle().friendly_common_name
+    ar = StandInZeus(installed=dict(tm1={name: installed(CRT)}, tm2={name: installed('missing')}))
+    bundles = zeus(ar).fetch_certificates([bundle()], DESTS)
+    detail = bundles[0].destinations['zeus']
+    assert detail['tm1']['matched'] is True
+    assert detail['tm2']['matched'] is False
+
+def gets(ar):
+    return [(dest, name) for method, dest, name in ar.sent if method == 'GET' and name]
+
+def test_inventory_is_cached_without_keys(tmpdir):
+    name = bundle().friendly_common_name
+    ar = StandInZeus(installed=dict(tm1={name: installed(CRT)}, tm2={}))
+    zeus(ar).fetch_certificates([bundle()], DESTS)
+    assert gets(ar) == [('tm1', name)]
+    assert 'PRIVATE KEY' not in open(f'{tmpdir}/zeus-inventory.json').read()
+    ar.sent = []
+    bundles = zeus(ar).fetch_certificates([bundle()], DESTS)
+    assert gets(ar) == []
+    assert bundles[0].destinations['zeus']['tm1']['matched'] is True
+
+def test_inventory_syncs_incrementally():
+    name = bundle().friendly_common_name
+    ar = StandInZeus(installed=dict(tm1={name: installed(CRT)}, tm2={}))
+    zeus(ar).fetch_certificates([bundle()], DESTS)
+    ar.installed['tm2'][name] = installed(CRT)
+    del ar.installed['tm1'][name]
+    ar.sent = []
+    bundles = zeus(ar).fetch_certificates([bundle()], DESTS)
+    assert gets(ar) == [('tm2', name)]
+    assert set(bundles[0].destinations['zeus'].keys()) == {'tm2'}
+
+def test_install_updates_inventory():
+    ar = StandInZeus()
+    zeus(ar).install_certificates('bug 1234567', [bundle()], DESTS)
+    ar.sent = []
+    bundles = zeus(ar).fetch_certificates([bundle()], DESTS)
+    assert gets(ar) == []
+    assert {detail['matched'] for detail in bundles[0].destinations['zeus'].values()} == {True}
+
+def test_install_refetches_past_the_cache():
+    name = bundle().friendly_common_name
+    ar = StandInZeus(installed={dest: {name: installed(CRT)} for dest in DESTS})
+    zeus(ar).fetch_certificates([bundle()], DESTS)
+    ar.installed['tm1'][name] = installed('missing')
+    ar.sent = []
+    zeus(ar).install_certificates('bug 1234567', [bundle()], DESTS)
+    assert sorted(gets(ar)) == [('tm1', name), ('tm1', name), ('tm2', name)]
+    assert puts(ar) == [('tm1', name)]
+
+def test_plan_then_apply_without_fetching():
+    name = bundle().friendly_common_name
+    ar = StandInZeus(installed=dict(tm1={name: installed(CRT)}, tm2={}))
+    plan = zeus(ar).plan_certificates([bundle()], DESTS)
+    assert plan == [dict(bundle_name=bundle().bundle_name, dest='tm2', sha2=bundle().sha2, installed=None, replaces=False)]
+    assert puts(ar) == []
+    ar.sent = []
+    bundles = zeus(ar).install_certificates('bug 1234567', [bundle()], DESTS, plan=plan)
+    assert ar.sent == [('PUT', 'tm2', name)]
+    detail = bundles[0].destinations['zeus']
+    assert detail['tm1']['status'] == UNCHANGED
+    assert detail['tm2']['status'] == UPDATED
+
+def test_rollback_restores_replaced(tmpdir, monkeypatch):
+    monkeypatch.setattr(base, 'CFG', dict(deploy=dict(snapshot_path=str(tmpdir.join('snapshots')))))
+    name = bundle().friendly_common_name
+    old = installed('missing', note='bug 0000000')
+    ar = StandInZeus(installed=dict(tm1={name: dict(old)}, tm2={}))
+    deploy_id = 'ab' * 16
+    bundles = zeus(ar).install_certificates('bug 1234567', [bundle()], DESTS, deploy_id=deploy_id)
+    assert bundles[0].destinations['zeus']['tm1']['deploy_id'] == deploy_id
+    assert ar.installed['tm1'][name]['public'] == CRT
+    snapshot = tmpdir.join('snapshots', deploy_id, 'zeus', 'tm1.json')
+    assert stat.S_IMODE(os.stat(str(snapshot)).st_mode) == 0o600
+    assert not tmpdir.join('snapshots', deploy_id, 'zeus', 'tm2.json').exists()
+    ar.sent = []
+    results = zeus(ar).rollback_certificates(deploy_id)
+    assert results == dict(tm1={name: RESTORED})
+    assert ar.sent == [('PUT', 'tm1', name)]
+    assert ar.installed['tm1'][name] == old
+
+def test_apply_plan_without_replaces_snapshots(tmpdir, monkeypatch):
+    monkeypatch.setattr(base, 'CFG', dict(deploy=dict(snapshot_path=str(tmpdir.join('snapshots')))))
+    name = bundle().friendly_common_name
+    ar = StandInZeus(installed=dict(tm1={name: installed('missing')}, tm2={}))
+    plan = zeus(ar).plan_certificates([bundle()], DESTS)
+    for change in plan:
+        del change['replaces']
+    ar.sent = []
+    deploy_id = 'ef' * 16
+    zeus(ar).install_certificates('bug 1234567', [bundle()], DESTS, plan=plan, deploy_id=deploy_id)
+    assert sorted(dest for method, dest, n in ar.sent if method == 'GET') == DESTS
+    assert sorted(puts(ar)) == [('tm1', name), ('tm2', name)]
+    assert tmpdir.join('snapshots', deploy_id, 'zeus', 'tm1.json').exists()
+    assert not tmpdir.join('snapshots', deploy_id, 'zeus', 'tm2.json').exists()
+
+def test_rollback_unknown_deploy(tmpdir, monkeypatch):
+    monkeypatch.setattr(base, 'CFG', dict(deploy=dict(snapshot_path=str(tmpdir))))
+    with pytest.raises(SnapshotNotFoundError):
+        zeus(StandInZeus()).rollback_certificates('cd' * 16)
+    with pytest.raises(SnapshotNotFoundError):
+        zeus(StandInZeus()).rollback_certificates('../../etc')